@@ -0,0 +1,539 @@
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+
+from .scripts.constants import COMPRESSED_IMAGE_FILE_TYPES
+from .settings import MAX_EXTRACTED_SIZE, MAX_ARCHIVE_ENTRIES, MAX_COMPRESSION_RATIO, MAX_ARCHIVE_DEPTH, \
+    UPLOAD_CHUNK_SIZE, ARCHIVE_COMPRESSION, ARCHIVE_THREADS
+
+# zlib levels of the compression settings, None stores the files
+COMPRESSION_LEVELS = {'store': None, 'fast': 1, 'default': zlib.Z_DEFAULT_COMPRESSION}
+
+# files up to this size are compressed in memory by the thread pool, larger ones are streamed
+_IN_MEMORY_SIZE = 8 * 1024 ** 2
+
+# folders and files that are never extracted
+SKIPPED_FOLDERS = ('__MACOSX', '.git')
+SKIPPED_FILES = ('.DS_Store',)
+
+# entries smaller than this are not checked against the compression ratio, tiny files compress very well
+_RATIO_MIN_SIZE = 1024 ** 2
+
+# nested archives up to this size are kept in memory while they are extracted
+_SPOOL_SIZE = 64 * 1024 ** 2
+
+_UTF8_FLAG = 0x800
+_ENCRYPTED_FLAG = 0x1
+
+# signature, versions, flags, compression, time, date, crc, sizes, name and extra field lengths
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+# signature, versions, flags, compression, time, date, crc, sizes, name, extra field and comment lengths,
+# disk number, internal and external attributes, offset of the local header
+_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+_END_RECORD = struct.Struct('<4s4H2LH')
+_ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_ENTRIES_LIMIT = 0xFFFF
+_DATA_DESCRIPTOR_FLAG = 0x8
+_UNIX = 3
+
+
+class ArchiveError(Exception):
+    """
+    Raised when an archive is broken, unsafe or exceeds the extraction limits.
+    """
+
+
+class _Limits:
+    # running totals shared by an archive and the archives nested in it
+    def __init__(self, max_size: int, max_entries: int, max_ratio: int, max_depth: int):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.max_ratio = max_ratio
+        self.max_depth = max_depth
+        self.size = 0
+        self.entries = 0
+
+    def add_entry(self, info: zipfile.ZipInfo):
+        self.entries += 1
+        if self.entries > self.max_entries:
+            raise ArchiveError(f'The archive has more than {self.max_entries} entries.')
+        if info.file_size >= _RATIO_MIN_SIZE and info.file_size > info.compress_size * self.max_ratio:
+            raise ArchiveError(f'{member_name(info)} is compressed more than {self.max_ratio} times.')
+
+    def add_bytes(self, n: int):
+        self.size += n
+        if self.size > self.max_size:
+            raise ArchiveError(f'The archive extracts to more than {self.max_size} bytes.')
+
+
+def member_name(info: zipfile.ZipInfo) -> str:
+    """
+    Returns the name of an archive member. Names of archives that do not set the utf-8 flag are decoded as utf-8 if
+    possible, as macOS writes them this way.
+
+    :param info: ZipInfo of the member
+    :return: str, name of the member with '/' separators
+    """
+    name = info.filename
+    if not info.flag_bits & _UTF8_FLAG:
+        try:
+            name = name.encode('cp437').decode('utf-8')
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return name.replace('\\', '/')
+
+
+def is_skipped(name: str) -> bool:
+    """
+    Checks if an archive member is not extracted: macOS metadata, .git folders and .DS_Store files.
+
+    :param name: name of the member
+    :return: True if the member is skipped, False otherwise
+    """
+    parts = name.rstrip('/').split('/')
+    if any(part in SKIPPED_FOLDERS for part in parts[:-1]) or parts[-1] in SKIPPED_FOLDERS:
+        return True
+    return parts[-1].startswith('._') or parts[-1] in SKIPPED_FILES
+
+
+def _path_parts(name: str) -> list:
+    return [part for part in name.split('/') if part not in ('', '.')]
+
+
+def _target_path(destination: str, name: str) -> str:
+    # refuse absolute paths and paths escaping the destination (zip slip)
+    parts = _path_parts(name)
+    if name.startswith('/') or '..' in parts or (parts and ':' in parts[0]):
+        raise ArchiveError(f'Unsafe path in the archive: {name}')
+    return os.path.join(destination, *parts)
+
+
+def _copy(source, target, limits: _Limits, declared_size: int):
+    written = 0
+    while chunk := source.read(UPLOAD_CHUNK_SIZE):
+        written += len(chunk)
+        if written > declared_size:
+            raise ArchiveError('An archive member is larger than its header says.')
+        limits.add_bytes(len(chunk))
+        target.write(chunk)
+
+
+def _is_small(info: zipfile.ZipInfo) -> bool:
+    # members that are read at once, bypassing ZipExtFile, which costs more than the IO for small files
+    return (info.file_size <= UPLOAD_CHUNK_SIZE and not info.flag_bits & _ENCRYPTED_FLAG
+            and info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED))
+
+
+def _seek_data(fileobj, info: zipfile.ZipInfo):
+    # moves to the compressed data of a member, right after its local header
+    fileobj.seek(info.header_offset)
+    header = fileobj.read(_LOCAL_HEADER.size)
+    if len(header) != _LOCAL_HEADER.size or header[:4] != _LOCAL_HEADER_SIGNATURE:
+        raise ArchiveError(f'Bad local header of {member_name(info)}.')
+    fields = _LOCAL_HEADER.unpack(header)
+    fileobj.seek(fields[-2] + fields[-1], os.SEEK_CUR)  # name and extra field
+
+
+def _read_small(fileobj, info: zipfile.ZipInfo, limits: _Limits) -> bytes:
+    _seek_data(fileobj, info)
+    data = fileobj.read(info.compress_size)
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        try:
+            data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(data, info.file_size + 1)
+        except zlib.error as e:
+            raise ArchiveError(f'{member_name(info)} is corrupted: {e}')
+    if len(data) != info.file_size:
+        raise ArchiveError(f'{member_name(info)} does not match the size in its header.')
+    if zlib.crc32(data) != info.CRC:
+        raise ArchiveError(f'{member_name(info)} is corrupted: bad CRC.')
+    limits.add_bytes(len(data))
+    return data
+
+
+def file_signature(stat_result: os.stat_result) -> tuple:
+    """
+    Returns what identifies the version of a file on disk: any write changes its modification time.
+
+    :param stat_result: os.stat_result of the file
+    :return: tuple (inode, size, modification time in ns)
+    """
+    return stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+
+def _finish_member(target: str, info: zipfile.ZipInfo, manifest: dict, name: str):
+    # restore the modification time like unzip does, a later write by the pipeline then always changes it
+    try:
+        timestamp = time.mktime(info.date_time + (0, 0, -1))
+        os.utime(target, (timestamp, timestamp))
+    except (OverflowError, ValueError):
+        pass  # invalid date in the archive, keep the extraction time
+    if manifest is not None:
+        manifest[name] = (info, file_signature(os.stat(target)))
+
+
+def _extract(fileobj, destination: str, limits: _Limits, depth: int, manifest: dict = None) -> int:
+    extracted = 0
+    folders = set()  # folders known to exist
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            name = member_name(info)
+            if is_skipped(name):
+                continue
+            limits.add_entry(info)
+            target = _target_path(destination, name)
+            folder = target if info.is_dir() else os.path.dirname(target)
+            if folder not in folders:
+                os.makedirs(folder, exist_ok=True)
+                folders.add(folder)
+            if info.is_dir():
+                continue
+
+            if name.endswith('.zip') and depth < limits.max_depth:
+                # nested archives are extracted next to where they would be, the archive itself is not written
+                with tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE) as spool:
+                    with archive.open(info) as source:
+                        _copy(source, spool, limits, info.file_size)
+                    spool.seek(0)
+                    if zipfile.is_zipfile(spool):
+                        extracted += _extract(spool, os.path.dirname(target), limits, depth + 1)
+                    else:  # not an archive after all, keep it as a file
+                        spool.seek(0)
+                        with open(target, 'wb') as f:
+                            shutil.copyfileobj(spool, f)
+                        _finish_member(target, info, manifest, '/'.join(_path_parts(name)))
+                        extracted += 1
+                continue
+
+            if _is_small(info):
+                data = _read_small(fileobj, info, limits)
+                with open(target, 'wb') as f:
+                    f.write(data)
+            else:
+                with archive.open(info) as source, open(target, 'wb') as f:
+                    _copy(source, f, limits, info.file_size)
+            _finish_member(target, info, manifest, '/'.join(_path_parts(name)))
+            extracted += 1
+    return extracted
+
+
+def extract_archive(zip_path: str, destination: str,
+                    max_size: int = MAX_EXTRACTED_SIZE,
+                    max_entries: int = MAX_ARCHIVE_ENTRIES,
+                    max_ratio: int = MAX_COMPRESSION_RATIO,
+                    max_depth: int = MAX_ARCHIVE_DEPTH,
+                    manifest: dict = None) -> int:
+    """
+    Extracts a zip archive in one pass over its central directory. Members are streamed to disk, macOS metadata,
+    .git folders and .DS_Store files are skipped, and nested .zip archives are extracted in place of the archive.
+    Modification times are restored from the archive.
+
+    :param zip_path: path to the archive
+    :param destination: directory to extract to
+    :param max_size: int, largest total size of the extracted files in bytes
+    :param max_entries: int, largest number of members, including the members of nested archives
+    :param max_ratio: int, largest compression ratio of a member
+    :param max_depth: int, how deep nested archives are extracted, deeper ones are written as files
+    :param manifest: dict to fill with the files extracted from the archive itself (not from nested archives)
+                     in the format {path relative to destination: (ZipInfo, file_signature)}, see write_archive
+    :return: int, number of extracted files
+    :raises ArchiveError: if the archive is broken, has unsafe paths or exceeds a limit
+    """
+    limits = _Limits(max_size, max_entries, max_ratio, max_depth)
+    os.makedirs(destination, exist_ok=True)
+    try:
+        with open(zip_path, 'rb') as fileobj:
+            return _extract(fileobj, destination, limits, depth=0, manifest=manifest)
+    except zipfile.BadZipFile as e:
+        raise ArchiveError(f'The file is not a valid zip archive: {e}')
+    except NotImplementedError as e:
+        raise ArchiveError(f'The archive uses an unsupported feature: {e}')
+
+
+class ZipWriter:
+    """
+    Writes a zip archive entry by entry. Unlike zipfile, it takes entries that are already compressed, so members
+    of another archive can be copied without decompressing and compressing them again.
+    """
+
+    def __init__(self, fileobj):
+        """
+        :param fileobj: seekable binary file to write the archive to
+        """
+        self.fileobj = fileobj
+        self.entries = []  # (ZipInfo, flags, offset of the local header)
+
+    def _write_local_header(self, info: zipfile.ZipInfo, zip64: bool) -> int:
+        offset = self.fileobj.tell()
+        name = info.filename.encode('utf-8')
+        flags = info.flag_bits & ~_DATA_DESCRIPTOR_FLAG & ~_UTF8_FLAG
+        if not info.filename.isascii():
+            flags |= _UTF8_FLAG
+        extra = struct.pack('<2H2Q', 1, 16, info.file_size, info.compress_size) if zip64 else b''
+        dos_time, dos_date = _dos_date_time(info.date_time)
+        self.fileobj.write(_LOCAL_HEADER.pack(
+            _LOCAL_HEADER_SIGNATURE, 45 if zip64 else 20, 0, flags, info.compress_type, dos_time, dos_date, info.CRC,
+            _ZIP64_LIMIT if zip64 else info.compress_size, _ZIP64_LIMIT if zip64 else info.file_size,
+            len(name), len(extra)))
+        self.fileobj.write(name)
+        self.fileobj.write(extra)
+        self.entries.append((info, flags, offset))
+        return offset
+
+    def write_compressed(self, info: zipfile.ZipInfo, chunks):
+        """
+        Adds an entry whose data is already compressed.
+
+        :param info: ZipInfo with filename, compress_type, CRC, compress_size, file_size, date_time and external_attr
+        :param chunks: iterable of bytes, the compressed data
+        """
+        self._write_local_header(info, info.file_size >= _ZIP64_LIMIT or info.compress_size >= _ZIP64_LIMIT)
+        for chunk in chunks:
+            self.fileobj.write(chunk)
+
+    def copy_entry(self, source, info: zipfile.ZipInfo, name: str = None):
+        """
+        Copies a member of another archive without decompressing it.
+
+        :param source: binary file of the other archive
+        :param info: ZipInfo of the member in the other archive
+        :param name: name of the entry in this archive, the member's name by default
+        """
+        entry = _copy_info(info, name or info.filename)
+        _seek_data(source, info)
+        self.write_compressed(entry, _read_chunks(source, info.compress_size))
+
+    def write_file(self, path: str, name: str, compresslevel=zlib.Z_DEFAULT_COMPRESSION,
+                   stat_result: os.stat_result = None):
+        """
+        Adds a file from disk, streaming it through the compressor.
+
+        :param path: path to the file
+        :param name: name of the entry
+        :param compresslevel: int, zlib compression level, None to store the file
+        :param stat_result: os.stat_result of the file if it is already known
+        """
+        info = _file_info(name, stat_result or os.stat(path))
+        compressor = None
+        if compresslevel is not None:
+            info.compress_type = zipfile.ZIP_DEFLATED
+            compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        # the sizes are only known at the end, write the header first and fill them in afterwards
+        zip64 = info.file_size >= _ZIP64_LIMIT - _ZIP64_LIMIT // 16  # leave room for incompressible data
+        offset = self._write_local_header(info, zip64)
+        crc = file_size = compress_size = 0
+        with open(path, 'rb') as f:
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                data = compressor.compress(chunk) if compressor else chunk
+                compress_size += len(data)
+                self.fileobj.write(data)
+        if compressor:
+            data = compressor.flush()
+            compress_size += len(data)
+            self.fileobj.write(data)
+        info.CRC, info.file_size, info.compress_size = crc, file_size, compress_size
+        if not zip64 and (file_size >= _ZIP64_LIMIT or compress_size >= _ZIP64_LIMIT):
+            raise ArchiveError(f'{path} grew past the zip64 limit while it was archived.')
+        end = self.fileobj.tell()
+        self.fileobj.seek(offset)
+        self.entries.pop()
+        self._write_local_header(info, zip64)
+        self.fileobj.seek(end)
+
+    def write_directory(self, path: str, name: str):
+        """
+        Adds a directory entry.
+
+        :param path: path to the directory
+        :param name: name of the entry, without the trailing '/'
+        """
+        info = _file_info(name + '/', os.stat(path))
+        info.file_size = 0
+        info.external_attr |= 0x10  # MS-DOS directory flag
+        self._write_local_header(info, zip64=False)
+
+    def close(self):
+        """
+        Writes the central directory. The file object is not closed.
+        """
+        start = self.fileobj.tell()
+        for info, flags, offset in self.entries:
+            name = info.filename.encode('utf-8')
+            fields = [value for value in (info.file_size, info.compress_size, offset) if value >= _ZIP64_LIMIT]
+            extra = struct.pack(f'<2H{len(fields)}Q', 1, 8 * len(fields), *fields) if fields else b''
+            dos_time, dos_date = _dos_date_time(info.date_time)
+            self.fileobj.write(_CENTRAL_HEADER.pack(
+                _CENTRAL_HEADER_SIGNATURE, 45 if fields else 20, _UNIX, 45 if fields else 20, 0, flags,
+                info.compress_type, dos_time, dos_date, info.CRC,
+                min(info.compress_size, _ZIP64_LIMIT), min(info.file_size, _ZIP64_LIMIT),
+                len(name), len(extra), 0, 0, info.internal_attr, info.external_attr, min(offset, _ZIP64_LIMIT)))
+            self.fileobj.write(name)
+            self.fileobj.write(extra)
+        end = self.fileobj.tell()
+        count, size = len(self.entries), end - start
+
+        if count >= _ZIP64_ENTRIES_LIMIT or size >= _ZIP64_LIMIT or start >= _ZIP64_LIMIT:
+            self.fileobj.write(_ZIP64_END_RECORD.pack(b'PK\x06\x06', _ZIP64_END_RECORD.size - 12, 45, 45, 0, 0,
+                                                      count, count, size, start))
+            self.fileobj.write(_ZIP64_LOCATOR.pack(b'PK\x06\x07', 0, end, 1))
+        self.fileobj.write(_END_RECORD.pack(b'PK\x05\x06', 0, 0, min(count, _ZIP64_ENTRIES_LIMIT),
+                                            min(count, _ZIP64_ENTRIES_LIMIT), min(size, _ZIP64_LIMIT),
+                                            min(start, _ZIP64_LIMIT), 0))
+
+
+def _dos_date_time(date_time: tuple) -> (int, int):
+    year, month, day, hour, minute, second = date_time
+    year = min(max(year, 1980), 2107)
+    return hour << 11 | minute << 5 | second // 2, (year - 1980) << 9 | month << 5 | day
+
+
+def _file_info(name: str, stat_result: os.stat_result) -> zipfile.ZipInfo:
+    # like ZipInfo.from_file, without another stat call, dates before 1980 cannot be stored
+    date_time = max(time.localtime(stat_result.st_mtime)[:6], (1980, 1, 1, 0, 0, 0))
+    info = zipfile.ZipInfo(name, date_time)
+    info.external_attr = (stat_result.st_mode & 0xFFFF) << 16
+    info.file_size = stat_result.st_size
+    info.CRC = info.compress_size = 0
+    return info
+
+
+def _copy_info(info: zipfile.ZipInfo, name: str) -> zipfile.ZipInfo:
+    entry = zipfile.ZipInfo(name, info.date_time)
+    entry.compress_type = info.compress_type
+    entry.flag_bits = info.flag_bits
+    entry.CRC = info.CRC
+    entry.compress_size = info.compress_size
+    entry.file_size = info.file_size
+    entry.internal_attr = info.internal_attr
+    entry.external_attr = info.external_attr
+    return entry
+
+
+def _read_chunks(fileobj, size: int):
+    while size > 0:
+        chunk = fileobj.read(min(UPLOAD_CHUNK_SIZE, size))
+        if not chunk:
+            raise ArchiveError('The source archive ended unexpectedly.')
+        size -= len(chunk)
+        yield chunk
+
+
+def compress_file(path: str, name: str, stat_result: os.stat_result, compresslevel) -> (zipfile.ZipInfo, bytes):
+    """
+    Compresses a file in memory. zlib releases the GIL, so files can be compressed concurrently in threads.
+
+    :param path: path to the file
+    :param name: name of the entry
+    :param stat_result: os.stat_result of the file
+    :param compresslevel: int, zlib compression level, None to store the file
+    :return: tuple (ZipInfo of the entry, compressed data) for ZipWriter.write_compressed
+    """
+    info = _file_info(name, stat_result)
+    with open(path, 'rb') as f:
+        data = f.read()
+    info.CRC = zlib.crc32(data)
+    info.file_size = len(data)
+    if compresslevel is not None:
+        info.compress_type = zipfile.ZIP_DEFLATED
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(data) + compressor.flush()
+    info.compress_size = len(data)
+    return info, data
+
+
+def _archive_entries(folder: str, manifest: dict):
+    # (kind, path, name, stat_result or manifest entry) in the order make_archive would write them
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        files.sort()
+        prefix = os.path.relpath(root, folder).replace(os.sep, '/')
+        prefix = '' if prefix == '.' else prefix + '/'
+        for directory in dirs:
+            yield 'directory', os.path.join(root, directory), prefix + directory, None
+        for file in files:
+            path = os.path.join(root, file)
+            name = prefix + file
+            stat_result = os.stat(path)
+            entry = manifest.get(name)
+            if entry is not None and entry[1] == file_signature(stat_result):
+                yield 'copy', path, name, entry[0]
+            else:
+                yield 'file', path, name, stat_result
+
+
+def write_archive(folder: str, output_path: str, source_path: str = None, manifest: dict = None,
+                  compression: str = ARCHIVE_COMPRESSION, threads: int = ARCHIVE_THREADS) -> (int, int):
+    """
+    Archives a folder like shutil.make_archive(base_name, 'zip', folder). Files that were extracted from the source
+    archive and not modified since (their file_signature still matches the manifest) are copied from it as they are,
+    so only the modified and new files are compressed, concurrently in a thread pool. Compressed image formats are
+    stored. The archive is written next to output_path and moved into place when it is complete, output_path may be
+    the source archive itself.
+
+    :param folder: folder to archive
+    :param output_path: path of the archive to write
+    :param source_path: path of the archive the folder was extracted from
+    :param manifest: manifest filled by extract_archive
+    :param compression: str, one of COMPRESSION_LEVELS: 'store', 'fast' or 'default'
+    :param threads: int, number of compressing threads
+    :return: tuple (number of copied files, number of compressed or stored files)
+    """
+    if compression not in COMPRESSION_LEVELS:
+        raise ValueError(f'Unknown compression {compression!r}, expected one of {", ".join(COMPRESSION_LEVELS)}.')
+    level = COMPRESSION_LEVELS[compression]
+    manifest = manifest if source_path is not None and manifest is not None else {}
+    partial = f'{output_path}.part'
+    copied = compressed = 0
+    try:
+        with open(partial, 'wb') as output, open(source_path or os.devnull, 'rb') as source, \
+                ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+            writer = ZipWriter(output)
+            # entries are written in order, the compressed ones a few entries behind the threads compressing them
+            pending = deque()
+
+            def write_next():
+                kind, path, name, data = pending.popleft()
+                if kind == 'directory':
+                    writer.write_directory(path, name)
+                elif kind == 'copy':
+                    writer.copy_entry(source, data, name)
+                elif kind == 'compressed':
+                    info, compressed_data = data.result()
+                    writer.write_compressed(info, (compressed_data,))
+                else:
+                    writer.write_file(path, name, file_level(name), data)
+
+            def file_level(name: str):
+                return None if name.lower().endswith(COMPRESSED_IMAGE_FILE_TYPES) else level
+
+            for kind, path, name, data in _archive_entries(folder, manifest):
+                if kind == 'copy':
+                    copied += 1
+                elif kind == 'file':
+                    compressed += 1
+                    if data.st_size <= _IN_MEMORY_SIZE:
+                        kind, data = 'compressed', pool.submit(compress_file, path, name, data, file_level(name))
+                pending.append((kind, path, name, data))
+                if len(pending) > 4 * threads:
+                    write_next()
+            while pending:
+                write_next()
+            writer.close()
+        os.replace(partial, output_path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return copied, compressed
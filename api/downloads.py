@@ -0,0 +1,179 @@
+import asyncio
+import os
+import shutil
+import time
+
+import anyio
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse
+
+from .jobs import jobs
+from .notifications import close_job
+from .settings import DOWNLOAD_CLEANUP_DELAY, RESULT_TTL, RESULT_SWEEP_INTERVAL
+
+# running cleanup tasks, the event loop only keeps weak references to tasks
+_cleanup_tasks = set()
+
+
+def parse_range(range_header: str, size: int):
+    """
+    Parses a Range header with a single byte range.
+
+    :param range_header: value of the Range header, e.g. 'bytes=0-1023', 'bytes=1024-' or 'bytes=-1024'
+    :param size: int, size of the file
+    :return: tuple (start, end) with the inclusive end, None to send the whole file,
+             or False if the range cannot be satisfied
+    """
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None  # other units and multiple ranges are answered with the whole file
+    first, _, last = ranges.strip().partition('-')
+    try:
+        if not first:
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+class RangeFileResponse(FileResponse):
+    """
+    FileResponse that answers single byte-range requests with 206, so interrupted downloads can be resumed.
+    Whole files go through http.response.pathsend when the server supports it, the file is never read into memory.
+    on_complete is called only if the last byte of the file reached the client.
+    """
+
+    def __init__(self, path: str, range_header: str = None, if_range: str = None, on_complete: callable = None,
+                 **kwargs):
+        super().__init__(path, stat_result=os.stat(path), **kwargs)
+        self.on_complete = on_complete
+        self.headers['accept-ranges'] = 'bytes'
+        size = self.stat_result.st_size
+        self.range = None
+        if range_header and (if_range is None or if_range in (self.headers['etag'], self.headers['last-modified'])):
+            self.range = parse_range(range_header, size)
+        if self.range is False:
+            self.status_code = 416
+            self.headers['content-range'] = f'bytes */{size}'
+            self.headers['content-length'] = '0'
+        elif self.range is not None:
+            start, end = self.range
+            self.status_code = 206
+            self.headers['content-range'] = f'bytes {start}-{end}/{size}'
+            self.headers['content-length'] = str(end - start + 1)
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+
+        size = self.stat_result.st_size
+        completed = False
+        if scope['method'].upper() == 'HEAD' or self.range is False:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        elif self.range is None and 'http.response.pathsend' in scope.get('extensions', {}):
+            await send({'type': 'http.response.pathsend', 'path': str(self.path)})
+            completed = True
+        else:
+            start, end = self.range or (0, size - 1)
+            completed = await self._send_range(receive, send, start, end) and end == size - 1
+
+        if completed and self.on_complete is not None:
+            self.on_complete()
+        if self.background is not None:
+            await self.background()
+
+    async def _send_range(self, receive, send, start: int, end: int) -> bool:
+        # servers drop the body of a closed connection silently, listen for the disconnect to tell if the client got it
+        sent = False
+        async with anyio.create_task_group() as task_group:
+            async def listen_for_disconnect():
+                while (await receive())['type'] != 'http.disconnect':
+                    pass
+                task_group.cancel_scope.cancel()
+
+            task_group.start_soon(listen_for_disconnect)
+            async with await anyio.open_file(self.path, mode='rb') as file:
+                await file.seek(start)
+                remaining = end - start + 1
+                more_body = True
+                while more_body:
+                    chunk = await file.read(min(self.chunk_size, remaining)) if remaining > 0 else b''
+                    remaining -= len(chunk)
+                    more_body = remaining > 0 and len(chunk) > 0  # a file truncated meanwhile ends early
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
+                sent = remaining == 0
+            task_group.cancel_scope.cancel()
+        return sent
+
+
+def remove_project(project_id: str, root_dir: str):
+    """
+    Removes the files of a project and forgets its job.
+
+    :param project_id: str, id of the project
+    :param root_dir: str, directory of the project
+    """
+    shutil.rmtree(root_dir, True)
+    close_job(project_id)
+
+
+async def _remove_project(project_id: str, root_dir: str, delay: float):
+    await asyncio.sleep(delay)
+    await run_in_threadpool(remove_project, project_id, root_dir)
+
+
+def schedule_cleanup(project_id: str, root_dir: str, delay: float = DOWNLOAD_CLEANUP_DELAY):
+    """
+    Removes a project in the background after a delay, without blocking the event loop.
+    Must be called from the event loop.
+
+    :param project_id: str, id of the project
+    :param root_dir: str, directory of the project
+    :param delay: float, seconds to wait before removing the project
+    """
+    task = asyncio.get_running_loop().create_task(_remove_project(project_id, root_dir, delay))
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+
+
+def remove_expired_projects(ttl: float = RESULT_TTL) -> int:
+    """
+    Removes the projects of the jobs that finished more than ttl seconds ago, whether or not they were downloaded.
+
+    :param ttl: float, seconds a finished project is kept
+    :return: int, number of removed projects
+    """
+    expired = jobs.find_finished(time.time() - ttl)
+    for project_id in expired:
+        remove_project(project_id, f'projects/{project_id}')
+    return len(expired)
+
+
+async def sweep_expired_projects(ttl: float = RESULT_TTL, interval: float = RESULT_SWEEP_INTERVAL):
+    """
+    Removes expired projects right away and then every interval seconds, see remove_expired_projects.
+    Every worker process of the server may run it, removing a project twice is harmless.
+
+    :param ttl: float, seconds a finished project is kept
+    :param interval: float, seconds between two sweeps
+    """
+    while True:
+        try:
+            removed = await run_in_threadpool(remove_expired_projects, ttl)
+            if removed:
+                print(f'Removed {removed} expired project(s)')
+        except Exception as e:
+            print(f'Failed to remove expired projects: {e}')
+        await asyncio.sleep(interval)
+
+
+def start_sweeping(ttl: float = RESULT_TTL, interval: float = RESULT_SWEEP_INTERVAL):
+    """
+    Starts sweep_expired_projects in the background. Must be called from the event loop.
+    """
+    task = asyncio.get_running_loop().create_task(sweep_expired_projects(ttl, interval))
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
@@ -0,0 +1,310 @@
+import os
+import sqlite3
+import threading
+import time
+
+from .settings import JOBS_DATABASE
+
+# job statuses
+RECEIVED = 'received'
+QUEUED = 'queued'
+RUNNING = 'running'
+READY = 'ready'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# statuses of jobs that are still being processed
+ACTIVE_STATUSES = (RECEIVED, QUEUED, RUNNING)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    project_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    status TEXT NOT NULL,
+    message TEXT,
+    progress REAL NOT NULL DEFAULT 0,
+    size INTEGER,
+    content_hash TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    updated_at REAL NOT NULL,
+    metrics TEXT,
+    seed INTEGER,
+    task TEXT,
+    queued_at REAL,
+    worker_pid INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_user_id ON jobs (user_id);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS stage_totals (
+    stage TEXT PRIMARY KEY,
+    runs INTEGER NOT NULL,
+    wall_time REAL NOT NULL,
+    cpu_time REAL NOT NULL,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    skipped INTEGER NOT NULL,
+    cache_hits INTEGER NOT NULL DEFAULT 0,
+    cache_misses INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+# columns added after the first release, added to existing databases
+_ADDED_COLUMNS = {
+    'jobs': {'metrics': 'TEXT', 'seed': 'INTEGER', 'task': 'TEXT', 'queued_at': 'REAL', 'worker_pid': 'INTEGER'},
+    'stage_totals': {'cache_hits': 'INTEGER NOT NULL DEFAULT 0', 'cache_misses': 'INTEGER NOT NULL DEFAULT 0'},
+}
+
+# counters of stage_totals, see record_stage
+STAGE_COUNTERS = ('wall_time', 'cpu_time', 'files', 'bytes', 'skipped', 'cache_hits', 'cache_misses')
+
+# columns that update() may set
+_COLUMNS = ('user_id', 'filename', 'status', 'message', 'progress', 'size', 'content_hash',
+            'started_at', 'finished_at', 'metrics')
+
+
+class JobStore:
+    """
+    Registry of the jobs in a SQLite database in WAL mode, so every worker process of the server sees the same state
+    and readers do not block the writer. Each statement is atomic, status transitions are conditional updates.
+    Connections are opened lazily, one per thread.
+    """
+
+    def __init__(self, path: str = JOBS_DATABASE):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            for table, added_columns in _ADDED_COLUMNS.items():
+                columns = {row[1] for row in connection.execute(f'PRAGMA table_info({table})')}
+                for column, column_type in added_columns.items():
+                    if column not in columns:
+                        connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+            self._local.connection = connection
+        return connection
+
+    def create(self, project_id: str, user_id: str, filename: str, seed: int = None) -> bool:
+        """
+        Registers a new job.
+
+        :param project_id: str, id of the project
+        :param user_id: str, id of the user who may download the result
+        :param filename: str, name of the uploaded archive
+        :param seed: int, seed of the job, kept so that the job can be reproduced
+        :return: True if the job was created, False if the project id is already in use
+        """
+        now = time.time()
+        try:
+            self._connection.execute(
+                'INSERT INTO jobs (project_id, user_id, filename, status, created_at, updated_at, seed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', (project_id, user_id, filename, RECEIVED, now, now, seed))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def get(self, project_id: str):
+        """
+        Returns a job.
+
+        :param project_id: str, id of the project
+        :return: dict with the columns of the job, None if there is no such job
+        """
+        row = self._connection.execute('SELECT * FROM jobs WHERE project_id = ?', (project_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def find_by_user(self, user_id: str) -> list:
+        """
+        Returns the jobs of a user, the newest first.
+
+        :param user_id: str, id of the user
+        :return: list of dicts with the columns of the jobs
+        """
+        rows = self._connection.execute(
+            'SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at DESC', (user_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def update(self, project_id: str, **fields) -> bool:
+        """
+        Sets columns of a job.
+
+        :param project_id: str, id of the project
+        :param fields: columns to set, see _COLUMNS
+        :return: True if the job exists, False otherwise
+        """
+        unknown = set(fields) - set(_COLUMNS)
+        if unknown:
+            raise ValueError(f'Unknown job columns: {", ".join(sorted(unknown))}')
+        assignments = ''.join(f'{column} = ?, ' for column in fields)
+        cursor = self._connection.execute(
+            f'UPDATE jobs SET {assignments}updated_at = ? WHERE project_id = ?',
+            (*fields.values(), time.time(), project_id))
+        return cursor.rowcount > 0
+
+    def transition(self, project_id: str, status: str, from_statuses: tuple = ACTIVE_STATUSES, **fields) -> bool:
+        """
+        Changes the status of a job atomically, only if it currently has one of the given statuses.
+
+        :param project_id: str, id of the project
+        :param status: str, new status
+        :param from_statuses: tuple of statuses the job may have
+        :param fields: other columns to set together with the status
+        :return: True if the status was changed, False otherwise
+        """
+        fields = {'status': status, **fields}
+        assignments = ''.join(f'{column} = ?, ' for column in fields)
+        placeholders = ', '.join('?' * len(from_statuses))
+        cursor = self._connection.execute(
+            f'UPDATE jobs SET {assignments}updated_at = ? WHERE project_id = ? AND status IN ({placeholders})',
+            (*fields.values(), time.time(), project_id, *from_statuses))
+        return cursor.rowcount > 0
+
+    def enqueue(self, project_id: str, task: str, concurrency: int, max_queued: int) -> bool:
+        """
+        Queues a received job atomically, only if fewer than max_queued jobs of the whole server would have to wait.
+
+        :param project_id: str, id of the project
+        :param task: str, what to run, see JobScheduler.submit
+        :param concurrency: int, number of jobs that may run at once, queued jobs up to the free slots do not wait
+        :param max_queued: int, number of jobs that may wait
+        :return: True if the job was queued, False if the queue is full or the job is not received anymore
+        """
+        now = time.time()
+        cursor = self._connection.execute(
+            'UPDATE jobs SET status = ?, task = ?, queued_at = ?, updated_at = ? WHERE project_id = ? AND status = ? '
+            'AND (SELECT COUNT(*) FROM jobs WHERE status = ?) '
+            '- MAX(0, ? - (SELECT COUNT(*) FROM jobs WHERE status = ?)) < ?',
+            (QUEUED, task, now, now, project_id, RECEIVED, QUEUED, concurrency, RUNNING, max_queued))
+        return cursor.rowcount > 0
+
+    def claim(self, pick: callable, concurrency: int):
+        """
+        Starts the next queued job atomically, only if fewer than concurrency jobs of the whole server are running.
+        The job is marked as run by the calling process.
+
+        :param pick: function that returns the job to start from a non-empty list of the queued jobs
+        :param concurrency: int, number of jobs that may run at once
+        :return: dict with the columns of the started job, None if there is no job or no free slot
+        """
+        connection = self._connection
+        # a cheap read first, so that idle servers do not take the write lock
+        if not self._can_claim(concurrency):
+            return None
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            job = None
+            if self._can_claim(concurrency):
+                queued = [dict(row) for row in connection.execute('SELECT * FROM jobs WHERE status = ?', (QUEUED,))]
+                job = pick(queued)
+                now = time.time()
+                job.update(status=RUNNING, started_at=now, worker_pid=os.getpid())
+                connection.execute(
+                    'UPDATE jobs SET status = ?, started_at = ?, worker_pid = ?, updated_at = ? WHERE project_id = ?',
+                    (RUNNING, now, job['worker_pid'], now, job['project_id']))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return job
+
+    def _can_claim(self, concurrency: int) -> bool:
+        counts = self.count_by_status()
+        return counts.get(QUEUED, 0) > 0 and counts.get(RUNNING, 0) < concurrency
+
+    def find_by_status(self, *statuses: str) -> list:
+        """
+        Returns the jobs with one of the given statuses.
+
+        :param statuses: str, statuses of the jobs
+        :return: list of dicts with the columns of the jobs
+        """
+        rows = self._connection.execute(
+            f'SELECT * FROM jobs WHERE status IN ({", ".join("?" * len(statuses))})', statuses).fetchall()
+        return [dict(row) for row in rows]
+
+    def average_duration(self, limit: int = 20):
+        """
+        Returns the average run time in seconds of the last finished jobs still in the registry, None if there are none.
+
+        :param limit: int, number of jobs to average
+        """
+        row = self._connection.execute(
+            'SELECT AVG(finished_at - started_at) FROM (SELECT started_at, finished_at FROM jobs '
+            'WHERE started_at IS NOT NULL AND finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?)',
+            (limit,)).fetchone()
+        return row[0]
+
+    def status(self, project_id: str):
+        """
+        Returns the status of a job, None if there is no such job.
+        """
+        row = self._connection.execute('SELECT status FROM jobs WHERE project_id = ?', (project_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def message(self, project_id: str):
+        """
+        Returns the last notification of a job, None if there is no such job or it has no notifications yet.
+        """
+        row = self._connection.execute('SELECT message FROM jobs WHERE project_id = ?', (project_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def delete(self, project_id: str):
+        """
+        Removes a job from the registry.
+        """
+        self._connection.execute('DELETE FROM jobs WHERE project_id = ?', (project_id,))
+
+    def find_finished(self, before: float) -> list:
+        """
+        Returns the jobs that are over and finished, or were cancelled, before a time.
+
+        :param before: float, timestamp
+        :return: list of project ids
+        """
+        statuses = (READY, FAILED, CANCELLED)
+        rows = self._connection.execute(
+            f'SELECT project_id FROM jobs WHERE status IN ({", ".join("?" * len(statuses))}) '
+            f'AND COALESCE(finished_at, updated_at) < ?', (*statuses, before)).fetchall()
+        return [row[0] for row in rows]
+
+    def count_by_status(self) -> dict:
+        """
+        Returns the number of jobs in the registry by status.
+        """
+        return dict(self._connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def record_stage(self, stage: str, **counters):
+        """
+        Adds a run of a pipeline stage to the totals shared by all processes.
+
+        :param stage: str, name of the stage
+        :param counters: values of STAGE_COUNTERS, missing ones count as 0
+        """
+        values = [counters.get(counter, 0) for counter in STAGE_COUNTERS]
+        placeholders = ', '.join('?' * len(STAGE_COUNTERS))
+        self._connection.execute(
+            f'INSERT INTO stage_totals (stage, runs, {", ".join(STAGE_COUNTERS)}) VALUES (?, 1, {placeholders}) '
+            f'ON CONFLICT (stage) DO UPDATE SET runs = runs + 1, '
+            + ', '.join(f'{counter} = {counter} + excluded.{counter}' for counter in STAGE_COUNTERS),
+            (stage, *values))
+
+    def stage_totals(self) -> list:
+        """
+        Returns the totals of the pipeline stages.
+
+        :return: list of dicts with the columns of stage_totals, ordered by stage
+        """
+        rows = self._connection.execute('SELECT * FROM stage_totals ORDER BY stage').fetchall()
+        return [dict(row) for row in rows]
+
+
+jobs = JobStore()
@@ -1,21 +1,30 @@
-import io
 import multiprocessing
-import shutil
+import os
+import threading
 import time
-import asyncio
 from typing import Optional
 import random
-import subprocess
-import platform
 
-from fastapi import FastAPI, UploadFile, File, Request, Query, WebSocket, WebSocketDisconnect, BackgroundTasks
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, Request, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
 
 from websockets.exceptions import ConnectionClosedOK
 
 from .pipeline import pipeline
+from .archives import extract_archive, write_archive, COMPRESSION_LEVELS
+from .downloads import RangeFileResponse, schedule_cleanup, remove_project, start_sweeping
+from .jobs import jobs, RUNNING, READY, FAILED
+from .metrics import measure_stage, finish_job, render_metrics
 from .notifications import *
+from .scheduler import scheduler, QueueFull
+from .scripts import TransformCache
+from .settings import resolve_workers, ARCHIVE_COMPRESSION, NOTIFICATION_POLL_INTERVAL, DOWNLOAD_CLEANUP_DELAY, \
+    TRANSFORM_CACHE_DIR, TRANSFORM_CACHE_SIZE, TRANSFORM_CACHE_EVICTION_INTERVAL, MAX_UPLOAD_SIZE
+from .uploads import StreamingUpload, UploadTooLarge, InvalidUpload
+from .workers import run_isolated, terminate_all
 
 app = FastAPI()
 
@@ -29,18 +38,16 @@ app.add_middleware(
 )
 
 
-def unzip_archive(zip_file, destination):
-    system = platform.system()
-    if system == "Linux":
-        subprocess.run(["unzip", zip_file, "-d", destination])
-    elif system == "Windows":
-        zip_file = os.path.abspath(zip_file).replace('/', '\\')  # Convert path to Windows format
-        destination = os.path.abspath(destination).replace('/', '\\')  # Convert path to Windows format
-        subprocess.run(
-            ["powershell", "Expand-Archive", "-Path", f'"{zip_file}"', "-DestinationPath", f'"{destination}"'],
-        )
-    else:
-        print("Unsupported operating system.")
+@app.on_event("startup")
+async def startup():
+    # results that are never downloaded completely are removed once they expire
+    start_sweeping()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    # job processes are not daemons, since they start processes of their own, stop them with the server
+    terminate_all()
 
 
 @app.get("/api/v1/get_id")
@@ -58,6 +65,16 @@ async def get_id(request: Request, shuffle: Optional[bool] = False):
     return unique_id
 
 
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus metrics of the pipeline stages and the jobs, aggregated over all worker processes.
+
+    :return: metrics in the Prometheus text format
+    """
+    return PlainTextResponse(await run_in_threadpool(render_metrics), media_type='text/plain; version=0.0.4')
+
+
 # WebSocket route for notifications
 @app.websocket("/ws/notifications/{unique_id}")
 async def websocket_endpoint(websocket: WebSocket, unique_id: Optional[str] = None):
@@ -74,22 +91,28 @@ async def websocket_endpoint(websocket: WebSocket, unique_id: Optional[str] = No
     await websocket.accept()
     last_notification = None
     await websocket.send_text('Listening for notifications...')
+    if unique_id is None:
+        # If the unique_id is not provided, close the connection
+        await websocket.send_text('Invalid unique_id.')
+        await websocket.close()
+        return
+
+    subscription = bus.subscribe(unique_id)
     try:
-        while True:  # continuously check for new notifications
-            if unique_id is None:
-                # If the unique_id is not provided, close the connection
-                await websocket.send_text('Invalid unique_id.')
-                await websocket.close()
-                break
-            notification = receive_notification(unique_id)
+        while True:  # notifications are pushed as they are published
+            notification = await subscription.get(timeout=NOTIFICATION_POLL_INTERVAL)
+            if notification is None and bus.last(unique_id) is None:
+                # the job does not run in this worker process (or has not started yet), check the job registry
+                notification = await run_in_threadpool(receive_notification, unique_id)
             if notification != last_notification and notification is not None:  # only send notification if it is new
                 await websocket.send_text(notification)  # send the notification
                 last_notification = notification
-            await asyncio.sleep(.1)  # Add a delay to control the update frequency
     except WebSocketDisconnect:
-        remove_notification_file(unique_id)
+        await run_in_threadpool(cancel_job, unique_id)
     except ConnectionClosedOK:
-        remove_notification_file(unique_id)
+        await run_in_threadpool(cancel_job, unique_id)
+    finally:
+        bus.unsubscribe(subscription)
 
 
 def paraphrase(
@@ -105,37 +128,29 @@ def paraphrase(
         comment_adding: bool = Query(True),
         dummy_file_adding: bool = Query(True),
         dummy_file_number: int = 10,
-        renaming_images: bool = Query(True)
+        renaming_images: bool = Query(True),
+        workers: Optional[int] = None,
+        in_memory: bool = Query(True),
+        compression: Optional[str] = None,
+        seed: Optional[int] = None,
+        seed_supplied: bool = False
 ):
     root_dir = f'projects/{project_id}'
     folder = f'{root_dir}/{filename[:-4]}/'
 
     try:
+        # the scheduler marked the job as running when it claimed a slot, unless it was cancelled since
         assert_notify(project_id, 'Extracting project...')
 
-        # extract the zip file
-        unzip_archive(f'{root_dir}/{filename}', folder)
-
-        # remove the zip file
-        os.remove(f'{root_dir}/{filename}')
-
-        # recursively extract all zip files
-        for root, dirs, files in os.walk(folder):
-            if root == '__MACOSX':
-                continue
-            for file in files:
-                if file.endswith('.zip') and not file.startswith('._'):
-                    shutil.unpack_archive(f'{root}/{file}', root)
-                    os.remove(f'{root}/{file}')
+        # extract the zip file together with nested archives, skipping macOS metadata and .git folders,
+        # the zip file is kept to copy the files the pipeline does not change into the result
+        manifest = {}
+        with measure_stage(project_id, 'extraction') as record:
+            record['files'] = extract_archive(f'{root_dir}/{filename}', folder, manifest=manifest)
+            record['bytes'] = os.path.getsize(f'{root_dir}/{filename}')
 
         assert_notify(project_id, 'Project extracted...')
-
-        # remove .git folder
-        for root, dirs, files in os.walk(folder):
-            if '__MACOSX' in root:
-                continue
-            if '.git' in dirs:
-                shutil.rmtree(f'{root}/.git')
+        jobs.update(project_id, progress=0.1)
 
         assert_notify(project_id, 'Starting paraphrasing...')
 
@@ -151,39 +166,69 @@ def paraphrase(
             comment_adding=comment_adding,
             dummy_file_adding=dummy_file_adding,
             dummy_files_number=dummy_file_number,
-            renaming_images=renaming_images
+            renaming_images=renaming_images,
+            workers=resolve_workers(workers),
+            seed=seed,
+            # outputs that do not depend on the seed are shared by all uploads, the ones that do are only kept
+            # when the client chose the seed, since only a client that sends it again can reuse them
+            cache=TransformCache(TRANSFORM_CACHE_DIR, TRANSFORM_CACHE_SIZE, TRANSFORM_CACHE_EVICTION_INTERVAL,
+                                 store_seeded=seed_supplied) if TRANSFORM_CACHE_SIZE > 0 else None,
+            in_memory=in_memory
         )
         assert_notify(project_id, 'Paraphrasing completed...')
+        jobs.update(project_id, progress=0.9)
 
         assert_notify(project_id, 'Archiving the project...')
-        shutil.make_archive(f'{root_dir}/{filename[:-4]}', 'zip', folder)
+        with measure_stage(project_id, 'archiving') as record:
+            copied, compressed = write_archive(folder, f'{root_dir}/{filename[:-4]}.zip', f'{root_dir}/{filename}',
+                                               manifest, compression=compression or ARCHIVE_COMPRESSION)
+            record['files'] = copied + compressed
+            record['bytes'] = os.path.getsize(f'{root_dir}/{filename[:-4]}.zip')
         assert_notify(project_id, 'Finished archiving the project...')
-        with open(f'{root_dir}/info.txt', 'r') as f:
-            info = f.readlines()
-        info = [line for line in info if 'Ready' not in line]
-        info.append('Ready: True')
-        with open(f'{root_dir}/info.txt', 'w') as f:
-            f.writelines(info)
-        time.sleep(10)
-        assert_notify(project_id, 'Project is ready to download')
-    except AssertionError:
-        remove_notification_file(project_id)
-        time.sleep(10)
-        shutil.rmtree(root_dir)
+        # the job is ready before the client is told so, the download may start right after the message
+        if not jobs.transition(project_id, READY, (RUNNING,), progress=1.0, finished_at=time.time()):
+            raise JobCancelled('Connection interrupted.')
+        notify(project_id, 'Project is ready to download')
+    except JobCancelled:
+        pass  # the job was cancelled, run_job removes the project
     except Exception as e:
+        jobs.transition(project_id, FAILED, finished_at=time.time())
         notify(project_id, f'Error: {e}')
-        remove_notification_file(project_id)
-        time.sleep(10)
-        shutil.rmtree(root_dir)
+    finally:
+        finish_job(project_id)
+
+
+def run_job(project_id: str, *args):
+    """
+    Runs paraphrase in a separate process and cleans up after jobs that did not finish,
+    including the ones whose process crashed or was killed for exceeding its limits.
+
+    :param project_id: str, id of the project
+    :param args: args to pass to paraphrase after the project id
+    """
+    reason = run_isolated(project_id, paraphrase, (project_id, *args))
+    if reason is not None and jobs.transition(project_id, FAILED, finished_at=time.time()):
+        notify(project_id, f'Error: {reason}.')
+    if jobs.status(project_id) != READY:
+        # the project is removed in the background, so that the job frees its slot in the queue right away
+        threading.Timer(DOWNLOAD_CLEANUP_DELAY, remove_project, (project_id, f'projects/{project_id}')).start()
+
+
+def _queue_full_response(error: QueueFull) -> JSONResponse:
+    return JSONResponse({'message': str(error)}, 429, headers={'Retry-After': str(error.retry_after)})
+
+
+# the body is parsed by StreamingUpload, the form is only declared for the API docs
+_UPLOAD_FORM = {'requestBody': {'required': True, 'content': {'multipart/form-data': {'schema': {
+    'type': 'object', 'required': ['zip_file'],
+    'properties': {'zip_file': {'type': 'string', 'format': 'binary'}}}}}}}
 
 
-@app.post("/api/v1/upload")
+@app.post("/api/v1/upload", openapi_extra=_UPLOAD_FORM)
 async def upload(
         request: Request,
-        background_tasks: BackgroundTasks,
         project_id: str = Query(None),
         user_id: str = Query(None),
-        zip_file: UploadFile = File(...),
         condition_transformation: bool = Query(True),
         loop_transformation: bool = Query(True),
         type_renaming: bool = Query(True),
@@ -194,58 +239,92 @@ async def upload(
         comment_adding: bool = Query(True),
         dummy_file_adding: bool = Query(True),
         dummy_files_number: int = 10,
-        renaming_images: bool = Query(True)
+        renaming_images: bool = Query(True),
+        workers: Optional[int] = Query(None),
+        in_memory: bool = Query(True),
+        compression: Optional[str] = Query(None),
+        seed: Optional[int] = Query(None, ge=0, lt=2 ** 63)  # stored as a SQLite INTEGER
 ):
+    if compression is not None and compression not in COMPRESSION_LEVELS:
+        return JSONResponse({'message': f'Invalid compression. Use one of: {", ".join(COMPRESSION_LEVELS)}.'}, 400)
+
     if not project_id:
         project_id = await get_id(request)
     if not user_id:
         user_id = await get_id(request, shuffle=True)
 
-    # check if id is not in use (if there is no notification file or project folder)
-    if receive_notification(project_id) is not None or os.path.exists(f'projects/{project_id}'):
+    # reject uploads that are declared too large or could not be queued anyway before receiving the body,
+    # the form around the file only adds a few hundred bytes
+    try:
+        content_length = int(request.headers.get('content-length') or 0)
+    except ValueError:
+        return JSONResponse({'message': 'Invalid Content-Length header.'}, 400)
+    if content_length > MAX_UPLOAD_SIZE:
+        return JSONResponse({'message': str(UploadTooLarge(MAX_UPLOAD_SIZE))}, 413)
+    if await run_in_threadpool(scheduler.is_full):
+        return _queue_full_response(QueueFull(await run_in_threadpool(scheduler.estimate_wait)))
+
+    # the body is received as it is saved, the size limit applies to the bytes received so far,
+    # the file name is checked to be a .zip archive
+    try:
+        zip_file = StreamingUpload(request)
+        filename = await zip_file.read_filename()
+    except (InvalidUpload, UploadTooLarge) as e:
+        return JSONResponse({'message': str(e)}, 413 if isinstance(e, UploadTooLarge) else 400)
+
+    # every job is seeded, the seed is returned so that the same upload can be paraphrased the same way again
+    seed_supplied = seed is not None
+    if not seed_supplied:
+        seed = random.getrandbits(32)
+
+    # registering the job is atomic, so concurrent uploads with the same id cannot both get it
+    if os.path.exists(f'projects/{project_id}') or not await run_in_threadpool(jobs.create, project_id, user_id,
+                                                                                filename, seed):
         return JSONResponse({'message': 'Project ID already in use. Please try again.'}, 400)
 
-    notify(project_id, f'Received project: {zip_file.filename}...')
-
-    # check if zip file is provided
-    if not zip_file.filename.endswith('.zip'):
-        return JSONResponse({'message': 'Invalid file type. Please upload a zip file.'}, 400)
-
-    filename = zip_file.filename
-    content = zip_file.file.read()
+    # the job registry is SQLite, its calls block and run off the event loop
+    await run_in_threadpool(notify, project_id, f'Received project: {filename}...')
 
     root_dir = f'projects/{project_id}'
     folder = f'{root_dir}/{filename[:-4]}/'
 
     try:
-        assert_notify(project_id, 'Saving project...')
+        await run_in_threadpool(assert_notify, project_id, 'Saving project...')
         os.makedirs(folder, exist_ok=True)
 
-        # save the zip file
-        with open(f'{root_dir}/{filename}', 'wb') as f:
-            f.write(content)
-
-        with open(f'{root_dir}/info.txt', 'w') as f:
-            lines = [
-                f'Project ID: {project_id}\n',
-                f'User ID: {user_id}\n',
-                f'Filename: {filename}\n',
-                'Ready: False'
-            ]
-            f.writelines(lines)
-
-        assert_notify(project_id, 'Project saved...')
-
-        background_tasks.add_task(paraphrase, project_id, filename,
-                                  condition_transformation, loop_transformation,
-                                  type_renaming, types_to_rename, file_renaming,
-                                  function_transformation, variable_renaming,
-                                  comment_adding, dummy_file_adding,
-                                  dummy_files_number, renaming_images)
+        # stream the zip file to disk as it is received
+        try:
+            size, content_hash = await zip_file.save(f'{root_dir}/{filename}')
+        except UploadTooLarge as e:
+            await run_in_threadpool(remove_project, project_id, root_dir)
+            return JSONResponse({'message': str(e)}, 413)
+        except (InvalidUpload, ClientDisconnect) as e:
+            await run_in_threadpool(remove_project, project_id, root_dir)
+            return JSONResponse({'message': str(e) or 'The upload was interrupted.'}, 400)
+
+        await run_in_threadpool(jobs.update, project_id, size=size, content_hash=content_hash)
+
+        await run_in_threadpool(assert_notify, project_id, 'Project saved...')
+
+        try:
+            # small projects are served first, waiting clients are notified of their position in the queue
+            queue_position = await run_in_threadpool(
+                scheduler.submit, project_id, run_job, project_id, filename,
+                condition_transformation, loop_transformation,
+                type_renaming, types_to_rename, file_renaming,
+                function_transformation, variable_renaming,
+                comment_adding, dummy_file_adding,
+                dummy_files_number, renaming_images, workers, in_memory, compression, seed,
+                seed_supplied, size=size)
+        except QueueFull as e:
+            await run_in_threadpool(remove_project, project_id, root_dir)
+            return _queue_full_response(e)
 
         return JSONResponse({'message': 'File uploaded successfully',
                              'project_id': project_id,
                              'user_id': user_id,
+                             'queue_position': queue_position,
+                             'seed': seed,
                              }, 200)
 
     except Exception as e:
@@ -256,58 +335,38 @@ async def upload(
 
 
 @app.get("/api/v1/download")
-async def download(project_id: str = Query(...), user_id: str = Query(...)):
+async def download(request: Request, project_id: str = Query(...), user_id: str = Query(...)):
     if not project_id or not user_id:
         return JSONResponse({'message': 'Please, provide project_id and user_id'}, 403)
 
     root_dir = f'projects/{project_id}'
 
-    if not os.path.exists(root_dir):
-        return JSONResponse({'message': 'Invalid project_id or user_id'}, 403)
-
     try:
-        with open(f'{root_dir}/info.txt', 'r') as f:
-            info = f.readlines()
+        job = await run_in_threadpool(jobs.get, project_id)
 
-        info = {line.split(': ')[0]: line.split(': ')[1].strip() for line in info}
-
-        if info['User ID'] != user_id:
+        if job is None or job['user_id'] != user_id:
             return JSONResponse({'message': 'Invalid project_id or user_id'}, 403)
-        if info['Ready'] != 'True':
+        if job['status'] != READY:
             return JSONResponse({'message': 'The project is not ready yet'}, 400)
 
-        filename = info['Filename']
+        filename = job['filename']
     except Exception as e:
         return JSONResponse({'message': 'Failed to download the file', 'details': e}, 500)
 
     try:
-        with open(f'{root_dir}/{filename}', "rb") as f:
-            result = io.BytesIO(f.read())
-
         print(project_id, 'Sending paraphrased project...')
-        return StreamingResponse(result, media_type="application/zip", status_code=200,
-                                 headers={"Content-Disposition": f"attachment; filename=paraphrased_{filename}"})
+        # the project is removed once the client got the last byte, interrupted downloads can be resumed until then
+        # or until the result expires, see RESULT_TTL
+        return RangeFileResponse(f'{root_dir}/{filename}', range_header=request.headers.get('range'),
+                                 if_range=request.headers.get('if-range'),
+                                 on_complete=lambda: schedule_cleanup(project_id, root_dir),
+                                 media_type="application/zip", filename=f'paraphrased_{filename}')
     except Exception as e:
+        schedule_cleanup(project_id, root_dir)
         return JSONResponse({'message': 'Failed to download the file', 'details': e}, 500)
-    finally:
-        remove_notification_file(project_id)
-        time.sleep(10)
-        shutil.rmtree(root_dir)
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    system = platform.system()
-    if system == "Linux":
-        distribution = platform.linux_distribution()
-        if distribution[0] == "Ubuntu":
-            subprocess.run(["sudo", "apt-get", "install", "unzip"])
-        elif distribution[0] == "Fedora":
-            subprocess.run(["sudo", "dnf", "install", "unzip"])
-        elif distribution[0] == "CentOS":
-            subprocess.run(["sudo", "yum", "install", "unzip"])
-        else:
-            print("Unsupported Linux distribution.")
-
     uvicorn.run("api.main:app", host="127.0.0.1", port=8000, workers=multiprocessing.cpu_count(), ws="websockets")
@@ -0,0 +1,78 @@
+import json
+import time
+from contextlib import contextmanager
+
+from .jobs import jobs, STAGE_COUNTERS
+
+_job_stages = {}  # project_id -> list of the stage records of the job, in the order the stages ran
+
+# (column of stage_totals, name, type, help) of the Prometheus metrics of the stage totals
+_STAGE_METRICS = (
+    ('runs', 'paraphraser_stage_runs_total', 'counter', 'Number of completed runs of a pipeline stage.'),
+    ('wall_time', 'paraphraser_stage_wall_seconds_total', 'counter', 'Wall time spent in a pipeline stage.'),
+    ('cpu_time', 'paraphraser_stage_cpu_seconds_total', 'counter',
+     'CPU time spent in a pipeline stage, including its worker processes.'),
+    ('files', 'paraphraser_stage_files_total', 'counter', 'Files processed by a pipeline stage.'),
+    ('bytes', 'paraphraser_stage_bytes_total', 'counter', 'Bytes processed by a pipeline stage.'),
+    ('skipped', 'paraphraser_stage_skipped_files_total', 'counter', 'Files a pipeline stage failed to process.'),
+    ('cache_hits', 'paraphraser_stage_cache_hits_total', 'counter',
+     'Files whose output a pipeline stage took from the transform cache.'),
+    ('cache_misses', 'paraphraser_stage_cache_misses_total', 'counter',
+     'Files a pipeline stage looked up in the transform cache and had to transform.'),
+)
+
+
+@contextmanager
+def measure_stage(project_id: str, stage: str):
+    """
+    Measures the wall and CPU time of a stage of a job. The block fills the returned record with the numbers of
+    processed files, bytes, skipped files and cache hits and misses (see apply_to_project). When the block completes,
+    the record is added to the summary of the job in the registry and to the totals of the stage.
+
+    :param project_id: str, id of the job
+    :param stage: str, name of the stage
+    :return: dict, record of the stage
+    """
+    record = {'stage': stage, 'files': 0, 'bytes': 0, 'skipped': 0}
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    yield record
+    record['wall_time'] = time.perf_counter() - wall_start
+    record['cpu_time'] = time.process_time() - cpu_start + record.pop('worker_cpu_time', 0)
+
+    stages = _job_stages.setdefault(project_id, [])
+    stages.append(record)
+    jobs.update(project_id, metrics=json.dumps(stages))
+    jobs.record_stage(stage, **{counter: record[counter] for counter in STAGE_COUNTERS if counter in record})
+
+
+def finish_job(project_id: str) -> list:
+    """
+    Forgets the stage records of a job once it is over, they stay in the registry.
+
+    :param project_id: str, id of the job
+    :return: list of the stage records of the job
+    """
+    return _job_stages.pop(project_id, [])
+
+
+def render_metrics() -> str:
+    """
+    Renders the stage totals and the number of jobs by status in the Prometheus text format.
+    The totals are shared by all processes through the job registry.
+
+    :return: str, metrics page
+    """
+    lines = []
+    totals = jobs.stage_totals()
+    for column, name, metric_type, description in _STAGE_METRICS:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for row in totals:
+            lines.append(f'{name}{{stage="{row["stage"]}"}} {row[column]}')
+
+    lines.append('# HELP paraphraser_jobs Jobs in the registry.')
+    lines.append('# TYPE paraphraser_jobs gauge')
+    for status, count in sorted(jobs.count_by_status().items()):
+        lines.append(f'paraphraser_jobs{{status="{status}"}} {count}')
+    return '\n'.join(lines) + '\n'
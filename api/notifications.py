@@ -1,29 +1,178 @@
-import os
+import asyncio
+import threading
+from collections import deque
+
+from .jobs import jobs, ACTIVE_STATUSES, CANCELLED
+from .settings import NOTIFICATION_BUFFER_SIZE
+
+
+class Subscription:
+    """
+    Queue of the notifications of one job for one client. Messages can be put from any thread and are read on the
+    event loop that created the subscription. The buffer is bounded: a repeated message is coalesced with the
+    previous one, and when a slow client falls behind, the oldest messages are dropped.
+    """
+
+    def __init__(self, project_id: str, buffer_size: int = NOTIFICATION_BUFFER_SIZE):
+        self.project_id = project_id
+        self._loop = asyncio.get_running_loop()
+        self._messages = deque(maxlen=buffer_size)
+        self._event = asyncio.Event()
+        self.dropped = 0  # number of messages dropped because the buffer was full
+
+    def put(self, message: str):
+        """
+        Adds a message, thread-safe.
+        """
+        self._loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message: str):
+        if self._messages and self._messages[-1] == message:
+            return
+        if len(self._messages) == self._messages.maxlen:
+            self.dropped += 1
+        self._messages.append(message)
+        self._event.set()
+
+    async def get(self, timeout: float = None):
+        """
+        Waits for the next message.
+
+        :param timeout: float, seconds to wait, None to wait until a message arrives
+        :return: str, the message, or None if the timeout expired
+        """
+        if not self._messages:
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self._messages.popleft()
+
+
+class NotificationBus:
+    """
+    In-process publish/subscribe of job notifications. Publishing is thread-safe, so jobs running in the thread pool
+    push their progress straight to the websockets of the same worker process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = {}  # project_id -> last published message
+        self._subscriptions = {}  # project_id -> set of Subscription
+
+    def publish(self, project_id: str, message: str):
+        """
+        Sends a message to the subscribers of a job.
+
+        :param project_id: str, id of the job
+        :param message: str, message to send
+        """
+        with self._lock:
+            self._last[project_id] = message
+            subscriptions = list(self._subscriptions.get(project_id, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def subscribe(self, project_id: str) -> Subscription:
+        """
+        Subscribes to the notifications of a job, the last published message is delivered first.
+        Must be called from the event loop the messages are read on.
+
+        :param project_id: str, id of the job
+        :return: Subscription
+        """
+        subscription = Subscription(project_id)
+        with self._lock:
+            self._subscriptions.setdefault(project_id, set()).add(subscription)
+            last = self._last.get(project_id)
+        if last is not None:
+            subscription.put(last)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Removes a subscription.
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.project_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.project_id]
+
+    def last(self, project_id: str):
+        """
+        Returns the last message published for a job in this process, None if there is none.
+        """
+        with self._lock:
+            return self._last.get(project_id)
+
+    def close(self, project_id: str):
+        """
+        Forgets the last message of a job. Subscribers are kept, the job id may be reused.
+        """
+        with self._lock:
+            self._last.pop(project_id, None)
+
+
+bus = NotificationBus()
+
+
+class JobCancelled(AssertionError):
+    """
+    Raised when a job is no longer active, e.g. its client disconnected. It is an AssertionError, as assert_notify
+    used to raise, but it is raised explicitly, so it is not stripped by python -O.
+    """
+
+
+_channel = None  # connection to the server process when running in a job process
+
+
+def set_channel(connection):
+    """
+    Forwards the notifications of this process to the server process, see workers.run_isolated.
+
+    :param connection: multiprocessing connection to send (project_id, message) tuples to
+    """
+    global _channel
+    _channel = connection
 
 
 def notify(project_id, message):
-    os.makedirs('notifications/', exist_ok=True)
-    with open(f'notifications/{project_id}.txt', 'w') as file:
-        file.write(message)
+    bus.publish(project_id, message)
+    if _channel is not None:
+        _channel.send((project_id, message))
+    # the job registry mirrors the bus for the websockets and jobs of other worker processes
+    jobs.update(project_id, message=message)
     print(message)
 
 
 def receive_notification(project_id):
-    try:
-        with open(f'notifications/{project_id}.txt', 'r') as file:
-            message = file.read()
+    message = bus.last(project_id)
+    if message is not None:
         return message
-    except FileNotFoundError:
-        return None
+    return jobs.message(project_id)
+
+
+def cancel_job(project_id):
+    """
+    Cancels a job whose client disconnected, the job stops at its next assert_notify.
+    Jobs that are already finished are left for the download.
+    """
+    jobs.transition(project_id, CANCELLED)
 
 
-def remove_notification_file(project_id):
-    try:
-        os.remove(f'notifications/{project_id}.txt')
-    except FileNotFoundError:
-        pass
+def close_job(project_id):
+    """
+    Forgets a job once its files are removed, the project id may be reused afterwards.
+    """
+    bus.close(project_id)
+    jobs.delete(project_id)
 
 
 def assert_notify(project_id, message):
-    assert receive_notification(project_id) is not None, 'Connection interrupted.'
+    # the job is cancelled when the client disconnects, possibly in another worker process
+    if jobs.status(project_id) not in ACTIVE_STATUSES:
+        raise JobCancelled('Connection interrupted.')
     notify(project_id, message)
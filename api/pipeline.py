@@ -1,29 +1,57 @@
+import os
+
 from api import *
+from api.metrics import measure_stage
+from api.scripts.rng import random_stream
+
 
+def apply_stage(unique_id: str, project, func: callable, record: dict = None, **kwargs):
+    """
+    Applies a per-file stage to the project and reports the files that failed to process.
 
-def preprocess(unique_id: str, path: str):
+    :param unique_id: str, unique id of the project
+    :param project: dict, in-memory project, or str, path to the project on disk
+    :param func: function to apply to every file
+    :param record: dict, stage record of measure_stage to add the numbers of processed files to
+    :param kwargs: kwargs to pass to apply_to_project or apply_to_files
+    """
+    if isinstance(project, dict):
+        failures = apply_to_project(project, func, stats=record, **kwargs)
+    else:
+        failures = apply_to_files(project, func, stats=record, **kwargs)
+    if failures:
+        notify(unique_id, f'Skipped {len(failures)} file(s) that failed in {func.__name__}.')
+
+
+def preprocess(unique_id: str, project, **kwargs):
     """
     Preprocess the project. Remove comments and empty lines, change 'class func' to 'static func'.
 
     :param unique_id: str, unique id of the project
-    :param path: path to the project to paraphrase
-    :return: dict, preprocessed project
+    :param project: dict, in-memory project, or str, path to the project on disk
+    :param kwargs: kwargs to pass to apply_stage (workers, executor, seed, root)
     """
 
     assert_notify(unique_id, 'Preprocessing...')
 
-    assert_notify(unique_id, 'Removing comments...')
-    apply_to_files(path, remove_comments)
+    with measure_stage(unique_id, 'preprocess') as record:
+        assert_notify(unique_id, 'Removing comments...')
+        apply_stage(unique_id, project, remove_comments, record, **kwargs)
 
-    assert_notify(unique_id, 'Removing empty lines...')
-    apply_to_files(path, remove_empty_lines)
+        assert_notify(unique_id, 'Removing empty lines...')
+        second_pass = {}
+        apply_stage(unique_id, project, remove_empty_lines, second_pass, **kwargs)
+        # both passes go over the same files, only the failures and the CPU time of the second one add up
+        record['skipped'] += second_pass['skipped']
+        record['worker_cpu_time'] = record.get('worker_cpu_time', 0) + second_pass.get('worker_cpu_time', 0)
 
 
 def pipeline(unique_id: str, path: str,
              condition_transformation=True, loop_transformation=True,
              type_renaming=True, types_to_rename=('struct', 'enum', 'protocol'),
              file_renaming=False, function_transformation=True, variable_renaming=True,
-             comment_adding=True, dummy_file_adding=True, dummy_files_number=10, renaming_images=True):
+             comment_adding=True, dummy_file_adding=True, dummy_files_number=10, renaming_images=True,
+             workers=1, seed=None, cache=None, in_memory=True):
     """
     Project paraphrasing pipeline.
 
@@ -40,86 +68,173 @@ def pipeline(unique_id: str, path: str,
     :param dummy_file_adding: bool, whether to add dummy files, stable, recommended being True
     :param dummy_files_number: int, number of dummy files to be added
     :param renaming_images: bool, whether to rename images, stable, recommended being True
+    :param workers: int, number of worker processes for the per-file stages, 1 to run them serially
+    :param seed: seed of the job, every stage and file draws from a random stream derived from it, so the same seed
+        gives the same output for any number of workers, None for random output
+    :param cache: TransformCache to reuse the outputs of the per-file stages from, None to transform every file,
+        only seeded runs use it
+    :param in_memory: bool, whether to load the project once and write it back at the end instead of
+        re-reading and re-writing the files in every stage, recommended being True
     """
-    preprocess(unique_id, path)
+    executor = create_executor(workers) if workers > 1 else None
+    try:
+        _pipeline(unique_id, path, condition_transformation, loop_transformation,
+                  type_renaming, types_to_rename, file_renaming, function_transformation, variable_renaming,
+                  comment_adding, dummy_file_adding, dummy_files_number, renaming_images, in_memory, cache,
+                  workers=workers, executor=executor, seed=seed, root=path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def _pipeline(unique_id, path, condition_transformation, loop_transformation,
+              type_renaming, types_to_rename, file_renaming, function_transformation, variable_renaming,
+              comment_adding, dummy_file_adding, dummy_files_number, renaming_images, in_memory, cache, **options):
+    if in_memory:
+        assert_notify(unique_id, 'Loading the project...')
+        with measure_stage(unique_id, 'loading') as record:
+            project = load_project(path)
+            loaded = dict(project)
+            _count_sources(record, project)
+    else:
+        project = path
+
+    preprocess(unique_id, project, **options)
     notify(unique_id, 'Finished preprocessing the project...')
 
     if variable_renaming:
         assert_notify(unique_id, 'Renaming variables...')
-        apply_to_files(path, rename_variables)
+        with measure_stage(unique_id, 'variables') as record:
+            apply_stage(unique_id, project, rename_variables, record, cache=cache, **options)
         notify(unique_id, 'Finished renaming variables.')
 
     if function_transformation:
         assert_notify(unique_id, 'Restructuring functions...')
-        apply_to_files(path, restructure_functions)
+        with measure_stage(unique_id, 'functions') as record:
+            apply_stage(unique_id, project, restructure_functions, record, cache=cache, **options)
         notify(unique_id, 'Finished restructuring functions.')
 
     if condition_transformation:
         assert_notify(unique_id, 'Transforming conditions...')
-        apply_to_files(path, transform_conditions, comment_adding=comment_adding)
+        with measure_stage(unique_id, 'conditions') as record:
+            apply_stage(unique_id, project, transform_conditions, record, comment_adding=comment_adding, cache=cache,
+                        **options)
         notify(unique_id, 'Finished transforming conditions.')
 
     if loop_transformation:
         assert_notify(unique_id, 'Transforming loops...')
-        apply_to_files(path, transform_loops, comment_adding=comment_adding)
+        with measure_stage(unique_id, 'loops') as record:
+            apply_stage(unique_id, project, transform_loops, record, comment_adding=comment_adding, cache=cache,
+                        **options)
         notify(unique_id, 'Finished transforming loops.')
 
     if comment_adding:
         assert_notify(unique_id, 'Adding comments...')
-        apply_to_files(path, add_comments)
+        with measure_stage(unique_id, 'comments') as record:
+            apply_stage(unique_id, project, add_comments, record, cache=cache, **options)
         notify(unique_id, 'Finished adding comments.')
 
     if renaming_images:
         assert_notify(unique_id, 'Renaming images...')
-        image_files, image_paths = search_image_files(path)
-        image_rename_map = generate_rename_map(image_files)
-        rename_images(path, image_rename_map, image_paths)
+        with measure_stage(unique_id, 'images') as record:
+            image_files, image_paths = search_image_files(path)
+            record['files'] = len(image_paths)
+            record['bytes'] = sum(os.path.getsize(image_path) for image_path in image_paths)
+            with random_stream(options['seed'], 'images'):
+                image_rename_map = generate_rename_map(sorted(image_files))
+            if in_memory:
+                rename_image_files(image_rename_map, image_paths)
+                rename_image_references(project, image_rename_map)
+            else:
+                rename_images(path, image_rename_map, image_paths)
         notify(unique_id, 'Finished renaming images.')
 
     if type_renaming or file_renaming or dummy_file_adding:
-        project = dir_to_dict(path)
-
-        type_names = parse_types_in_project(project, include_types=types_to_rename)
-        types_in_frameworks = parse_types_in_frameworks(path)
-
-        type_names = set(type_names) - set(types_in_frameworks)
-        file_names = set(list_file_names(project))
-
-        type_names = set([name for name in type_names if name == name.encode('latin1').decode('utf-8')])
-        file_names = set([name for name in file_names if name == name.encode('latin1').decode('utf-8')])
-
-        if 'Package' in file_names:
-            file_names.remove('Package')
-
-        common_names = type_names & file_names
-        type_only_names = type_names - common_names
-        file_only_names = file_names - common_names
-
-        common_rename_map = generate_rename_map(list(common_names))
-        type_rename_map = generate_rename_map(list(type_only_names))
-        file_rename_map = generate_rename_map(list(file_only_names))
-
-        type_rename_map.update(common_rename_map)
-        file_rename_map.update(common_rename_map)
+        with measure_stage(unique_id, 'indexing') as record:
+            if in_memory:
+                # type and file renaming work on the sources only, frameworks are kept as they are
+                frameworks = {file_path: content for file_path, content in project.items()
+                              if in_frameworks(file_path, ('Pods',))}
+                sources = {file_path: content for file_path, content in project.items()
+                           if file_path not in frameworks}
+            else:
+                sources = dir_to_dict(path)
+            _count_sources(record, sources)
+
+            # the index describes the sources as they are now, it is valid only until rename_types rewrites them,
+            # the later stages (rename_files, add_dummy_files) make no membership checks and do not update it
+            index = ProjectIndex(sources)
+            type_names = parse_types_in_project(sources, include_types=types_to_rename, index=index)
+            types_in_frameworks = parse_types_in_frameworks(path)
+
+            type_names = set(type_names) - set(types_in_frameworks)
+            file_names = set(list_file_names(sources))
+
+            type_names = set([name for name in type_names if name == name.encode('latin1').decode('utf-8')])
+            file_names = set([name for name in file_names if name == name.encode('latin1').decode('utf-8')])
+
+            if 'Package' in file_names:
+                file_names.remove('Package')
+
+            common_names = type_names & file_names
+            type_only_names = type_names - common_names
+            file_only_names = file_names - common_names
+
+            # the names are sorted, so a seeded run draws them in the same order whatever the hash seed
+            with random_stream(options['seed'], 'indexing'):
+                common_rename_map = generate_rename_map(sorted(common_names))
+                type_rename_map = generate_rename_map(sorted(type_only_names))
+                file_rename_map = generate_rename_map(sorted(file_only_names))
+
+            type_rename_map.update(common_rename_map)
+            file_rename_map.update(common_rename_map)
 
         if type_renaming and type_names:
             assert_notify(unique_id, 'Renaming types...')
-            project = rename_types(project, type_rename_map)
+            with measure_stage(unique_id, 'types') as record:
+                _count_sources(record, sources)
+                sources = rename_types(sources, type_rename_map, index=index)
             notify(unique_id, 'Finished renaming types.')
 
         if file_renaming and file_names:
             assert_notify(unique_id, 'Renaming files...')
-            project = rename_files(project, file_rename_map)
+            with measure_stage(unique_id, 'files') as record:
+                _count_sources(record, sources)
+                sources = rename_files(sources, file_rename_map)
             notify(unique_id, 'Finished renaming files.')
 
         if dummy_file_adding:
             assert_notify(unique_id, 'Adding dummy files...')
-            project = add_dummy_files(project, dummy_files_number, path)
+            with measure_stage(unique_id, 'dummy_files') as record:
+                original_paths = set(sources)
+                with random_stream(options['seed'], 'dummy_files'):
+                    sources = add_dummy_files(sources, dummy_files_number, path)
+                # the stage processes the files it adds
+                _count_sources(record, {file_path: content for file_path, content in sources.items()
+                                        if file_path not in original_paths})
             notify(unique_id, 'Finished adding dummy files.')
 
         notify(unique_id, 'Finished paraphrasing the project.')
         assert_notify(unique_id, 'Saving paraphrased project...')
-        dict_to_dir(project)
+        with measure_stage(unique_id, 'saving') as record:
+            if in_memory:
+                _count_sources(record, {**frameworks, **sources})
+                save_project({**frameworks, **sources}, loaded)
+            else:
+                _count_sources(record, sources)
+                dict_to_dir(sources)
+
+    elif in_memory:
+        notify(unique_id, 'Finished paraphrasing the project.')
+        assert_notify(unique_id, 'Saving paraphrased project...')
+        with measure_stage(unique_id, 'saving') as record:
+            _count_sources(record, project)
+            save_project(project, loaded)
 
     else:
         notify(unique_id, 'Finished paraphrasing the project. The project is already saved.')
+
+
+def _count_sources(record: dict, sources: dict):
+    record['files'] += len(sources)
+    record['bytes'] += sum(len(content.encode('utf-8')) for content in sources.values())
@@ -0,0 +1,193 @@
+import importlib
+import json
+import math
+import os
+import threading
+import time
+
+from .downloads import remove_project
+from .jobs import jobs, QUEUED, RUNNING, FAILED, CANCELLED
+from .notifications import notify
+from .settings import MAX_CONCURRENT_JOBS, MAX_QUEUED_JOBS, QUEUE_POLICY, QUEUE_AGING_INTERVAL, \
+    QUEUE_RETRY_AFTER, QUEUE_POLL_INTERVAL, DOWNLOAD_CLEANUP_DELAY
+
+QUEUE_POLICIES = ('smallest', 'fifo')
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted to a full queue.
+
+    :param retry_after: int, seconds after which the client may try again
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f'The server is busy. Please try again in {retry_after} seconds.')
+        self.retry_after = retry_after
+
+
+class JobScheduler:
+    """
+    Runs the jobs of the whole server, at most concurrency at once, further jobs wait in a bounded queue.
+
+    The queue is the job registry, which every worker process of the server shares: a submitted job is stored as
+    queued together with the function and args to run, and a thread of any worker process starts it once fewer than
+    concurrency jobs are running. Queueing and starting are conditional updates of the registry, so the limits hold
+    however many worker processes there are. Each process runs concurrency threads, started with its first job,
+    which wait for their own submissions and poll the registry for slots freed by the other processes.
+
+    With the 'smallest' policy small uploads run first, the priority of a waiting job doubles every aging_interval
+    seconds, so a large upload is overtaken by a bounded number of small ones. Every waiting job is notified of its
+    position whenever the queue changes.
+    """
+
+    def __init__(self, concurrency: int = MAX_CONCURRENT_JOBS, max_queued: int = MAX_QUEUED_JOBS,
+                 policy: str = QUEUE_POLICY, aging_interval: float = QUEUE_AGING_INTERVAL,
+                 retry_after: int = QUEUE_RETRY_AFTER, poll_interval: float = QUEUE_POLL_INTERVAL):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'Unknown queue policy: {policy}. Use one of: {", ".join(QUEUE_POLICIES)}.')
+        self.concurrency = max(1, concurrency)
+        self.max_queued = max_queued
+        self.policy = policy
+        self.aging_interval = aging_interval
+        self.retry_after = retry_after
+        self.poll_interval = poll_interval
+
+        self._condition = threading.Condition()
+        self._threads = []
+        self._average_duration = None  # moving average of the run time of the jobs of this process, seconds
+
+    def submit(self, project_id: str, func: callable, *args, size: int = 0) -> int:
+        """
+        Queues a received job. Its size must already be in the registry.
+
+        :param project_id: str, id of the job, waiting jobs are notified of their position under it
+        :param func: module-level function to run, any worker process may run it
+        :param args: JSON serializable args to pass to the function
+        :param size: int, size of the upload, smaller jobs run first with the 'smallest' policy
+        :return: int, position of the job in the queue, 0 if it starts right away
+        :raises QueueFull: if the queue is full
+        """
+        task = json.dumps({'func': f'{func.__module__}:{func.__qualname__}', 'args': args})
+        if not jobs.enqueue(project_id, task, self.concurrency, self.max_queued):
+            raise QueueFull(self.estimate_wait())
+        with self._condition:
+            self._start_threads()
+            self._condition.notify()
+        positions = self._positions()
+        self._notify_positions(positions)
+        return positions.get(project_id, 0)
+
+    def is_full(self) -> bool:
+        """
+        Checks if a job submitted now would be rejected.
+        """
+        counts = jobs.count_by_status()
+        return counts.get(QUEUED, 0) - self._free_slots(counts) >= self.max_queued
+
+    def _free_slots(self, counts: dict) -> int:
+        return max(0, self.concurrency - counts.get(RUNNING, 0))
+
+    def estimate_wait(self) -> int:
+        """
+        Estimates the seconds until a slot in the queue frees up, for the Retry-After header.
+        """
+        average_duration = jobs.average_duration()
+        if average_duration is None:
+            average_duration = self._average_duration
+        if average_duration is None:
+            return self.retry_after
+        return max(1, math.ceil(average_duration / self.concurrency))
+
+    def _start_threads(self):
+        while len(self._threads) < self.concurrency:
+            thread = threading.Thread(target=self._work, name=f'job-{len(self._threads)}', daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _priority(self, job: dict, now: float):
+        if self.policy == 'fifo':
+            return job['queued_at'], job['project_id']
+        waited = now - job['queued_at']
+        return (job['size'] or 0) / 2 ** (waited / self.aging_interval), job['queued_at'], job['project_id']
+
+    def _next_job(self, queued: list) -> dict:
+        # the queue is bounded, so picking the job by a scan is cheap and lets the priorities age
+        now = time.time()
+        return min(queued, key=lambda job: self._priority(job, now))
+
+    def _positions(self) -> dict:
+        # 1-based positions of the jobs that have to wait, the ones that fill the free slots are about to start
+        now = time.time()
+        ordered = sorted(jobs.find_by_status(QUEUED), key=lambda job: self._priority(job, now))
+        free_slots = self._free_slots(jobs.count_by_status())
+        return {job['project_id']: position for position, job in enumerate(ordered[free_slots:], 1)}
+
+    @staticmethod
+    def _notify_positions(positions: dict):
+        for project_id, position in positions.items():
+            notify(project_id, f'Waiting in queue: position {position} of {len(positions)}...')
+
+    def _work(self):
+        while True:
+            try:
+                job = jobs.claim(self._next_job, self.concurrency)
+                if job is None:
+                    _reap()
+                    with self._condition:
+                        self._condition.wait(self.poll_interval)
+                    continue
+                self._notify_positions(self._positions())
+            except Exception as e:
+                print(f'Failed to start a job: {type(e).__name__}: {e}')
+                time.sleep(self.poll_interval)
+                continue
+
+            start = time.monotonic()
+            try:
+                func, args = _load_task(job['task'])
+                func(*args)
+            except Exception as e:
+                print(f'Job {job["project_id"]} failed: {type(e).__name__}: {e}')
+            finally:
+                duration = time.monotonic() - start
+                with self._condition:
+                    if self._average_duration is None:
+                        self._average_duration = duration
+                    else:  # exponential moving average, recent jobs weigh more
+                        self._average_duration += (duration - self._average_duration) / 5
+                    # a slot is free, a job submitted to this process meanwhile may start without waiting for a poll
+                    self._condition.notify()
+
+
+def _load_task(task: str):
+    task = json.loads(task)
+    module, name = task['func'].split(':')
+    return getattr(importlib.import_module(module), name), task['args']
+
+
+def _reap():
+    # jobs of a worker process that died, with the server or on its own, would keep their slots forever
+    for job in jobs.find_by_status(RUNNING):
+        if not _is_alive(job['worker_pid']) and jobs.transition(job['project_id'], FAILED, (RUNNING,),
+                                                                 finished_at=time.time()):
+            notify(job['project_id'], 'Error: The server stopped while the job was running.')
+    # queued jobs that were cancelled never run, nothing else removes their projects before they expire
+    for job in jobs.find_by_status(CANCELLED):
+        if job['started_at'] is None and job['updated_at'] < time.time() - DOWNLOAD_CLEANUP_DELAY:
+            remove_project(job['project_id'], f'projects/{job["project_id"]}')
+
+
+def _is_alive(pid: int) -> bool:
+    if pid is None:
+        return False  # claimed before the registry recorded the process
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # the process exists, it belongs to another user
+    return True
+
+
+scheduler = JobScheduler()
@@ -1,5 +1,8 @@
-from .file_utils import dir_to_dict, dict_to_dir, apply_to_files
+from .file_utils import dir_to_dict, dict_to_dir, load_project, save_project, in_frameworks, \
+    apply_to_files, apply_to_project, create_executor
+from .cache import TransformCache
 from .dummy_files import add_dummy_files
 from .comment_utils import add_comments
+from .project_index import ProjectIndex
 from .rename_utils import *
 from .text import *
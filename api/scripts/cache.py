@@ -0,0 +1,141 @@
+import hashlib
+import os
+import tempfile
+import time
+
+# part of every key, bump it when a per-file stage changes its output so that older entries are not used
+CACHE_VERSION = 1
+
+# file whose modification time is the time of the last eviction
+_EVICTION_MARKER = '.evicted'
+
+
+class TransformCache:
+    """
+    On-disk cache of the outputs of the per-file stages, addressed by the hash of the input content, the stage,
+    its arguments and the random stream of the file (see random_stream). Outputs that did not draw from the stream
+    are stored without it, so they are shared by every seed and path.
+    Entries are plain files, written atomically, so the worker processes of a job and concurrent jobs can share
+    the directory. A hit refreshes the modification time of the entry, evict() removes the least recently used
+    entries once the directory is larger than the size bound.
+    """
+
+    def __init__(self, directory: str, max_size: int, eviction_interval: float = 0, store_seeded: bool = True):
+        """
+        :param directory: str, directory of the cache, created on the first write
+        :param max_size: int, size of the entries in bytes above which evict() removes the least recently used ones
+        :param eviction_interval: float, seconds evict() waits after the last eviction by any process, the cache
+            may grow past max_size by what is written meanwhile
+        :param store_seeded: bool, whether to look up and store the outputs that depend on the random stream,
+            they are only reused by a run with the same seed
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.eviction_interval = eviction_interval
+        self.store_seeded = store_seeded
+
+    def key(self, content: str, func: callable, args=(), kwargs=None, stream: tuple = None) -> str:
+        """
+        Returns the key of the output of a stage.
+
+        :param content: str, input content of the file
+        :param func: function of the stage
+        :param args: args the function is called with
+        :param kwargs: kwargs the function is called with
+        :param stream: tuple of the keys of the random stream (seed, stage, relative path),
+            None for an output that does not depend on it
+        :return: str, hex digest
+        """
+        options = repr((CACHE_VERSION, func.__module__, func.__qualname__, tuple(args),
+                        sorted((kwargs or {}).items()), stream))
+        digest = hashlib.sha256(options.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(content.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, content: str, func: callable, args=(), kwargs=None, stream: tuple = None):
+        """
+        Looks up the output of a stage, first the one shared by all streams, then the one of the given stream.
+
+        :return: str, cached output, None on a miss
+        """
+        keys = [self.key(content, func, args, kwargs)]
+        if stream is not None and self.store_seeded:
+            keys.append(self.key(content, func, args, kwargs, stream))
+        for key in keys:
+            path = self._path(key)
+            try:
+                with open(path, 'r', encoding='utf-8', newline='') as file:
+                    output = file.read()
+                os.utime(path)
+            except OSError:
+                continue  # a miss, or the entry was evicted meanwhile
+            return output
+        return None
+
+    def put(self, content: str, output: str, func: callable, args=(), kwargs=None, stream: tuple = None):
+        """
+        Stores the output of a stage. Failures to write are ignored, the cache is only an optimization.
+
+        :param stream: tuple of the keys of the random stream, None if the output did not draw from it
+        """
+        if stream is not None and not self.store_seeded:
+            return
+        path = self._path(self.key(content, func, args, kwargs, stream))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(descriptor, 'w', encoding='utf-8', newline='') as file:
+                    file.write(output)
+                os.replace(temporary, path)
+            except BaseException:
+                os.remove(temporary)
+                raise
+        except OSError as e:
+            print(f'Failed to write to the transform cache: {e}')
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used entries until the cache is not larger than max_size. Walking the cache takes
+        a stat of every entry, so it is skipped if any process evicted less than eviction_interval seconds ago.
+
+        :return: int, number of removed entries
+        """
+        marker = os.path.join(self.directory, _EVICTION_MARKER)
+        try:
+            if time.time() - os.stat(marker).st_mtime < self.eviction_interval:
+                return 0
+            os.utime(marker)
+        except FileNotFoundError:
+            os.makedirs(self.directory, exist_ok=True)
+            open(marker, 'w').close()
+
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.directory):
+            for file in files:
+                if file == _EVICTION_MARKER:
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+            total -= size
+        return removed
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
@@ -4,6 +4,10 @@ IMAGE_FILE_TYPES = (
     '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp', '.heic', '.svg', '.ico', 'heif', 'hif', 'avif',
 )
 
+# image formats that are compressed already, deflating them again takes time and saves nothing
+COMPRESSED_IMAGE_FILE_TYPES = tuple(file_type for file_type in IMAGE_FILE_TYPES
+                                    if file_type not in ('.bmp', '.tiff', '.svg', '.ico'))
+
 ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
 
 CYRILLIC_LETTERS = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ'
@@ -1,14 +1,13 @@
-import random
-
 from .rename_utils import generate_random_name
+from .rng import rng
 
 
 def generate_dummy_body(return_type, loop, operator):
     string = generate_random_name()
-    n1 = random.randint(1, 10000)
-    n2 = random.randint(1, 10000)
-    f1 = random.uniform(1, 10000)
-    f2 = random.uniform(1, 10000)
+    n1 = rng().randint(1, 10000)
+    n2 = rng().randint(1, 10000)
+    f1 = rng().uniform(1, 10000)
+    f2 = rng().uniform(1, 10000)
 
     if return_type == 'Int':
         if loop:
@@ -33,10 +32,10 @@ def generate_dummy_body(return_type, loop, operator):
             for i in 0...{n1} {{
                 {string} = {string} {operator} {f2}
             }}
-            return {string} {random.choice(['>', '<', '==', '!='])} {n2}
+            return {string} {rng().choice(['>', '<', '==', '!='])} {n2}
             '''
         else:
-            return f"return {n1} {random.choice(['>', '<', '==', '!='])} {n2}"
+            return f"return {n1} {rng().choice(['>', '<', '==', '!='])} {n2}"
     elif return_type == 'Double':
         if loop:
             return f'''
@@ -73,19 +72,19 @@ def generate_dummy_body(return_type, loop, operator):
 def generate_dummy_function():
     name = generate_random_name('func')
 
-    return_type = random.choice(['Int', 'String', 'Bool', 'Double', 'Float', 'Void'])
+    return_type = rng().choice(['Int', 'String', 'Bool', 'Double', 'Float', 'Void'])
 
-    condition = random.choice([True, False])
-    loop = random.choice([True, False])
-    operator = random.choice(['+', '-', '*'])
+    condition = rng().choice([True, False])
+    loop = rng().choice([True, False])
+    operator = rng().choice(['+', '-', '*'])
 
     if condition:
-        i = random.randint(1, 10000)
-        j = random.randint(1, 10000)
+        i = rng().randint(1, 10000)
+        j = rng().randint(1, 10000)
 
         res = f'''
         func {name}() -> {return_type} {{
-            if {i} {random.choice(['>', '<', '==', '!='])} {j} {{
+            if {i} {rng().choice(['>', '<', '==', '!='])} {j} {{
                 {generate_dummy_body(return_type, loop, operator)}
             }}
             else {{
@@ -115,7 +114,7 @@ def generate_conforming_class(class_name, protocol_name, function):
 
 def generate_dummy_enum():
     name = generate_random_name('enum')
-    cases = [generate_random_name('case') for _ in range(random.randint(1, 20))]
+    cases = [generate_random_name('case') for _ in range(rng().randint(1, 20))]
     cases = '\n\t'.join(cases)
     enum = f'enum {name} {{\n\t{cases}\n}}'
     return enum
@@ -1,5 +1,12 @@
 from .constants import CHANGEABLE_FILE_TYPES
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import os
+import random
+import time
+
+from .lexer import lex
+from .rng import random_stream
 
 
 def dir_to_dict(dir_path: str, file_types: tuple = CHANGEABLE_FILE_TYPES) -> dict:
@@ -49,54 +56,303 @@ def dict_to_dir(data: dict):
             file.write(content)
 
 
-def apply_to_project(project: dict, func: callable, exclude=(), *args, **kwargs):
+def load_project(dir_path: str, file_types: tuple = CHANGEABLE_FILE_TYPES) -> dict:
+    """
+    Loads a project into memory without touching the files on disk. Unlike dir_to_dict, files in frameworks are
+    included, so that every stage of the pipeline can run against the same dictionary.
+    Files that are not valid utf-8 are left on disk and skipped.
+
+    :param dir_path: path to the directory
+    :param file_types: tuple of file types to load
+    :return: dictionary where the keys are the file paths and the values are the file contents
+    """
+    project = {}
+    for root, dirs, files in os.walk(dir_path):
+        if '__MACOSX' in root:
+            continue
+        for file in files:
+            if file.endswith('.DS_Store'):
+                os.remove(os.path.join(root, file))
+                continue
+            if not file.endswith(file_types) or file.startswith('._'):
+                continue
+            path = (os.path.join(root, file)).replace('\\', '/')
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    project[path] = f.read().replace('\u2028', ' ')
+            except UnicodeDecodeError:
+                print(f'Skipping {path}: not a valid utf-8 file')
+
+    print(f'Loaded {len(project)} changeable files from {dir_path}')
+    return project
+
+
+def save_project(project: dict, loaded: dict):
+    """
+    Writes an in-memory project back to disk. Only new and changed files are written,
+    files that were loaded but are no longer in the project (e.g. renamed ones) are removed.
+
+    :param project: dictionary where the keys are the file paths and the values are the file contents
+    :param loaded: the project as it was loaded by load_project
+    """
+    for file_path in loaded.keys() - project.keys():
+        os.remove(file_path)
+    dict_to_dir({path: content for path, content in project.items() if loaded.get(path) != content})
+
+
+def in_frameworks(file_path: str, frameworks: tuple = ('Pods', 'Frameworks')) -> bool:
+    """
+    Checks if a file belongs to a framework folder.
+
+    :param file_path: path to the file
+    :param frameworks: tuple of framework folder names
+    :return: True if any folder in the path is a framework folder, False otherwise
     """
-    Applies a function to a project. The function must take a file content as the first argument.
+    return any(folder in frameworks for folder in file_path.split('/')[:-1])
+
 
-    :param project: project to apply the function to
+def is_transformable(file_path: str, exclude=()) -> bool:
+    """
+    Checks if the per-file stages should be applied to a file.
+    Only .swift files outside frameworks are transformed, macOS metadata files and files with non-utf-8 names are skipped.
+
+    :param file_path: path to the file
+    :param exclude: tuple of file names to exclude
+    :return: True if the file should be transformed, False otherwise
+    """
+    file = file_path.split('/')[-1]
+    if not file.endswith('.swift') or file.startswith('._') or file in exclude:
+        return False
+    try:
+        if file != file.encode('latin1').decode('utf-8'):
+            return False
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return False
+    return not in_frameworks(file_path)
+
+
+def apply_to_project(project: dict, func: callable, exclude=(), *args, workers=1, executor=None, seed=None, root='',
+                     cache=None, stats=None, **kwargs):
+    """
+    Applies a function to the .swift files of an in-memory project. The function must take a file content as the first
+    argument. With more than one worker the files are spread across a process pool.
+
+    :param project: project to apply the function to, it is updated in place
     :param func: function to apply
     :param exclude: tuple of file names to exclude from the function
     :param args: args to pass to the function
+    :param workers: int, number of worker processes, 1 to process the files serially
+    :param executor: ProcessPoolExecutor with `workers` processes to reuse instead of creating a new one
+    :param seed: seed of the job, every file gets a random stream of its own, see transform_content
+    :param root: path of the project folder, the streams are keyed by the file paths relative to it
+    :param cache: TransformCache to reuse the outputs of earlier runs from, see transform_content
+    :param stats: dict to add the numbers of processed files, bytes, failed files and cache hits to, see _add_stats
     :param kwargs: kwargs to pass to the function
-    :return:
+    :return: dict of files that failed to process in the format {path: error}
     """
+    paths = [path for path in project if is_transformable(path, exclude)]
+    contents = [project[path] for path in paths]
+    job = (paths, contents, repeat(func), repeat(args), repeat(kwargs), repeat(seed), repeat(root), repeat(cache))
 
-    for file_path, file_content in project.items():
-        if file_path.endswith('.swift') and file_path.split('/')[-1] not in exclude:
-            project[file_path] = func(file_content, *args, **kwargs)
+    failures = {}
+    cpu_time = 0
+    hits = []
+    for path, new_content, error, file_cpu_time, hit in _map(transform_content, job, len(paths), workers, executor):
+        cpu_time += file_cpu_time
+        hits.append(hit)
+        if error is None:
+            project[path] = new_content
+        else:
+            failures[path] = error
 
-    return project
+    if stats is not None:
+        n_bytes = sum(len(content.encode('utf-8')) for content in contents)
+        _add_stats(stats, len(paths), n_bytes, failures, cpu_time, _is_parallel(workers, len(paths)),
+                   hits if cache is not None else None)
+    _evict(cache, hits)
+    _report_failures(func, failures)
+    return failures
 
 
-def project_contains_string(project: dict, string: str) -> bool:
+def list_swift_files(dir_path: str, exclude=()) -> list:
     """
-    Checks if a project contains a string.
+    Lists the .swift files of a project that the per-file stages are applied to.
 
-    :param project: project to check
-    :param string: string to check
-    :return: True if the project contains the string, False otherwise
+    :param dir_path: path to the project
+    :param exclude: tuple of file names to exclude
+    :return: list of file paths
     """
-    for file_content in project.values():
-        if string in file_content:
-            return True
-    return False
-
-
-def apply_to_files(dir_path: str, func: callable, exclude=(), *args, **kwargs):
+    paths = []
     for root, dirs, files in os.walk(dir_path):
-        # Check if any folder in the path is in FRAMEWORKS
-        if 'Pods' in root.replace('\\', '/').split('/') or 'Frameworks' in root.replace('\\', '/').split('/'):
-            continue  # skip files in frameworks
         for file in files:
-            if not file.endswith('.swift'):
-                continue
-            if file.startswith('._') or file in exclude:
-                continue
-            if file != file.encode('latin1').decode('utf-8'):
-                continue
             path = (os.path.join(root, file)).replace('\\', '/')
-            with open(path, 'r', encoding='utf-8') as f:
-                content = f.read().replace('\u2028', ' ')
-                new_content = func(content, *args, **kwargs)
+            if is_transformable(path, exclude):
+                paths.append(path)
+    return paths
+
+
+def transform_content(path: str, content: str, func: callable, args=(), kwargs=None, seed=None, root='', cache=None):
+    """
+    Applies a function to the content of a file.
+    Errors are returned instead of raised, so that one broken file does not stop the whole stage.
+
+    :param path: path to the file
+    :param content: content of the file
+    :param func: function to apply, must take a file content as the first argument
+    :param args: args to pass to the function
+    :param kwargs: kwargs to pass to the function
+    :param seed: seed of the job, the function draws from a random stream keyed by the seed, the function name and
+        the relative path, so the file gets the same output whichever worker runs it and in whichever order
+    :param root: path of the project folder, the path is made relative to it, so the stream does not depend on
+        where the project is extracted
+    :param cache: TransformCache to look the output up in and to store it to, only used for seeded runs
+    :return: tuple (path, new content, error, CPU seconds, cache hit), error is None if the file was processed
+        successfully, cache hit is None if no cache was used
+    """
+    start = time.thread_time()
+    stream_keys = (seed, func.__name__, _relative_path(path, root))
+    if cache is not None and seed is None:
+        cache = None  # the output of an unseeded run cannot be reproduced
+    if cache is not None:
+        new_content = cache.get(content, func, args, kwargs, stream_keys)
+        if new_content is not None:
+            return path, new_content, None, time.thread_time() - start, True
+    try:
+        with random_stream(*stream_keys) as stream:
+            state = stream.getstate() if cache is not None else None
+            new_content = func(content, *args, **(kwargs or {}))
+            if cache is not None:
+                # an output that did not draw from the stream is the same for every seed and path
+                cache.put(content, new_content, func, args, kwargs,
+                          stream_keys if stream.getstate() != state else None)
+        return path, new_content, None, time.thread_time() - start, False if cache is not None else None
+    except Exception as e:
+        return path, content, f'{type(e).__name__}: {e}', time.thread_time() - start, None
+    finally:
+        # the token streams of a file are shared by the calls of one stage, they are not kept for the next file
+        lex.cache_clear()
+
+
+def transform_file(path: str, func: callable, args=(), kwargs=None, seed=None, root='', cache=None):
+    """
+    Reads a file, applies a function to its content and writes the result back.
+
+    :param path: path to the file
+    :param func: function to apply, must take a file content as the first argument
+    :param args: args to pass to the function
+    :param kwargs: kwargs to pass to the function
+    :param seed: seed of the job, see transform_content
+    :param root: path of the project folder, see transform_content
+    :param cache: TransformCache, see transform_content
+    :return: tuple (path, error, size in bytes, CPU seconds, cache hit), error is None if the file was processed
+        successfully, cache hit is None if no cache was used
+    """
+    start = time.thread_time()
+    size = 0
+    hit = None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            size = os.fstat(f.fileno()).st_size
+            content = f.read().replace('\u2028', ' ')
+        path, new_content, error, _, hit = transform_content(path, content, func, args, kwargs, seed, root, cache)
+        if error is None and new_content != content:
             with open(path, 'w', encoding='utf-8') as f:
                 f.write(new_content)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return path, error, size, time.thread_time() - start, hit
+
+
+def apply_to_files(dir_path: str, func: callable, exclude=(), *args, workers=1, executor=None, seed=None, root='',
+                   cache=None, stats=None, **kwargs):
+    """
+    Applies a function to every .swift file of a project on disk.
+    With more than one worker the files are spread across a process pool.
+
+    :param dir_path: path to the project
+    :param func: function to apply, must take a file content as the first argument
+    :param exclude: tuple of file names to exclude from the function
+    :param args: args to pass to the function
+    :param workers: int, number of worker processes, 1 to process the files serially
+    :param executor: ProcessPoolExecutor with `workers` processes to reuse instead of creating a new one
+    :param seed: seed of the job, every file gets a random stream of its own, see transform_content
+    :param root: path of the project folder, the streams are keyed by the file paths relative to it
+    :param cache: TransformCache to reuse the outputs of earlier runs from, see transform_content
+    :param stats: dict to add the numbers of processed files, bytes, failed files and cache hits to, see _add_stats
+    :param kwargs: kwargs to pass to the function
+    :return: dict of files that failed to process in the format {path: error}
+    """
+    paths = list_swift_files(dir_path, exclude)
+    job = (paths, repeat(func), repeat(args), repeat(kwargs), repeat(seed), repeat(root), repeat(cache))
+
+    results = _map(transform_file, job, len(paths), workers, executor)
+    failures = {path: error for path, error, _, _, _ in results if error is not None}
+    hits = [hit for _, _, _, _, hit in results]
+
+    if stats is not None:
+        n_bytes = sum(size for _, _, size, _, _ in results)
+        cpu_time = sum(file_cpu_time for _, _, _, file_cpu_time, _ in results)
+        _add_stats(stats, len(paths), n_bytes, failures, cpu_time, _is_parallel(workers, len(paths)),
+                   hits if cache is not None else None)
+    _evict(cache, hits)
+    _report_failures(func, failures)
+    return failures
+
+
+def create_executor(workers: int) -> ProcessPoolExecutor:
+    """
+    Creates a process pool for the per-file stages.
+
+    :param workers: int, number of worker processes
+    :return: ProcessPoolExecutor
+    """
+    # forked workers inherit the parent's random state, reseed them so that unseeded runs do not repeat names
+    return ProcessPoolExecutor(max_workers=workers, initializer=random.seed)
+
+
+def _relative_path(path: str, root: str) -> str:
+    root = root.replace('\\', '/').rstrip('/')
+    if root and path.startswith(root + '/'):
+        return path[len(root) + 1:]
+    return path
+
+
+def _is_parallel(workers: int, n_files: int) -> bool:
+    return workers > 1 and n_files > 1
+
+
+def _map(func: callable, job: tuple, n_files: int, workers: int, executor=None) -> list:
+    if not _is_parallel(workers, n_files):
+        return list(map(func, *job))
+
+    # a few chunks per worker keeps the pool balanced without paying the IPC cost for every file
+    chunksize = max(1, n_files // (workers * 4))
+    if executor is not None:
+        return list(executor.map(func, *job, chunksize=chunksize))
+    with create_executor(workers) as executor:
+        return list(executor.map(func, *job, chunksize=chunksize))
+
+
+def _add_stats(stats: dict, n_files: int, n_bytes: int, failures: dict, cpu_time: float, parallel: bool,
+               hits: list = None):
+    # the CPU time of the worker processes is not part of the process time of the caller, it is reported separately
+    stats['files'] = stats.get('files', 0) + n_files
+    stats['bytes'] = stats.get('bytes', 0) + n_bytes
+    stats['skipped'] = stats.get('skipped', 0) + len(failures)
+    if parallel:
+        stats['worker_cpu_time'] = stats.get('worker_cpu_time', 0) + cpu_time
+    if hits is not None:
+        # a hit is None for a file that was not looked up, e.g. one that failed
+        stats['cache_hits'] = stats.get('cache_hits', 0) + hits.count(True)
+        stats['cache_misses'] = stats.get('cache_misses', 0) + hits.count(False)
+
+
+def _evict(cache, hits: list):
+    # a stage may write an entry for every miss, evict() itself limits how often the cache is walked
+    if cache is not None and False in hits:
+        cache.evict()
+
+
+def _report_failures(func: callable, failures: dict):
+    for path, error in failures.items():
+        print(f'Failed to apply {func.__name__} to {path}: {error}')
@@ -0,0 +1,285 @@
+import bisect
+from functools import lru_cache
+
+import regex as re
+
+IDENTIFIER = 'identifier'
+NUMBER = 'number'
+STRING = 'string'
+COMMENT = 'comment'
+OPEN = 'open'
+CLOSE = 'close'
+PUNCTUATION = 'punctuation'
+
+# values of the region mask
+CODE_REGION = 0
+STRING_REGION = 1
+COMMENT_REGION = 2
+
+OPENING_BRACKETS = {')': '(', ']': '[', '}': '{'}
+
+_TOKEN_PATTERN = re.compile(
+    r'\s*(?:'
+    r'(?P<comment>//[^\n]*|/\*)'
+    r'|(?P<string>#*(?:"""|"))'
+    r'|(?P<identifier>[^\W\d]\w*)'
+    r'|(?P<number>\d\w*)'
+    r'|(?P<open>[(\[{])'
+    r'|(?P<close>[)\]}])'
+    r'|(?P<punctuation>\S)'
+    r')'
+)
+
+_BLOCK_COMMENT_PATTERN = re.compile(r'/\*|\*/')
+
+_NOT_LINE_BREAK_PATTERN = re.compile(r'[^\n]')
+
+
+@lru_cache(maxsize=None)
+def _string_pattern(quote: str, hashes: int):
+    # the next interpolation, escape sequence or closing delimiter of a string literal;
+    # single-line literals also end at a line break, so that an unterminated literal does not swallow the file
+    escape = re.escape('\\' + '#' * hashes)
+    close = re.escape(quote + '#' * hashes)
+    line_break = r'|(?P<line_break>\n)' if quote == '"' else ''
+    return re.compile(rf'{escape}(?:(?P<interpolation>\()|.)|(?P<close>{close}){line_break}', re.DOTALL)
+
+
+class SwiftSource:
+    """
+    Token stream of a Swift file, shared by the transformation stages.
+
+    Tokens are tuples (kind, start, end) with offsets into the code. String literals are split around their
+    interpolations: the code inside \\( ... ) is tokenized like any other code, so identifiers used in
+    interpolations are found, while the literal parts are single STRING tokens. Comments are single COMMENT tokens.
+    Brackets in strings and comments are ignored when brackets are matched.
+    """
+
+    def __init__(self, code: str):
+        self.code = code
+        self.tokens = []
+        self.closing = {}  # index of a matched opening bracket -> index right after its closing bracket
+        self._tokenize()
+
+        self._regions = None
+        self._masked = None
+        self._blocks = None
+        self._line_starts = None
+
+    def _tokenize(self):
+        code = self.code
+        append = self.tokens.append
+        closing = self.closing
+        stacks = {'(': [], '[': [], '{': []}
+        interpolations = {}  # index of the '(' of an interpolation -> pattern to continue its string literal
+        pending = None  # (segment start, search start, pattern) of a string literal to scan
+        pos = 0
+
+        while pos < len(code):
+            if pending is not None:
+                pos = self._scan_string(*pending, stacks['('], interpolations)
+                pending = None
+                continue
+
+            for match in _TOKEN_PATTERN.finditer(code, pos):
+                kind = match.lastgroup
+                start, end = match.span(kind)
+
+                if kind == IDENTIFIER or kind == PUNCTUATION or kind == NUMBER:
+                    append((kind, start, end))
+                elif kind == OPEN:
+                    append((OPEN, start, end))
+                    stacks[code[start]].append(start)
+                elif kind == CLOSE:
+                    append((CLOSE, start, end))
+                    stack = stacks[OPENING_BRACKETS[code[start]]]
+                    if stack:
+                        opening = stack.pop()
+                        closing[opening] = end
+                        if opening in interpolations:
+                            # the interpolation is over, continue with the rest of the string literal
+                            pending = (end, end, interpolations.pop(opening))
+                            pos = end
+                            break
+                elif kind == STRING:
+                    delimiter = match.group(kind)
+                    hashes = delimiter.count('#')
+                    pending = (start, end, _string_pattern(delimiter[hashes:], hashes))
+                    pos = end
+                    break
+                elif code[start + 1] == '*':
+                    end = _skip_block_comment(code, end)
+                    append((COMMENT, start, end))
+                    pos = end
+                    break
+                else:
+                    append((COMMENT, start, end))
+            else:
+                break
+
+    def _scan_string(self, segment_start: int, pos: int, pattern, parentheses: list, interpolations: dict) -> int:
+        code = self.code
+        while True:
+            match = pattern.search(code, pos)
+            if match is None:
+                self.tokens.append((STRING, segment_start, len(code)))
+                return len(code)
+            if match.lastgroup == 'interpolation':
+                parenthesis = match.start('interpolation')
+                self.tokens.append((STRING, segment_start, parenthesis))
+                self.tokens.append((OPEN, parenthesis, parenthesis + 1))
+                parentheses.append(parenthesis)
+                interpolations[parenthesis] = pattern
+                return parenthesis + 1
+            if match.lastgroup == 'close':
+                self.tokens.append((STRING, segment_start, match.end()))
+                return match.end()
+            if match.lastgroup == 'line_break':
+                self.tokens.append((STRING, segment_start, match.start()))
+                return match.start()
+            pos = match.end()  # escape sequence
+
+    def text(self, token: tuple) -> str:
+        """
+        Returns the text of a token.
+        """
+        return self.code[token[1]:token[2]]
+
+    @property
+    def regions(self) -> bytearray:
+        """
+        Region mask of the code, one byte per character: CODE_REGION, STRING_REGION or COMMENT_REGION.
+        It is computed once per file, so checking whether a match is inside a literal is a single lookup.
+        The code of string interpolations is CODE_REGION.
+        """
+        if self._regions is None:
+            self._regions = bytearray(len(self.code))
+            for kind, start, end in self.tokens:
+                if kind == STRING:
+                    self._regions[start:end] = bytes((STRING_REGION,)) * (end - start)
+                elif kind == COMMENT:
+                    self._regions[start:end] = bytes((COMMENT_REGION,)) * (end - start)
+        return self._regions
+
+    def is_code(self, index: int) -> bool:
+        """
+        Checks if a character is code, i.e. it is not part of a string literal or a comment.
+
+        :param index: index of the character
+        :return: True if the character is code, False otherwise
+        """
+        return not 0 <= index < len(self.code) or self.regions[index] == CODE_REGION
+
+    def line_index(self, index: int) -> int:
+        """
+        Returns the number of the line containing a character.
+
+        :param index: index of the character
+        :return: int, zero-based line number
+        """
+        if self._line_starts is None:
+            self._line_starts = [0] + [match.end() for match in re.finditer('\n', self.code)]
+        return bisect.bisect_right(self._line_starts, index) - 1
+
+    def line_start(self, line: int) -> int:
+        """
+        Returns the index of the first character of a line.
+
+        :param line: zero-based line number
+        :return: int, index of the first character
+        """
+        self.line_index(0)
+        return self._line_starts[line]
+
+    def line(self, line: int) -> str:
+        """
+        Returns the text of a line without the line break. Lines out of range are empty.
+
+        :param line: zero-based line number
+        :return: str, text of the line
+        """
+        self.line_index(0)
+        if not 0 <= line < len(self._line_starts):
+            return ''
+        end = self._line_starts[line + 1] - 1 if line + 1 < len(self._line_starts) else len(self.code)
+        return self.code[self._line_starts[line]:end]
+
+    def is_top_level(self, index: int) -> bool:
+        """
+        Checks if a character is outside of any curly brackets.
+
+        :param index: index of the character
+        :return: True if the character is not inside a {...} block, False otherwise
+        """
+        if self._blocks is None:
+            # outermost blocks, unmatched opening brackets extend to the end of the code
+            self._blocks = []
+            end = -1
+            for kind, start, _ in self.tokens:
+                if kind == OPEN and start >= end and self.code[start] == '{':
+                    end = self.closing.get(start, len(self.code))
+                    self._blocks.append((start, end))
+        block = bisect.bisect_right(self._blocks, (index, len(self.code))) - 1
+        return block < 0 or index >= self._blocks[block][1]
+
+    @property
+    def masked(self) -> str:
+        """
+        The code with the characters of string literals and comments replaced by NUL characters, which are neither
+        whitespace nor part of identifiers, so patterns cannot match inside or run into the masked regions.
+        Offsets and line breaks are preserved, so regex matches on the masked code can be mapped back to the code.
+        """
+        if self._masked is None:
+            code = self.code
+            parts = []
+            cursor = 0
+            for kind, start, end in self.tokens:
+                if kind == STRING or kind == COMMENT:
+                    parts.append(code[cursor:start])
+                    parts.append(_NOT_LINE_BREAK_PATTERN.sub('\0', code[start:end]))
+                    cursor = end
+            parts.append(code[cursor:])
+            self._masked = ''.join(parts)
+        return self._masked
+
+    def without_comments(self, keep=lambda comment: False) -> str:
+        """
+        Returns the code without comments.
+
+        :param keep: function comment -> bool, comments for which it returns True are kept
+        :return: code string without comments
+        """
+        code = self.code
+        parts = []
+        cursor = 0
+        for kind, start, end in self.tokens:
+            if kind == COMMENT and not keep(code[start:end]):
+                parts.append(code[cursor:start])
+                cursor = end
+        parts.append(code[cursor:])
+        return ''.join(parts)
+
+
+def _skip_block_comment(code: str, pos: int) -> int:
+    # block comments can be nested in Swift
+    depth = 1
+    while depth:
+        match = _BLOCK_COMMENT_PATTERN.search(code, pos)
+        if match is None:
+            return len(code)
+        depth += 1 if match.group() == '/*' else -1
+        pos = match.end()
+    return pos
+
+
+@lru_cache(maxsize=8)
+def lex(code: str) -> SwiftSource:
+    """
+    Tokenizes Swift code. The result is cached, so the functions that look at the same code share one token stream.
+    The per-file stages clear the cache after every file (see transform_content), so large files are not kept alive.
+    Fragments of a file should be tokenized with SwiftSource directly, to not evict the file.
+
+    :param code: Swift code
+    :return: SwiftSource
+    """
+    return SwiftSource(code)
@@ -0,0 +1,100 @@
+import regex as re
+
+from .lexer import lex, IDENTIFIER, PUNCTUATION
+
+# keywords whose following identifier is indexed together with the keyword, e.g. 'import UIKit'
+INDEXED_KEYWORDS = ('import', 'typealias')
+
+
+def swift_terms(swift_code: str) -> set:
+    """
+    Collects the terms of a Swift file: identifiers outside string literals and comments,
+    attributes and property wrappers as '@Name', and 'import Name' and 'typealias Name' declarations.
+
+    :param swift_code: Swift code
+    :return: set of terms
+    """
+    source = lex(swift_code)
+    terms = set()
+    previous_kind = previous_text = None
+    previous_end = -1
+    for kind, start, end in source.tokens:
+        if kind == IDENTIFIER:
+            name = swift_code[start:end]
+            terms.add(name)
+            if previous_kind == PUNCTUATION and previous_text == '@' and previous_end == start:
+                terms.add('@' + name)
+            elif previous_kind == IDENTIFIER and previous_text in INDEXED_KEYWORDS:
+                terms.add(f'{previous_text} {name}')
+            previous_text = name
+        else:
+            previous_text = swift_code[start:end] if kind == PUNCTUATION else None
+        previous_kind = kind
+        previous_end = end
+    return terms
+
+
+def text_terms(content: str) -> set:
+    """
+    Collects the terms of a non-Swift file (.xib, .storyboard, .pbxproj): words and '@Name' forms.
+
+    :param content: file content
+    :return: set of terms
+    """
+    return set(re.findall(r'@?\w+', content))
+
+
+class ProjectIndex:
+    """
+    Inverted index of a project, maps terms (see swift_terms) to the files containing them.
+    It is built once and turns membership checks over the whole project into dictionary lookups.
+    """
+
+    def __init__(self, project: dict = None):
+        self._files = {}  # term -> set of file paths
+        self._terms = {}  # file path -> set of terms
+        for file_path, content in (project or {}).items():
+            self.update(file_path, content)
+
+    def update(self, file_path: str, content: str):
+        """
+        Indexes a new or changed file.
+
+        :param file_path: path to the file
+        :param content: content of the file
+        """
+        self.remove(file_path)
+        terms = swift_terms(content) if file_path.endswith('.swift') else text_terms(content)
+        self._terms[file_path] = terms
+        for term in terms:
+            self._files.setdefault(term, set()).add(file_path)
+
+    def remove(self, file_path: str):
+        """
+        Removes a file from the index.
+
+        :param file_path: path to the file
+        """
+        for term in self._terms.pop(file_path, ()):
+            files = self._files[term]
+            files.discard(file_path)
+            if not files:
+                del self._files[term]
+
+    def contains(self, term: str) -> bool:
+        """
+        Checks if any file of the project contains a term.
+
+        :param term: term to check, e.g. 'Name', '@Name', 'import Name' or 'typealias Name'
+        :return: True if the term is in the project, False otherwise
+        """
+        return term in self._files
+
+    def files(self, term: str) -> set:
+        """
+        Returns the files containing a term.
+
+        :param term: term to look up
+        :return: set of file paths
+        """
+        return set(self._files.get(term, ()))
@@ -1,11 +1,19 @@
+import bisect
 import os
-import random
 import regex as re
 
 from .constants import CHANGEABLE_FILE_TYPES, IMAGE_FILE_TYPES
-from .file_utils import project_contains_string
+from .lexer import lex, SwiftSource, IDENTIFIER, STRING, OPEN, CLOSE
+from .project_index import ProjectIndex
+from .rng import rng
 from .names import *
 
+# words that start the next declaration, a function signature that runs into one of them has no body
+_DECLARATION_WORDS = {'func', 'var', 'let', 'init', 'deinit', 'subscript', 'case', 'typealias', 'associatedtype',
+                      'class', 'struct', 'enum', 'protocol', 'extension', 'actor', 'static', 'public', 'private',
+                      'fileprivate', 'internal', 'open', 'override', 'mutating', 'final', 'convenience',
+                      'required', 'lazy', 'weak', 'dynamic', '@', ';'}
+
 
 def first_letter_upper(name: str):
     """
@@ -31,10 +39,10 @@ def generate_random_name(prefix='', old_name='', suffix=''):
     :return: generated name
     """
     if old_name:
-        name = random.choice(name_prefixes) + first_letter_upper(old_name)
+        name = rng().choice(name_prefixes) + first_letter_upper(old_name)
     else:
-        name = random.choice(name_prefixes) + random.choice(name_roots)
-        name += str(random.randint(0, len(name) * 100))
+        name = rng().choice(name_prefixes) + rng().choice(name_roots)
+        name += str(rng().randint(0, len(name) * 100))
     name = first_letter_upper(name) if prefix else first_letter_lower(name)
     return prefix + name + suffix
 
@@ -59,78 +67,139 @@ def new_type_name(name: str):
     return generate_random_name(prefix='Type', old_name=name)
 
 
-def rename_local_variables(code, function: str):
+def function_bodies(source: SwiftSource):
     """
-    Renames local variables in the code.
+    Finds the bodies of the functions in a token stream. Nested functions are part of the body of the outer function
+    and are not yielded separately. Requirements without a body, e.g. in protocols, are skipped.
 
-    :param code: source code
-    :param function: function to rename local variables in
-    :return: code with renamed local variables
+    :param source: SwiftSource of the code
+    :return: generator of tuples (index of the 'func' token, index of the '{' token, index of the '}' token)
     """
-    func_body = function[function.find('{') + 1:function.rfind('}')]
-    var_pattern = r'(?<!override)\s*(var|let)\s+([a-zA-Z_]+)'
-    variables = re.finditer(var_pattern, function)
-
-    for var_match in variables:
-        var_name = var_match.group(2)
-        new_name = new_var_name(var_name)
-
-        old_pattern = r'(?<![a-zA-Z_.])' + re.escape(var_name) + r'(?!\w)(?=(?:(?:[^"]*"){2})*[^"]*$)'
-        new_pattern = r'\\\(' + re.escape(var_name) + r'\)'
+    code, tokens = source.code, source.tokens
+    starts = [start for kind, start, end in tokens]
+    i = 0
+    while i < len(tokens):
+        kind, start, end = tokens[i]
+        i += 1
+        if kind != IDENTIFIER or code[start:end] != 'func':
+            continue
 
-        # exclude declaration and assignment to itself at the same time
-        if re.search(rf'{var_name}\s*=\s*{var_name}', function):
+        # walk the signature, skipping the parameter list and brackets in the return type
+        has_params = False
+        j = i
+        while j < len(tokens):
+            kind, start, end = tokens[j]
+            text = code[start:end]
+            if kind == OPEN and text != '{' and start in source.closing:
+                has_params = has_params or text == '('
+                j = bisect.bisect_left(starts, source.closing[start] - 1)
+            elif kind == OPEN and has_params and start in source.closing:
+                close = bisect.bisect_left(starts, source.closing[start] - 1)
+                yield i - 1, j, close
+                i = close + 1
+                break
+            elif kind == OPEN or kind == CLOSE or text in _DECLARATION_WORDS:
+                break  # no body
+            j += 1
+
+
+def local_variable_renames(source: SwiftSource, body_open: int, body_close: int, header_start: int = None) -> list:
+    """
+    Collects the local variables of a function body and the occurrences to rename.
+
+    A variable declared with var or let is renamed from its declaration to the end of the enclosing block,
+    or of the following block for bindings in if and while conditions. Member accesses (.name) are not renamed.
+    A name is skipped for the whole function if it is used before its first declaration (e.g. a parameter or
+    a property), assigned to itself (x = x, x: x) or used as an argument label.
+
+    :param source: SwiftSource of the code
+    :param body_open: index of the '{' token of the body
+    :param body_close: index of the '}' token of the body
+    :param header_start: index of the first token of the declaration, its names count as used before the body
+    :return: list of tuples (start, end, new name) sorted by offset
+    """
+    code, tokens = source.code, source.tokens
+    body_end = tokens[body_close][1]
+
+    seen = set()
+    if header_start is not None:
+        seen.update(code[start:end] for kind, start, end in tokens[header_start:body_open] if kind == IDENTIFIER)
+
+    scopes = {}  # name -> list of (declaration start, scope end)
+    excluded = set()
+    occurrences = []
+    blocks = [body_end]  # ends of the enclosing blocks
+    depth = 0  # depth of () and [] brackets
+    condition = None  # (depth, number of enclosing blocks, declared scopes) of an if or while condition
+
+    for k in range(body_open + 1, body_close):
+        kind, start, end = tokens[k]
+        if kind == OPEN:
+            if code[start] != '{':
+                depth += 1
+                continue
+            block_end = source.closing.get(start, body_end + 1) - 1
+            if condition is not None and condition[:2] == (depth, len(blocks)):
+                for scope in condition[2]:
+                    scope[1] = block_end
+                condition = None
+            blocks.append(block_end)
             continue
-        if re.search(rf'{var_name}\s*:\s*{var_name}', function):
+        if kind == CLOSE:
+            if code[start] != '}':
+                depth -= 1
+            elif len(blocks) > 1:
+                blocks.pop()
             continue
-
-        # check if var_name is used before declaration
-        declaration_idx = function.find(var_match.group(0))
-        first_occurrence_idx = function.find(var_name)
-        if first_occurrence_idx < declaration_idx:
+        if kind != IDENTIFIER:
             continue
 
-        pattern = r'\(|,' + r's*' + var_name + r':'
-        if re.search(pattern, func_body):
+        name = code[start:end]
+        previous = source.text(tokens[k - 1])
+        following = source.text(tokens[k + 1])
+        if name in ('if', 'while') and previous not in ('#', '}'):  # not #if or repeat { ... } while
+            condition = (depth, len(blocks), [])
             continue
 
-        new_func_body = re.sub(old_pattern, new_name, func_body, flags=re.MULTILINE)
-        new_func_body = re.sub(new_pattern, f'\\({new_name})', new_func_body)
-        new_func_body = new_func_body.replace(f'...{var_name}', f'...{new_name}')
-        new_function = function.replace(func_body, new_func_body)
-        code = code.replace(function, new_function)
+        if following in ('=', ':') and k + 2 < body_close and source.text(tokens[k + 2]) == name:
+            excluded.add(name)
+        if previous in ('(', ',') and following == ':':
+            excluded.add(name)
+
+        if previous in ('var', 'let') and source.text(tokens[k - 2]) != 'override':
+            if name not in scopes and name in seen:
+                excluded.add(name)
+            scope = [start, blocks[-1]]
+            scopes.setdefault(name, []).append(scope)
+            if condition is not None:
+                condition[2].append(scope)
+
+        if code[start - 1:start] != '.' or code[start - 3:start] == '...':
+            occurrences.append((name, start, end))
+            seen.add(name)
 
-    return code
+    new_names = {name: new_var_name(name) for name in scopes if name not in excluded}
+    return [(start, end, new_names[name]) for name, start, end in occurrences
+            if name in new_names and any(first <= start < last for first, last in scopes[name])]
 
 
 def rename_variables(code: str) -> str:
     """
-    Renames all variables in a string to random names.
+    Renames the local variables of all functions to random names.
 
     :param code: input code string
     :return: output code string
     """
-
-    # parsing functions
-    pattern = re.compile(
-        r'(?:(?<!class)(\s*?)(public|private|protected|internal|fileprivate|open|override|@objc)\s+)?(static\s+)?func\s+([a-zA-Z_][a-zA-Z0-9_]*)\s*\(\s*(.*?)\s*\)\s*(?:\s*->\s*(?:.*?)?)?\s*{')
-    functions = [match.group(0) for match in pattern.finditer(code)]
-
-    for declaration in functions:
-        open_brackets = 1
-        idx = code.find(declaration) + len(declaration)
-
-        while open_brackets > 0 and idx < len(code):
-            if code[idx] == '{':
-                open_brackets += 1
-            elif code[idx] == '}':
-                open_brackets -= 1
-            idx += 1
-
-        if open_brackets == 0:
-            entire_function = code[code.find(declaration):idx]
-            code = rename_local_variables(code, entire_function)
-    return code
+    source = lex(code)
+    parts = []
+    cursor = 0
+    for func, body_open, body_close in function_bodies(source):
+        for start, end, new_name in local_variable_renames(source, body_open, body_close, func):
+            parts.append(code[cursor:start])
+            parts.append(new_name)
+            cursor = end
+    parts.append(code[cursor:])
+    return ''.join(parts)
 
 
 def parse_type_names(swift_code: str, include_types: tuple = ('class', 'struct', 'enum')):
@@ -144,14 +213,14 @@ def parse_type_names(swift_code: str, include_types: tuple = ('class', 'struct',
     names = []
 
     core_data_imported = 'import CoreData' in swift_code
+    source = lex(swift_code)
 
     for typedef in include_types:
         pattern = rf'{typedef}\s+([A-Z][a-zA-Z0-9_]+)\s*(:|\{{)'
-        matches = re.finditer(pattern, swift_code)
+        matches = re.finditer(pattern, source.masked)
         for match in matches:
-            # extract the part of the code before declaration
-            code_before = swift_code[:match.start()]
-            if code_before.count('{') != code_before.count('}'):
+            # skip nested declarations
+            if not source.is_top_level(match.start()):
                 continue
             if f'@objc({match.group(1)})' in swift_code:
                 continue
@@ -176,13 +245,16 @@ def parse_framework_types(swift_code: str):
 
 def parse_types_in_project(project: dict,
                            include_types: tuple = ('class', 'struct', 'enum', 'protocol'),
-                           exclude_names: tuple = ('SceneDelegate', 'AppDelegate', 'ContentState')):
+                           exclude_names: tuple = ('SceneDelegate', 'AppDelegate', 'ContentState'),
+                           index: ProjectIndex = None):
     """
     Parses type names from the project. Types are specified in the include_types parameter.
+    Types that are imported as modules are skipped.
 
     :param project: dict, project to parse
     :param include_types: tuple of types to parse
     :param exclude_names: tuple of names to exclude
+    :param index: ProjectIndex of the project, built if not provided
     :return: list of parsed type names
     """
     names = []
@@ -192,13 +264,10 @@ def parse_types_in_project(project: dict,
             continue
         if file_path.endswith('.swift'):
             names += parse_type_names(file_content, include_types)
-    names = list(set(names))
-    for name in names:
-        if project_contains_string(project, f'import {name}'):
-            names.remove(name)
-        elif name in exclude_names:
-            names.remove(name)
-    return names
+
+    if index is None:
+        index = ProjectIndex(project)
+    return [name for name in set(names) if name not in exclude_names and not index.contains(f'import {name}')]
 
 
 def parse_types_in_frameworks(dir_path: str):
@@ -271,14 +340,40 @@ def search_image_files(path) -> (list, list):
     return image_files, image_paths
 
 
-def rename_images(path, rename_map, image_paths):
-    # Rename the image files
+def rename_image_files(rename_map, image_paths):
+    """
+    Renames the image files on disk according to the renaming map.
+
+    :param rename_map: renaming map in the format {old_name: new_name}
+    :param image_paths: paths to the image files
+    """
     for old_name, new_name in rename_map.items():
         for image_path in image_paths:
             if old_name in image_path:
                 new_image_path = image_path.replace(old_name, new_name)
                 os.rename(image_path, new_image_path)
 
+
+def rename_image_references(project: dict, rename_map: dict) -> dict:
+    """
+    Renames the image references in an in-memory project.
+
+    :param project: project to rename the references in
+    :param rename_map: renaming map in the format {old_name: new_name}
+    :return: dict, renamed project
+    """
+    for file_path, content in project.items():
+        for old_name, new_name in rename_map.items():
+            if old_name in content:
+                content = content.replace(old_name, new_name)
+        project[file_path] = content
+    return project
+
+
+def rename_images(path, rename_map, image_paths):
+    # Rename the image files
+    rename_image_files(rename_map, image_paths)
+
     # Rename the image references in the project
     for root, dirs, files in os.walk(path):
         # skip __MACOSX folders
@@ -301,67 +396,90 @@ def rename_images(path, rename_map, image_paths):
                 f.write(content)
 
 
+def rename_identifiers(swift_code: str, rename_map: dict) -> str:
+    """
+    Renames identifiers in the Swift code in one pass. Identifiers in string interpolations are renamed as well,
+    string literals are only renamed if they consist of exactly one old name, e.g. "Name".
+
+    :param swift_code: Swift code
+    :param rename_map: renaming map in the format {old_name: new_name}
+    :return: code with renamed identifiers
+    """
+    source = lex(swift_code)
+    parts = []
+    cursor = 0
+    for kind, start, end in source.tokens:
+        if kind == IDENTIFIER:
+            new_name = rename_map.get(swift_code[start:end])
+        elif kind == STRING and end - start > 2 and swift_code[start] == swift_code[end - 1] == '"':
+            new_name = rename_map.get(swift_code[start + 1:end - 1])
+            if new_name is not None:
+                new_name = f'"{new_name}"'
+        else:
+            continue
+        if new_name is not None:
+            parts.append(swift_code[cursor:start])
+            parts.append(new_name)
+            cursor = end
+    parts.append(swift_code[cursor:])
+    return ''.join(parts)
+
+
+def rename_custom_classes(interface_code: str, rename_map: dict) -> str:
+    """
+    Renames the custom classes in a .xib or .storyboard file in one pass.
+
+    :param interface_code: content of the .xib or .storyboard file
+    :param rename_map: renaming map in the format {old_name: new_name}
+    :return: content with renamed custom classes
+    """
+    def rename(match):
+        return f'customClass="{rename_map.get(match.group(1), match.group(1))}"'
+
+    return re.sub(r'customClass="([^"]*)"', rename, interface_code)
+
+
 def rename_type(project: dict, old_name: str, new_name: str):
     """
-    Renames the type in the project. If rename_files is True, the files will be renamed as well.
+    Renames the type in the project.
 
     :param project: project to rename the type in
     :param old_name: old type name
     :param new_name: new type name
     :return: dict, renamed project
     """
-    new_project = {}
+    return rename_types(project, {old_name: new_name})
 
-    if project_contains_string(project, f'@{old_name}'):
-        return project
 
-    if project_contains_string(project, f'typealias {old_name}'):
+def rename_types(project: dict, rename_map: dict, index: ProjectIndex = None):
+    """
+    Renames types in the project according to the renaming map. Every file is rewritten in one pass for all types.
+    Types used as @Name or declared by a typealias are not renamed.
+
+    :param project: project to rename types in
+    :param rename_map: renaming map in the format {old_name: new_name}
+    :param index: ProjectIndex of the project, built if not provided
+    :return: dict, renamed project
+    """
+    if index is None:
+        index = ProjectIndex(project)
+    rename_map = {old_name: new_name for old_name, new_name in rename_map.items()
+                  if not index.contains(f'@{old_name}') and not index.contains(f'typealias {old_name}')}
+    if not rename_map:
         return project
 
+    new_project = {}
     for file_path, file_content in project.items():
         if file_path.endswith('.swift'):
-            # pattern if old name is not surrounded by alphanumeric characters
-            old_pattern = r'(?<!\w)' + re.escape(old_name) + r'(?!\w)(?=(?:(?:[^"]*"){2})*[^"]*$)'
-            new_content = re.sub(old_pattern, new_name, file_content, flags=re.MULTILINE)
-
-            new_pattern = r'\\\([\S\s]*?\)'
-            matches = re.finditer(new_pattern, new_content)
-
-            for match in matches:
-                pattern = r'(?<!\w)' + re.escape(old_name) + r'(?!\w)'
-                new_match = re.sub(pattern, new_name, match.group(0))
-                new_content = new_content.replace(match.group(0), new_match)
-
-            in_string_pattern = r'\"' + re.escape(old_name) + r'\"'
-            new_content = re.sub(in_string_pattern, f'"{new_name}"', new_content)
-
-            new_project[file_path] = new_content
-            continue
+            new_project[file_path] = rename_identifiers(file_content, rename_map)
         elif file_path.endswith('.xib') or file_path.endswith('.storyboard'):
-            pattern = r'customClass="' + re.escape(old_name) + r'"'
-            new_content = re.sub(pattern, 'customClass="' + new_name + '"', file_content)
-            new_project[file_path] = new_content
-            continue
+            new_project[file_path] = rename_custom_classes(file_content, rename_map)
         else:
             new_project[file_path] = file_content
-            continue
 
     return new_project
 
 
-def rename_types(project: dict, rename_map: dict):
-    """
-    Renames types in the project according to the renaming map.
-
-    :param project: project to rename types in
-    :param rename_map: renaming map in the format {old_name: new_name}
-    :return: dict, renamed project
-    """
-    for old_name, new_name in rename_map.items():
-        project = rename_type(project, old_name, new_name)
-    return project
-
-
 def rename_files(project: dict, rename_map: dict) -> dict:
     """
     Renames files in the project according to the renaming map.
@@ -0,0 +1,50 @@
+import hashlib
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_stream = ContextVar('random_stream', default=None)
+
+
+def rng():
+    """
+    Returns the random generator of the current stream, see random_stream.
+    Outside of a stream it is the global random module, so unseeded runs behave as before.
+
+    :return: random.Random or the random module
+    """
+    stream = _stream.get()
+    return stream if stream is not None else random
+
+
+def derive_seed(seed, *keys) -> int:
+    """
+    Derives the seed of a stream from the seed of a job and the keys of the stream, e.g. the stage and the file.
+    Unlike hash(), the result is the same in every process.
+
+    :param seed: seed of the job
+    :param keys: str keys of the stream
+    :return: int, 64-bit seed
+    """
+    digest = hashlib.sha256(':'.join(map(str, (seed, *keys))).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+@contextmanager
+def random_stream(seed, *keys):
+    """
+    Makes rng() return a generator of its own, seeded from the job seed and the keys, for the code in the block.
+    The stream belongs to the current thread or task, so concurrent jobs do not share random state, and a file gets
+    the same names whichever worker transforms it and in whichever order. With seed None the block uses the global
+    random module.
+
+    :param seed: seed of the job, None for an unseeded block
+    :param keys: str keys of the stream, e.g. the stage and the path of the file relative to the project
+    :return: random.Random of the stream, None for an unseeded block
+    """
+    stream = random.Random(derive_seed(seed, *keys)) if seed is not None else None
+    token = _stream.set(stream)
+    try:
+        yield stream
+    finally:
+        _stream.reset(token)
@@ -1,9 +1,14 @@
 import random
 
 import regex as re
+from .lexer import lex, SwiftSource, OPEN, CLOSE, PUNCTUATION
 from .rename_utils import generate_random_name
 from .dummy_files import generate_dummy_function
 
+_BRACKET_PATTERN = re.compile(r'[(\[{}]')
+
+_INNER_BRACKETS_PATTERNS = (re.compile(r'\[[\S\s]*?\]'), re.compile(r'\([\S\s]*?\)'), re.compile(r'\{[\S\s]*?\}'))
+
 
 def remove_empty_lines(swift_code: str) -> str:
     """
@@ -17,49 +22,35 @@ def remove_empty_lines(swift_code: str) -> str:
 
 def remove_comments(swift_code: str) -> str:
     """
-    Removes all comments from a string. Preserves strings like "...//...".
+    Removes all comments from a string. Preserves strings like "...//..." and the swift-tools-version comment.
 
     :param swift_code: input code string
     :return: output code string with no comments
     """
-    version_comment = re.search(r'\/\/ swift-tools-version:.*', swift_code)
-
-    # Find all strings like "...//..." and replace them with placeholders
-    pattern = r'"(.*?//.*?)"'
-    preserved_strings = re.findall(pattern, swift_code)
-    for i, string in enumerate(preserved_strings):
-        placeholder = f'[000__PRESERVED_STRING_{i}__000]'
-        swift_code = swift_code.replace(string, placeholder)
-
-    # Remove single-line comments
-    swift_code = re.sub(r'//[^\n]*', '', swift_code)
-
-    # Remove multi-line comments
-    swift_code = re.sub(r'/\*(.*?)\*/', '', swift_code, flags=re.DOTALL)
-
-    # Restore preserved strings
-    for i, string in enumerate(preserved_strings):
-        placeholder = f'[000__PRESERVED_STRING_{i}__000]'
-        swift_code = swift_code.replace(placeholder, string)
-
-    # Restore swift-tools-version comment
-    if version_comment:
-        swift_code = version_comment.group() + '\n' + swift_code
-
-    return swift_code
+    return lex(swift_code).without_comments(keep=lambda comment: comment.startswith('// swift-tools-version:'))
 
 
 def split_conditions(condition: str) -> list:
-    # split the condition by "," but ignore "," inside brackets and strings
-    # Regular expression to match commas outside of parentheses and quotes
-    pattern = r',(?=(?:[^\(\)]*\([^()]*\))*[^\(\)]*$)(?=(?:[^\"]*\"[^\"]*\")*[^\"]*$)'
-
-    # Use re.split to split the string based on the pattern
-    split_result = re.split(pattern, condition)
-
-    # Remove any leading or trailing whitespace from each element in the result
-    split_result = [s.strip() for s in split_result]
+    """
+    Splits a condition list by the commas outside of brackets, string literals and comments.
 
+    :param condition: input condition, e.g. 'a > 0, b.contains(", ")'
+    :return: list of stripped conditions
+    """
+    # conditions are short-lived fragments, they are not cached so they do not evict the lexed files
+    source = SwiftSource(condition)
+    split_result = []
+    depth = 0
+    cursor = 0
+    for kind, start, end in source.tokens:
+        if kind == OPEN:
+            depth += 1
+        elif kind == CLOSE:
+            depth -= 1
+        elif kind == PUNCTUATION and depth == 0 and condition[start] == ',':
+            split_result.append(condition[cursor:start].strip())
+            cursor = end
+    split_result.append(condition[cursor:].strip())
     return split_result
 
 
@@ -114,6 +105,46 @@ if !({condition}) {{ /* check the case when {condition} is false */
     return transformed_statement
 
 
+def splice_blocks(code: str, blocks, render: callable) -> str:
+    """
+    Replaces blocks of code in one forward pass. Blocks must be sorted by their start and either nested or disjoint,
+    nested blocks are replaced first, so that the outer block is rendered with the already transformed body.
+    Blocks that overlap a previous one are left as they are.
+
+    :param code: input code string
+    :param blocks: iterable of tuples (start, body_start, end, data), where code[body_start - 1] is the opening bracket
+        of the block and code[end - 1] is the closing one
+    :param render: function (data, statement, body) -> str returning the replacement of the block
+    :return: output code string
+    """
+    # every frame is [start, body_start, end, data, parts, cursor]
+    stack = [[0, 0, len(code), None, [], 0]]
+
+    def close():
+        start, body_start, end, data, parts, cursor = stack.pop()
+        parts.append(code[cursor:end - 1])
+        body = ''.join(parts)
+        statement = code[start:body_start] + body + code[end - 1]
+        parent = stack[-1]
+        parent[4].append(render(data, statement, body))
+        parent[5] = end
+
+    for start, body_start, end, data in blocks:
+        while len(stack) > 1 and start >= stack[-1][2]:
+            close()
+        frame = stack[-1]
+        if end > frame[2] or start < frame[5]:
+            continue
+        frame[4].append(code[frame[5]:start])
+        stack.append([start, body_start, end, data, [], body_start])
+
+    while len(stack) > 1:
+        close()
+    root = stack[0]
+    root[4].append(code[root[5]:])
+    return ''.join(root[4])
+
+
 def transform_conditions(code: str, comment_adding: bool = False) -> str:
     """
     Transforms all guard statements in a string by converting them to if statements.
@@ -123,30 +154,18 @@ def transform_conditions(code: str, comment_adding: bool = False) -> str:
     :return: output code string
     """
     guard_pattern = r'[\s*?]guard\s+([\S\s]*?)\s+else\s+{'
-    statements = re.finditer(guard_pattern, code)
+    source = lex(code)
 
-    transformed_code = code  # Create a new string to store the transformed code
+    blocks = []
+    for match in re.finditer(guard_pattern, source.masked):
+        end = source.closing.get(match.end() - 1)
+        if end is not None:
+            blocks.append((match.start(), match.end(), end, code[match.start(1):match.end(1)]))
 
-    for match in statements:
-        condition = match.group(1)
-        statement_start = match.group(0)
-        open_brackets = 1
-        idx = code.find(statement_start) + len(statement_start)
+    def render(condition, statement, else_body):
+        return transform_condition(statement, condition, else_body, comment_adding=comment_adding)
 
-        while open_brackets > 0 and idx < len(code):
-            if code[idx] == '{':
-                open_brackets += 1
-            elif code[idx] == '}':
-                open_brackets -= 1
-            idx += 1
-
-        if open_brackets == 0:
-            statement = code[code.find(statement_start):idx]
-            else_body = statement[len(statement_start): -1]
-            transformed_statement = transform_condition(statement, condition, else_body, comment_adding=comment_adding)
-            transformed_code = transformed_code.replace(statement, transformed_statement)
-
-    return transformed_code
+    return splice_blocks(code, blocks, render)
 
 
 def generate_while_loop(val: str, sequence: str, body: str, n: int, comment_adding: bool = False) -> str:
@@ -209,17 +228,12 @@ def transform_loops(code: str, comment_adding: bool = False) -> str:
     :return: output code string
     """
     for_pattern = r'(\s*?)for\s+([a-zA-Z0-9_]+?)\s+in\s+([\S\s]+?){'
-    matches = re.finditer(for_pattern, code)
+    source = lex(code)
 
-    transformed_code = code  # Create a new string to store the transformed code
+    blocks = []
     n = 0
-
-    for match in matches:
-        val = match.group(2)
-        sequence = match.group(3)
+    for match in re.finditer(for_pattern, source.masked):
         loop_start = match.group(0)
-        open_brackets = 1
-        idx = code.find(loop_start) + len(loop_start)
 
         if loop_start.count('(') > loop_start.count(')'):
             continue
@@ -228,40 +242,43 @@ def transform_loops(code: str, comment_adding: bool = False) -> str:
         if loop_start.count('{') - 1 > loop_start.count('}'):
             continue
 
-        while open_brackets > 0 and idx < len(code):
-            if code[idx] == '{':
-                open_brackets += 1
-            elif code[idx] == '}':
-                open_brackets -= 1
-            idx += 1
+        end = source.closing.get(match.end() - 1)
+        if end is None:
+            continue
 
-        if open_brackets == 0:
-            loop = code[code.find(loop_start):idx]
-            body = loop[loop.find('{') + 1: -1]
-            transformed_loop = generate_while_loop(val, sequence, body, n, comment_adding)
-            transformed_code = transformed_code.replace(loop, transformed_loop)
-            n += 1
+        # generate the loop around a placeholder body, so that the names are drawn in the order of the loops
+        # even though the inner loops are rendered first
+        sequence = code[match.start(3):match.end(3)]
+        transformed_loop = generate_while_loop(match.group(2), sequence, '\0', n, comment_adding)
+        blocks.append((match.start(), match.end(), end, transformed_loop.split('\0', 1)))
+        n += 1
 
-    return transformed_code
+    def render(transformed_loop, loop, body):
+        return transformed_loop[0] + body + transformed_loop[1]
 
+    return splice_blocks(code, blocks, render)
 
-def parse_functions(code: str):
-    # parsing functions
+
+def parse_function_spans(code: str):
+    """
+    Parses the functions that can be restructured, in the order they appear in the code.
+
+    :param code: input code string
+    :return: generator of tuples (start, end, function_data), where code[start:end] is the function and
+        function_data is [function, name, params, declaration, body, returns_value]
+    """
     pattern = re.compile(
         r'(?:\b(?:open|public|internal|fileprivate|private|final|class|static|dynamic|convenience|required|mutating|override|@objc)\s+)*func\s+([a-zA-Z_][a-zA-Z0-9_]*)'
     )
-    declarations = [match.group(0) for match in pattern.finditer(code)]
+    source = lex(code)
+    masked = source.masked
 
     def parse_params(unparsed: str):
         parsed = []
 
         # replace patterns in [], (), and {}
-        inner_pattern = re.compile(r'\[[\S\s]*?\]')
-        unparsed = re.sub(inner_pattern, '', unparsed)
-        inner_pattern = re.compile(r'\([\S\s]*?\)')
-        unparsed = re.sub(inner_pattern, '', unparsed)
-        inner_pattern = re.compile(r'\{[\S\s]*?\}')
-        unparsed = re.sub(inner_pattern, '', unparsed)
+        for inner_pattern in _INNER_BRACKETS_PATTERNS:
+            unparsed = inner_pattern.sub('', unparsed)
 
         for param in unparsed.split(','):
             type_ = None
@@ -282,67 +299,60 @@ def parse_functions(code: str):
 
         return parsed
 
-    for declaration in declarations:
-        # check if @available is one line above declaration
-        line_id = 0
-        for line in code.split('\n'):
-            if declaration in line:
-                break
-            line_id += 1
-        if '@available' in code.split('\n')[line_id - 1]:
-            continue
-        if '@MainActor' in code.split('\n')[line_id - 1]:
-            continue
-
-        try:
-            declaration_start_index = declaration_end_index = code.find(declaration)
+    for match in pattern.finditer(masked):
+        func_start = match.start()
 
-            while not (code[declaration_end_index] == '{' and
-                       declaration.count('(') == declaration.count(')') and
-                       declaration.count('{') == declaration.count('}')):
-                declaration_end_index += 1
-                declaration = code[declaration_start_index:declaration_end_index]
-        except IndexError:
+        # check if @available or @MainActor is one line above declaration
+        line_id = source.line_index(func_start)
+        previous_line = source.line(line_id - 1)
+        if '@available' in previous_line:
+            continue
+        if '@MainActor' in previous_line:
             continue
 
-        if declaration.find('}') < declaration.find('{'):
+        # the declaration ends at the first '{' outside of parentheses and square brackets
+        declaration_end = match.end()
+        while declaration_end is not None:
+            bracket = _BRACKET_PATTERN.search(masked, declaration_end)
+            if bracket is None or bracket.group() == '}':
+                declaration_end = None
+            elif bracket.group() == '{':
+                declaration_end = bracket.start()
+                break
+            else:
+                declaration_end = source.closing.get(bracket.start())
+        if declaration_end is None:
             continue  # skip functions without body
 
-        if declaration.count('{') > 1 or declaration.count('}') > 0:
+        if '{' in masked[func_start:declaration_end]:
             continue  # skip functions with multiple bodies
 
+        declaration = code[func_start:declaration_end]
+
         if declaration.count('func') > 1:
             continue  # skip functions with multiple func keywords
 
         if '<' in declaration:
             continue  # skip generic functions
 
-        if code.split('\n')[line_id - 1].strip() == '@objc' and '@objc' not in declaration:
-            declaration = code.split('\n')[line_id - 1] + '\n' + declaration
-        if '@objc' in code.split('\n')[line_id] and '@objc' not in declaration:
-            declaration = '@objc ' + declaration
-
-        open_brackets = 1
-        func_start_index = code.find(declaration)
-        body_start_index = func_start_index + len(declaration) + 2
-        body_end_index = body_start_index
-
-        while open_brackets > 0 and body_end_index < len(code):
-            if code[body_end_index] == '{':
-                open_brackets += 1
-            elif code[body_end_index] == '}':
-                open_brackets -= 1
-            body_end_index += 1
-
-        if open_brackets != 0:
+        if '@objc' not in declaration:
+            if previous_line.strip() == '@objc':
+                func_start = source.line_start(line_id - 1)
+            elif '@objc' in source.line(line_id):
+                if not code.startswith('@objc ', func_start - 6):
+                    continue
+                func_start -= 6
+            declaration = code[func_start:declaration_end]
+
+        body_end = source.closing.get(declaration_end)
+        if body_end is None:
             continue
+        body_start = declaration_end + 1
+        if code[body_start:body_start + 1].isspace():
+            body_start += 1
 
-        function = code[func_start_index:body_end_index]
-        if function.count('{') != function.count('}'):
-            continue
-        if not function.replace(declaration, '').strip():
-            continue
-        name = declaration.split('func')[1].split('(')[0].strip()
+        function = code[func_start:body_end]
+        name = match.group(1)
 
         if not name.isalnum():
             continue
@@ -361,7 +371,7 @@ def parse_functions(code: str):
         unparsed_params = declaration[param_start:param_end - 1].strip()
         params = parse_params(unparsed_params)
 
-        body = code[body_start_index:body_end_index - 1]
+        body = code[body_start:body_end - 1]
         returns_value = ('->' in declaration and 'Void' not in declaration) or 'return ' in body
 
         # skip if there are nested functions
@@ -374,7 +384,18 @@ def parse_functions(code: str):
         if '\n' in declaration and declaration.index('\n') > declaration.index(')'):
             continue
 
-        yield [function, name, params, declaration, body, returns_value]
+        yield func_start, body_end, [function, name, params, declaration, body, returns_value]
+
+
+def parse_functions(code: str):
+    """
+    Parses the functions that can be restructured.
+
+    :param code: input code string
+    :return: generator of lists [function, name, params, declaration, body, returns_value]
+    """
+    for start, end, function_data in parse_function_spans(code):
+        yield function_data
 
 
 def compose_call(name: str, params: list, return_value: bool = False, is_async: bool = False):
@@ -427,7 +448,13 @@ def restructure_function(code, function_data):
 
 
 def restructure_functions(code: str):
-    new_code = code
-    for function_data in parse_functions(code):
-        new_code = restructure_function(new_code, function_data)
-    return new_code
+    parts = []
+    cursor = 0
+    for start, end, function_data in parse_function_spans(code):
+        if start < cursor:
+            continue
+        parts.append(code[cursor:start])
+        parts.append(restructure_function(function_data[0], function_data))
+        cursor = end
+    parts.append(code[cursor:])
+    return ''.join(parts)
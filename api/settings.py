@@ -0,0 +1,89 @@
+import os
+
+# Number of worker processes used by the per-file pipeline stages.
+# 1 runs the stages serially in the job's own process.
+PIPELINE_WORKERS = int(os.environ.get('PARAPHRASER_WORKERS', 1))
+
+# Upper bound for the per-job `workers` parameter.
+MAX_PIPELINE_WORKERS = int(os.environ.get('PARAPHRASER_MAX_WORKERS', os.cpu_count() or 1))
+
+
+def resolve_workers(workers=None) -> int:
+    """
+    Resolves the number of pipeline workers for a job.
+
+    :param workers: int, requested number of workers, None to use the server default
+    :return: int, number of workers clamped to [1, MAX_PIPELINE_WORKERS]
+    """
+    if workers is None:
+        workers = PIPELINE_WORKERS
+    return max(1, min(int(workers), MAX_PIPELINE_WORKERS))
+
+
+# Largest accepted upload in bytes, larger archives are rejected with 413 as soon as the Content-Length header
+# or the bytes received so far exceed it.
+MAX_UPLOAD_SIZE = int(os.environ.get('PARAPHRASER_MAX_UPLOAD_SIZE', 4 * 1024 ** 3))
+
+# Size of the chunks uploads are copied to disk in.
+UPLOAD_CHUNK_SIZE = int(os.environ.get('PARAPHRASER_UPLOAD_CHUNK_SIZE', 1024 ** 2))
+
+# Limits for extracting uploaded archives, nested archives count towards the totals of the outer one.
+MAX_EXTRACTED_SIZE = int(os.environ.get('PARAPHRASER_MAX_EXTRACTED_SIZE', 16 * 1024 ** 3))
+MAX_ARCHIVE_ENTRIES = int(os.environ.get('PARAPHRASER_MAX_ARCHIVE_ENTRIES', 500_000))
+MAX_COMPRESSION_RATIO = int(os.environ.get('PARAPHRASER_MAX_COMPRESSION_RATIO', 200))
+MAX_ARCHIVE_DEPTH = int(os.environ.get('PARAPHRASER_MAX_ARCHIVE_DEPTH', 3))
+
+# Seconds a project is kept after its result was downloaded completely.
+DOWNLOAD_CLEANUP_DELAY = float(os.environ.get('PARAPHRASER_DOWNLOAD_CLEANUP_DELAY', 10))
+
+# Seconds a finished project is kept when its result is not downloaded completely, e.g. an interrupted download
+# that is never resumed. Expired projects are removed at startup and every RESULT_SWEEP_INTERVAL seconds.
+RESULT_TTL = float(os.environ.get('PARAPHRASER_RESULT_TTL', 24 * 60 * 60))
+RESULT_SWEEP_INTERVAL = float(os.environ.get('PARAPHRASER_RESULT_SWEEP_INTERVAL', 10 * 60))
+
+# Compression of the result archives: 'store', 'fast' or 'default', jobs can override it.
+ARCHIVE_COMPRESSION = os.environ.get('PARAPHRASER_COMPRESSION', 'default')
+
+# Number of threads compressing the entries of a result archive.
+ARCHIVE_THREADS = int(os.environ.get('PARAPHRASER_ARCHIVE_THREADS', os.cpu_count() or 1))
+
+# Notifications kept per websocket client, the oldest ones are dropped for clients that fall behind.
+NOTIFICATION_BUFFER_SIZE = int(os.environ.get('PARAPHRASER_NOTIFICATION_BUFFER_SIZE', 32))
+
+# Seconds between checks of the job registry for jobs that run in another worker process.
+NOTIFICATION_POLL_INTERVAL = float(os.environ.get('PARAPHRASER_NOTIFICATION_POLL_INTERVAL', 0.5))
+
+# SQLite database of the jobs, shared by the worker processes of the server.
+JOBS_DATABASE = os.environ.get('PARAPHRASER_JOBS_DATABASE', 'jobs.sqlite3')
+
+# Number of jobs the whole server runs at once, in any of its worker processes, further jobs wait in the queue.
+MAX_CONCURRENT_JOBS = int(os.environ.get('PARAPHRASER_MAX_CONCURRENT_JOBS', 1))
+
+# Number of jobs that may wait in the queue of the server, uploads beyond it are rejected with 429.
+MAX_QUEUED_JOBS = int(os.environ.get('PARAPHRASER_MAX_QUEUED_JOBS', 16))
+
+# Order of the queue: 'smallest' runs small uploads first, 'fifo' in the order they arrived.
+QUEUE_POLICY = os.environ.get('PARAPHRASER_QUEUE_POLICY', 'smallest')
+
+# Seconds after which the priority of a waiting job doubles, so that large uploads are not starved by small ones.
+QUEUE_AGING_INTERVAL = float(os.environ.get('PARAPHRASER_QUEUE_AGING_INTERVAL', 60))
+
+# Seconds a rejected client is told to wait when there are no finished jobs to estimate the wait from.
+QUEUE_RETRY_AFTER = int(os.environ.get('PARAPHRASER_QUEUE_RETRY_AFTER', 60))
+
+# Seconds between the checks of a worker process for jobs it may start since a job of another process finished.
+QUEUE_POLL_INTERVAL = float(os.environ.get('PARAPHRASER_QUEUE_POLL_INTERVAL', 1))
+
+# Limits of the process a job runs in, 0 for no limit. The pipeline's own worker processes inherit them.
+# A job that uses more CPU seconds is killed, one that allocates more bytes of memory fails.
+JOB_CPU_LIMIT = int(os.environ.get('PARAPHRASER_JOB_CPU_LIMIT', 30 * 60))
+JOB_MEMORY_LIMIT = int(os.environ.get('PARAPHRASER_JOB_MEMORY_LIMIT', 8 * 1024 ** 3))
+
+# Directory of the cache of the per-file stage outputs, shared by the jobs and the worker processes of the server.
+TRANSFORM_CACHE_DIR = os.environ.get('PARAPHRASER_CACHE_DIR', 'cache')
+
+# Size of the cache in bytes, the least recently used outputs are removed above it. 0 disables the cache.
+TRANSFORM_CACHE_SIZE = int(os.environ.get('PARAPHRASER_CACHE_SIZE', 1024 ** 3))
+
+# Seconds between two evictions from the cache, each one takes a stat of every entry.
+TRANSFORM_CACHE_EVICTION_INTERVAL = float(os.environ.get('PARAPHRASER_CACHE_EVICTION_INTERVAL', 300))
@@ -0,0 +1,172 @@
+import hashlib
+import os
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from .settings import MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE
+
+
+class UploadTooLarge(Exception):
+    """
+    Raised when an upload exceeds the size limit.
+    """
+
+    def __init__(self, max_size: int):
+        super().__init__(f'The file exceeds the size limit of {max_size} bytes.')
+        self.max_size = max_size
+
+
+class InvalidUpload(Exception):
+    """
+    Raised when the request body is not a multipart form with the expected file.
+    """
+
+
+class StreamingUpload:
+    """
+    Reads a file from a multipart/form-data request body as it arrives, instead of letting the framework spool the
+    whole body to a temporary file first. The size limit is enforced while the body is received, so an oversized
+    upload is rejected after max_size bytes, and the file is written to disk only once.
+
+    read_filename() receives the body up to the headers of the file, so the upload can be checked and registered
+    before its content is read, save() receives the rest of it.
+    """
+
+    def __init__(self, request: Request, field: str = 'zip_file',
+                 max_size: int = MAX_UPLOAD_SIZE, chunk_size: int = UPLOAD_CHUNK_SIZE):
+        """
+        :param request: Request with a multipart/form-data body
+        :param field: str, name of the form field of the file, the other fields are ignored
+        :param max_size: int, largest accepted file size in bytes
+        :param chunk_size: int, the file is written to disk in chunks of about this size
+        """
+        content_type, options = parse_options_header(request.headers.get('content-type', ''))
+        if content_type != b'multipart/form-data' or b'boundary' not in options:
+            raise InvalidUpload('The request must be a multipart/form-data form.')
+
+        self.field = field
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.filename = None
+        self._stream = request.stream()
+        self._finished = False  # the whole body was received
+
+        self._header_field = b''
+        self._header_value = b''
+        self._headers = {}
+        self._in_file = False  # the current part is the file
+        self._file_done = False
+        self._size = 0
+        self._pending = bytearray()  # file content received but not written yet
+        self._parser = MultipartParser(options[b'boundary'], {
+            'on_part_begin': self._on_part_begin,
+            'on_header_field': self._on_header_field,
+            'on_header_value': self._on_header_value,
+            'on_header_end': self._on_header_end,
+            'on_headers_finished': self._on_headers_finished,
+            'on_part_data': self._on_part_data,
+            'on_part_end': self._on_part_end,
+        })
+
+    async def read_filename(self) -> str:
+        """
+        Receives the body until the headers of the file part are parsed.
+
+        :return: str, name of the uploaded file without any directories
+        :raises InvalidUpload: if the form has no file in the field, or the file is not a .zip archive
+        :raises UploadTooLarge: if the file is larger than max_size before its headers end
+        """
+        while self.filename is None and await self._receive():
+            pass
+        if self.filename is None:
+            raise InvalidUpload(f'The form has no file in the field "{self.field}".')
+        if not self.filename.endswith('.zip') or self.filename == '.zip':
+            raise InvalidUpload('Invalid file type. Please upload a zip file.')
+        return self.filename
+
+    async def save(self, destination: str) -> (int, str):
+        """
+        Receives the rest of the file and writes it to disk. The file is written next to the destination and moved
+        into place only when it is complete.
+
+        :param destination: path to save the file to
+        :return: tuple (size in bytes, sha256 hex digest of the content)
+        :raises UploadTooLarge: if the file is larger than max_size, nothing is left on disk in this case
+        """
+        await self.read_filename()
+        partial = f'{destination}.part'
+        digest = hashlib.sha256()
+        try:
+            with open(partial, 'wb') as f:
+                while True:
+                    more = not self._file_done and await self._receive()
+                    if len(self._pending) >= self.chunk_size or not more:
+                        chunk = bytes(self._pending)
+                        self._pending.clear()
+                        await run_in_threadpool(_write, f, digest, chunk)
+                    if not more:
+                        break
+            if not self._file_done:
+                raise InvalidUpload('The request body ended before the file.')
+            os.replace(partial, destination)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return self._size, digest.hexdigest()
+
+    async def _receive(self) -> bool:
+        # feeds the next chunk of the body to the parser, False once the body is over
+        if self._finished:
+            return False
+        try:
+            chunk = await self._stream.__anext__()
+        except StopAsyncIteration:
+            chunk = b''
+        if not chunk:
+            self._finished = True
+            self._parser.finalize()
+            return False
+        self._parser.write(chunk)
+        return True
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b''
+        self._header_value = b''
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b'content-disposition', b''))
+        if self.filename is None and options.get(b'name') == self.field.encode() and b'filename' in options:
+            # the name becomes part of the path of the project, clients may send a full path of their own
+            self.filename = os.path.basename(options[b'filename'].decode('utf-8', 'replace').replace('\\', '/'))
+            self._in_file = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if not self._in_file:
+            return  # the other fields are not used
+        self._size += end - start
+        if self._size > self.max_size:
+            raise UploadTooLarge(self.max_size)
+        self._pending += data[start:end]
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._in_file = False
+            self._file_done = True
+
+
+def _write(file, digest, chunk: bytes):
+    digest.update(chunk)
+    file.write(chunk)
@@ -0,0 +1,98 @@
+import multiprocessing
+import signal
+import threading
+
+try:
+    import resource
+except ImportError:  # not available on Windows, jobs run without limits there
+    resource = None
+
+from . import notifications
+from .notifications import bus
+from .settings import JOB_CPU_LIMIT, JOB_MEMORY_LIMIT
+
+# a fork server starts job processes from a clean single-threaded process, forking the server itself would copy
+# the locks held by its threads; the modules of the server are imported once in the fork server
+_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+_context = multiprocessing.get_context(_START_METHOD)
+if _START_METHOD == 'forkserver':
+    _context.set_forkserver_preload(['api.main'])
+
+_lock = threading.Lock()
+_processes = set()  # running job processes
+
+_EXIT_REASONS = {
+    -signal.SIGKILL: 'the job was killed, it probably ran out of memory',
+}
+if hasattr(signal, 'SIGXCPU'):
+    _EXIT_REASONS[-signal.SIGXCPU] = 'the job exceeded its CPU time limit'
+
+
+def _set_limits(cpu_limit: int, memory_limit: int):
+    if resource is None:
+        return
+    if cpu_limit:
+        # the soft limit sends SIGXCPU, the hard limit a second later SIGKILL in case the signal is handled
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def _run_job(connection, func: callable, args: tuple, cpu_limit: int, memory_limit: int):
+    # entry point of the job process
+    _set_limits(cpu_limit, memory_limit)
+    notifications.set_channel(connection)
+    try:
+        func(*args)
+    finally:
+        connection.close()
+
+
+def run_isolated(project_id: str, func: callable, args: tuple = (), cpu_limit: int = JOB_CPU_LIMIT,
+                 memory_limit: int = JOB_MEMORY_LIMIT):
+    """
+    Runs a job in a new process with CPU time and memory limits, so the regex-heavy stages neither hold the GIL
+    of the server nor can hang it. The notifications of the job are sent back over a pipe and published on the bus
+    of this process, where the websockets of the job listen. Blocks until the process exits.
+
+    :param project_id: str, id of the job
+    :param func: function to run, must be importable by the new process
+    :param args: args to pass to the function
+    :param cpu_limit: int, CPU seconds the job may use, 0 for no limit
+    :param memory_limit: int, bytes of memory the job may allocate, 0 for no limit
+    :return: str, why the process crashed, None if it exited normally
+    """
+    receiver, sender = _context.Pipe(duplex=False)
+    process = _context.Process(target=_run_job, args=(sender, func, args, cpu_limit, memory_limit),
+                               name=f'job-{project_id}')
+    process.start()
+    sender.close()  # the process holds the only sending end, so reading ends when it exits
+    with _lock:
+        _processes.add(process)
+
+    try:
+        while True:
+            try:
+                message_project_id, message = receiver.recv()
+            except (EOFError, OSError):
+                break
+            bus.publish(message_project_id, message)
+    finally:
+        receiver.close()
+        process.join()
+        with _lock:
+            _processes.discard(process)
+
+    if process.exitcode == 0:
+        return None
+    return _EXIT_REASONS.get(process.exitcode, f'the job process exited with code {process.exitcode}')
+
+
+def terminate_all():
+    """
+    Kills the running job processes, e.g. when the server shuts down.
+    """
+    with _lock:
+        processes = list(_processes)
+    for process in processes:
+        process.kill()
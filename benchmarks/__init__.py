@@ -0,0 +1,63 @@
+import math
+import time
+
+from api.scripts.lexer import lex
+
+
+def time_call(func: callable, *args, repeat: int = 3, **kwargs) -> float:
+    """
+    Times a function call. The lexer cache is cleared before every run, so that tokenizing is part of the timing.
+
+    :param func: function to time
+    :param args: args to pass to the function
+    :param repeat: int, number of runs, the fastest one is reported
+    :param kwargs: kwargs to pass to the function
+    :return: float, wall time of the fastest run in seconds
+    """
+    best = math.inf
+    for _ in range(repeat):
+        lex.cache_clear()
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def growth_exponent(sizes: list, times: list) -> float:
+    """
+    Fits time = c * size ** k with least squares on a log-log scale.
+
+    :param sizes: list of input sizes
+    :param times: list of measured times
+    :return: float, the growth exponent k, ~1 for linear and ~2 for quadratic functions
+    """
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(t, 1e-9)) for t in times]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    return covariance / variance
+
+
+def run_scaling(generate: callable, func: callable, sizes: list, unit: str = 'items', **kwargs) -> float:
+    """
+    Times a function on generated inputs of growing size and prints a table.
+
+    :param generate: function size -> input code string
+    :param func: function to time, takes the code as the first argument
+    :param sizes: list of input sizes
+    :param unit: str, name of the size unit for the table header
+    :param kwargs: kwargs to pass to the function
+    :return: float, the fitted growth exponent
+    """
+    times = []
+    print(f'{unit:>8} {"bytes":>10} {"seconds":>9} {"us/item":>9}')
+    for size in sizes:
+        code = generate(size)
+        seconds = time_call(func, code, **kwargs)
+        times.append(seconds)
+        print(f'{size:>8} {len(code):>10} {seconds:>9.4f} {seconds / size * 1e6:>9.2f}')
+    exponent = growth_exponent(sizes, times)
+    print(f'growth exponent: {exponent:.2f} (1.0 is linear)')
+    return exponent
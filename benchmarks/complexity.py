@@ -0,0 +1,137 @@
+"""
+Checks that the transformation functions scale linearly. Every function runs on inputs of doubling size, the growth
+exponent of its run time is fitted and compared to the function's budget. With --check the exit code is 1 if any
+function exceeds its budget, so a change that brings back a quadratic hot path (a find from 0 for every match,
+a replace on the whole file per match, a quote-parity lookahead) fails.
+
+A function over its budget is measured once more before it is reported, to rule out noise.
+
+Usage: python -m benchmarks.complexity [--check] [--functions transform_loops,...] [--steps 4] [--scale 1.0]
+                                       [--output complexity.json]
+"""
+import argparse
+import json
+import random
+import sys
+
+from api.scripts.comment_utils import add_comments, add_comments_to_imports, add_comments_to_declarations, \
+    add_comments_to_conditionals
+from api.scripts.project_index import swift_terms
+from api.scripts.rename_utils import rename_variables, rename_identifiers, rename_custom_classes
+from api.scripts.text import remove_comments, remove_empty_lines, transform_conditions, transform_loops, \
+    parse_functions, restructure_functions
+from benchmarks import time_call, growth_exponent
+from benchmarks.generator import generate_project, swift_sources
+from benchmarks.guards import generate_guards_file
+from benchmarks.loops import generate_loops_file
+from benchmarks.strings import generate_strings_file, OLD_NAME, NEW_NAME
+
+# growth exponent a function may reach, linear functions measure 0.8-1.2 depending on the noise
+DEFAULT_BUDGET = 1.35
+
+RENAME_MAP = {'Model1': 'TypeModel1', 'Model2': 'TypeModel2', 'ViewController0': 'TypeViewController0'}
+
+
+def generate_source_file(n_functions: int) -> str:
+    """
+    Generates a single source file of a synthetic project, see benchmarks.generator.
+    """
+    project = generate_project(n_files=1, n_functions=n_functions, n_types=8, n_interfaces=0, n_images=0, seed=1)
+    return next(iter(swift_sources(project).values()))
+
+
+def generate_storyboard(n_scenes: int) -> str:
+    """
+    Generates a storyboard with n_scenes view controllers, see benchmarks.generator.
+    """
+    project = generate_project(n_files=n_scenes, n_functions=0, n_types=0, n_interfaces=1, n_images=0)
+    return next(content for path, content in project.items() if path.endswith('.storyboard'))
+
+
+def _parse_all_functions(code: str) -> list:
+    # parse_functions is lazy
+    return list(parse_functions(code))
+
+
+# name -> (function, input generator, smallest input size, budget)
+CASES = {
+    'remove_comments': (remove_comments, generate_source_file, 250, DEFAULT_BUDGET),
+    'remove_empty_lines': (remove_empty_lines, generate_source_file, 2000, DEFAULT_BUDGET),
+    'transform_conditions': (transform_conditions, generate_guards_file, 2500, DEFAULT_BUDGET),
+    'transform_loops': (transform_loops, generate_loops_file, 2500, DEFAULT_BUDGET),
+    'parse_functions': (_parse_all_functions, generate_source_file, 250, DEFAULT_BUDGET),
+    'restructure_functions': (restructure_functions, generate_source_file, 250, DEFAULT_BUDGET),
+    'rename_variables': (rename_variables, generate_source_file, 250, DEFAULT_BUDGET),
+    'add_comments': (add_comments, generate_source_file, 250, DEFAULT_BUDGET),
+    'add_comments_to_imports': (add_comments_to_imports, generate_source_file, 2000, DEFAULT_BUDGET),
+    'add_comments_to_declarations': (add_comments_to_declarations, generate_source_file, 250, DEFAULT_BUDGET),
+    'add_comments_to_conditionals': (add_comments_to_conditionals, generate_source_file, 250, DEFAULT_BUDGET),
+    'rename_identifiers': (lambda code: rename_identifiers(code, {OLD_NAME: NEW_NAME, **RENAME_MAP}),
+                           generate_strings_file, 128 * 1024, DEFAULT_BUDGET),
+    'rename_custom_classes': (lambda code: rename_custom_classes(code, RENAME_MAP), generate_storyboard, 2000,
+                              DEFAULT_BUDGET),
+    'swift_terms': (swift_terms, generate_source_file, 250, DEFAULT_BUDGET),
+}
+
+
+def measure(name: str, steps: int = 4, scale: float = 1.0, repeat: int = 3) -> dict:
+    """
+    Times a function of CASES on inputs of doubling size and fits the growth exponent.
+
+    :param name: str, name of the case
+    :param steps: int, number of input sizes, the largest is 2 ** (steps - 1) times the smallest
+    :param scale: float, factor for the input sizes
+    :param repeat: int, number of runs per size, the fastest one is used
+    :return: dict {function, budget, bytes, seconds, exponent}
+    """
+    func, generate, smallest, budget = CASES[name]
+    sizes = [max(1, int(smallest * scale)) * 2 ** i for i in range(steps)]
+    codes = [generate(size) for size in sizes]
+    times = []
+    for code in codes:
+        random.seed(0)  # the functions that pick random names and comments do the same work in every run
+        times.append(time_call(func, code, repeat=repeat))
+    n_bytes = [len(code) for code in codes]
+    return {'function': name, 'budget': budget, 'bytes': n_bytes, 'seconds': times,
+            'exponent': growth_exponent(n_bytes, times)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help='exit with code 1 if a function exceeds its budget')
+    parser.add_argument('--functions', default=','.join(CASES), help='comma-separated names of the functions')
+    parser.add_argument('--steps', type=int, default=4, help='number of doubling input sizes')
+    parser.add_argument('--scale', type=float, default=1.0, help='factor for the input sizes')
+    parser.add_argument('--output', help='path to write the JSON results to')
+    args = parser.parse_args()
+
+    names = args.functions.split(',')
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        parser.error(f'unknown functions: {", ".join(unknown)}')
+
+    results = []
+    print(f'{"function":<30} {"max bytes":>10} {"seconds":>9} {"exponent":>9} {"budget":>7}')
+    for name in names:
+        result = measure(name, args.steps, args.scale)
+        if result['exponent'] > result['budget']:
+            result = measure(name, args.steps, args.scale)
+        result['passed'] = result['exponent'] <= result['budget']
+        results.append(result)
+        print(f'{name:<30} {result["bytes"][-1]:>10} {result["seconds"][-1]:>9.4f} {result["exponent"]:>9.2f} '
+              f'{result["budget"]:>7.2f}{"" if result["passed"] else "  OVER BUDGET"}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'Results written to {args.output}')
+
+    failed = [result['function'] for result in results if not result['passed']]
+    if failed:
+        print(f'{len(failed)} function(s) over budget: {", ".join(failed)}')
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
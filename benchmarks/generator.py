@@ -0,0 +1,231 @@
+"""
+Generates deterministic synthetic Swift projects for the benchmarks: sources with type declarations, guards, loops,
+comments, string literals and local variables, storyboards and xibs that reference the view controllers, a project
+file, a framework in Pods and image assets. The filler functions come from the dummy file templates.
+
+Usage: python -m benchmarks.generator OUTPUT [--files 50] [--functions 10] [--guards 0.5] [--loops 0.5]
+                                             [--types 20] [--interfaces 4] [--images 4] [--seed 0]
+
+OUTPUT is a directory, or a zip archive if it ends with .zip.
+"""
+import argparse
+import os
+import random
+import zipfile
+from contextlib import contextmanager
+
+from api.scripts import dummy_files
+
+TYPE_KINDS = ('class', 'struct', 'enum', 'protocol')
+
+ROOT = 'Project'
+
+# 1x1 transparent PNG
+_PNG = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                     '1f15c4890000000d49444154789c63000100000500010d0a2db40000000049454e44ae426082')
+
+
+@contextmanager
+def _seeded(seed: int):
+    # the dummy file templates use the global random generator, it is seeded for the project and restored after
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(state)
+
+
+def _type_declaration(kind: str, name: str, rng: random.Random) -> str:
+    if kind == 'enum':
+        cases = '\n'.join(f'    case {name.lower()}Case{i}' for i in range(rng.randint(2, 6)))
+        return f'enum {name} {{\n{cases}\n}}\n'
+    if kind == 'protocol':
+        return f'protocol {name} {{\n    func handle{name}(value: Int) -> Bool\n}}\n'
+    fields = '\n'.join(f'    var field{i}: Int = {rng.randint(0, 100)}' for i in range(rng.randint(1, 4)))
+    return f'{kind} {name} {{\n{fields}\n\n    init() {{}}\n}}\n'
+
+
+def _function(index: int, types: list, guard_density: float, loop_density: float, rng: random.Random) -> str:
+    used_type = rng.choice(types)
+    lines = [f'    /// Computes the value of row {index} for "{used_type}" models.',
+             f'    func compute{index}(value: Int, other: Int?, items: [Int]) -> Int {{']
+    if rng.random() < guard_density:
+        lines += [f'        guard value > {rng.randint(0, 50)}, let unwrapped = other else {{',
+                  '            return 0',
+                  '        }',
+                  '        var result = unwrapped + value']
+    else:
+        lines += ['        var result = value // no guard here']
+    if rng.random() < loop_density:
+        lines += ['        for item in items where item > 0 {',
+                  '            result += item',
+                  '        }']
+    if rng.random() < loop_density / 2:
+        lines += [f'        for offset in 0..<{rng.randint(2, 10)} {{',
+                  '            result -= offset',
+                  '        }']
+    lines += [f'        let label = "\\(result) items of {used_type}"',
+              '        /* the label is printed for debugging */',
+              '        print(label)',
+              f'        let model = {used_type}.self',
+              '        print(model)',
+              '        return result',
+              '    }']
+    return '\n'.join(lines)
+
+
+def _source_file(index: int, own_types: list, types: list, n_functions: int, guard_density: float,
+                 loop_density: float, rng: random.Random) -> str:
+    parts = ['import Foundation', 'import UIKit', '']
+    for kind, name in own_types:
+        parts.append(_type_declaration(kind, name, rng))
+    parts.append(f'class ViewController{index}: UIViewController {{')
+    parts.append('    @IBOutlet weak var titleLabel: UILabel!\n')
+    for i in range(n_functions):
+        if i % 4 == 3:
+            # filler from the dummy file templates, they use the seeded global random generator
+            parts.append('    ' + dummy_files.generate_dummy_function().strip())
+        else:
+            parts.append(_function(index * n_functions + i, types, guard_density, loop_density, rng))
+        parts.append('')
+    parts.append('}')
+    return '\n'.join(parts) + '\n'
+
+
+def _storyboard(index: int, controllers: list) -> str:
+    scenes = '\n'.join(
+        f'        <scene sceneID="scene{index}-{i}">\n'
+        f'            <objects>\n'
+        f'                <viewController id="vc{index}-{i}" customClass="{name}" customModule="App" '
+        f'sceneMemberID="viewController"/>\n'
+        f'            </objects>\n'
+        f'        </scene>'
+        for i, name in enumerate(controllers))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<document type="com.apple.InterfaceBuilder3.CocoaTouch.Storyboard.XIB" version="3.0">\n'
+            f'    <scenes>\n{scenes}\n    </scenes>\n</document>\n')
+
+
+def _xib(name: str) -> str:
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<document type="com.apple.InterfaceBuilder3.CocoaTouch.XIB" version="3.0">\n'
+            '    <objects>\n'
+            f'        <placeholder placeholderIdentifier="IBFilesOwner" id="-1" customClass="{name}"/>\n'
+            '    </objects>\n</document>\n')
+
+
+def _pbxproj(paths: list) -> str:
+    entries = '\n'.join(f'\t\tFILE{i:06d} /* {path.split("/")[-1]} */ = {{isa = PBXFileReference; '
+                        f'path = {path.split("/")[-1]}; sourceTree = "<group>"; }};'
+                        for i, path in enumerate(paths))
+    return f'// !$*UTF8*$!\n{{\n\tobjects = {{\n{entries}\n\t}};\n}}\n'
+
+
+def generate_project(n_files: int = 50, n_functions: int = 10, guard_density: float = 0.5, loop_density: float = 0.5,
+                     n_types: int = 20, n_interfaces: int = 4, n_images: int = 4, seed: int = 0,
+                     root: str = ROOT) -> dict:
+    """
+    Generates a Swift project. The same arguments always give the same project.
+
+    :param n_files: int, number of .swift source files
+    :param n_functions: int, number of functions per source file, the file size grows with it
+    :param guard_density: float, share of the functions that start with a guard statement
+    :param loop_density: float, share of the functions with a for loop, half as many have a second one
+    :param n_types: int, number of declared classes, structs, enums and protocols, besides the view controllers
+    :param n_interfaces: int, number of storyboards and xibs, they reference the view controllers
+    :param n_images: int, number of image assets
+    :param seed: int, seed for the random generator
+    :param root: str, folder of the project
+    :return: dict {path: content}, str for text files and bytes for images
+    """
+    rng = random.Random(seed)
+    types = [(TYPE_KINDS[i % len(TYPE_KINDS)], f'Model{i}') for i in range(n_types)]
+    type_names = [name for _, name in types] or ['String']
+    project = {}
+
+    with _seeded(seed):
+        for i in range(n_files):
+            own_types = types[i::n_files]
+            source = _source_file(i, own_types, type_names, n_functions, guard_density, loop_density, rng)
+            project[f'{root}/App/Sources/Module{i % 8}/ViewController{i}.swift'] = source
+
+    controllers = [f'ViewController{i}' for i in range(n_files)]
+    for i in range(n_interfaces):
+        if i % 2 == 0:
+            project[f'{root}/App/Base.lproj/Main{i}.storyboard'] = _storyboard(i, controllers[i::n_interfaces])
+        elif controllers:
+            name = controllers[i % len(controllers)]
+            project[f'{root}/App/Views/{name}.xib'] = _xib(name)
+
+    project[f'{root}/Pods/Lib/Lib.swift'] = 'import Foundation\n\npublic class LibClient {\n    public init() {}\n}\n'
+    for i in range(n_images):
+        project[f'{root}/App/Assets.xcassets/icon{i}.imageset/icon{i}.png'] = _PNG
+
+    project[f'{root}/App.xcodeproj/project.pbxproj'] = _pbxproj(sorted(project))
+    return project
+
+
+def swift_sources(project: dict) -> dict:
+    """
+    Returns the .swift files of a generated project outside of Pods, the files the per-file stages transform.
+    """
+    return {path: content for path, content in project.items()
+            if path.endswith('.swift') and '/Pods/' not in path}
+
+
+def write_project(project: dict, directory: str):
+    """
+    Writes a generated project to a directory.
+
+    :param project: dict {path: content} from generate_project
+    :param directory: str, directory to write the project folder to
+    """
+    for path, content in project.items():
+        target = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if isinstance(content, bytes):
+            with open(target, 'wb') as file:
+                file.write(content)
+        else:
+            with open(target, 'w', encoding='utf-8') as file:
+                file.write(content)
+
+
+def write_zip(project: dict, zip_path: str):
+    """
+    Writes a generated project to a zip archive, as it would be uploaded.
+
+    :param project: dict {path: content} from generate_project
+    :param zip_path: str, path of the archive
+    """
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for path, content in sorted(project.items()):
+            archive.writestr(path, content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output')
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--functions', type=int, default=10)
+    parser.add_argument('--guards', type=float, default=0.5)
+    parser.add_argument('--loops', type=float, default=0.5)
+    parser.add_argument('--types', type=int, default=20)
+    parser.add_argument('--interfaces', type=int, default=4)
+    parser.add_argument('--images', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    project = generate_project(args.files, args.functions, args.guards, args.loops, args.types, args.interfaces,
+                               args.images, args.seed)
+    if args.output.endswith('.zip'):
+        write_zip(project, args.output)
+    else:
+        write_project(project, args.output)
+    size = sum(len(content) for content in project.values())
+    print(f'Generated {len(project)} files, {size} bytes, in {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Benchmarks transform_conditions on generated files with a growing number of guard statements.
+
+Usage: python -m benchmarks.guards [--max-guards 20000]
+"""
+import argparse
+import random
+
+from api.scripts.text import transform_conditions
+from benchmarks import run_scaling
+
+
+def generate_guards_file(n_guards: int, seed: int = 0) -> str:
+    """
+    Generates a Swift file with n_guards guard statements, some of them nested and some sharing the same text.
+
+    :param n_guards: int, number of guard statements
+    :param seed: int, seed for the random generator
+    :return: str, generated Swift code
+    """
+    rng = random.Random(seed)
+    functions = []
+    for i in range(0, n_guards, 4):
+        functions.append(f'''
+func check{i}(value: Int, other: Int?) -> Int {{
+    guard value > {rng.randint(0, 100)}, value < 1000 else {{
+        guard value != 0 else {{ return 0 }}
+        return -1
+    }}
+    guard let unwrapped = other else {{ return value }}
+    guard value > 1 else {{ return 1 }}
+    return value + unwrapped
+}}''')
+    return 'import Foundation\n' + '\n'.join(functions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-guards', type=int, default=20000)
+    parser.add_argument('--steps', type=int, default=5)
+    args = parser.parse_args()
+
+    sizes = [args.max_guards // 2 ** i for i in reversed(range(args.steps))]
+    run_scaling(generate_guards_file, transform_conditions, sizes, unit='guards', comment_adding=True)
+
+
+if __name__ == '__main__':
+    main()
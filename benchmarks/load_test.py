@@ -0,0 +1,349 @@
+"""
+Drives concurrent clients through the whole flow against a local server: get_id, upload of a generated project,
+notifications until the project is ready, and download. Reports throughput, time to ready, how late the ready
+notification reaches the client, and the memory of the server processes over time.
+
+By default a uvicorn server of api.main:app is started in a temporary directory. The lag of the notifications is
+measured against the finish time in the job registry, so it is only reported for that server.
+
+Usage: python -m benchmarks.load_test [--clients 4] [--jobs 16] [--files 50] [--functions 10] [--workers 1]
+                                      [--url http://127.0.0.1:8000] [--output report.json]
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import math
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import websockets
+
+from benchmarks.generator import generate_project, write_zip
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: list, p: float):
+    """
+    Returns the p-th percentile of the values by the nearest-rank method, None for no values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _process_tree(pid: int) -> list:
+    # the server and all its descendants: uvicorn workers, the fork server and the job processes
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as file:
+                # the command name may contain spaces, the fields after it are separated by single spaces
+                ppid = int(file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, ()))
+    return tree
+
+
+def _rss(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the resident memory of a process and its descendants. Linux only.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []  # (seconds since start, bytes)
+        self._stopped = threading.Event()
+
+    def run(self):
+        start = time.monotonic()
+        while not self._stopped.is_set():
+            self.samples.append((time.monotonic() - start, sum(_rss(pid) for pid in _process_tree(self.pid))))
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class Server:
+    """
+    uvicorn server of api.main:app in a temporary directory, which holds its projects and job registry.
+    """
+
+    def __init__(self, workers: int = 1):
+        self.directory = tempfile.TemporaryDirectory(prefix='paraphraser-load-')
+        self.port = _free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')]))}
+        self.log = open(os.path.join(self.directory.name, 'server.log'), 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'api.main:app', '--port', str(self.port), '--workers', str(workers),
+             '--ws', 'websockets'],
+            cwd=self.directory.name, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        self._wait_until_ready()
+
+    @property
+    def jobs_database(self) -> str:
+        return os.path.join(self.directory.name, os.environ.get('PARAPHRASER_JOBS_DATABASE', 'jobs.sqlite3'))
+
+    def _wait_until_ready(self, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'The server exited with code {self.process.returncode}, '
+                                   f'see {self.log.name}')
+            try:
+                _request(self.url, 'GET', '/api/v1/get_id')
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError('The server did not start in time')
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+        self.directory.cleanup()
+
+
+def _request(url: str, method: str, path: str, body: bytes = None, headers: dict = None):
+    parsed = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=600)
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, {name.lower(): value for name, value in response.getheaders()}, response.read()
+    finally:
+        connection.close()
+
+
+def _multipart(field: str, filename: str, data: bytes) -> (bytes, str):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/zip\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def _finished_at(database: str, project_id: str):
+    try:
+        with sqlite3.connect(database, timeout=5) as connection:
+            row = connection.execute('SELECT finished_at FROM jobs WHERE project_id = ?', (project_id,)).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+
+
+async def run_job(url: str, archive: bytes, filename: str, jobs_database: str = None) -> dict:
+    """
+    Runs one project through the whole flow.
+
+    :return: dict with the outcome and the timings of the job in seconds
+    """
+    result = {'status': None, 'rejections': 0, 'messages': 0}
+    start = time.monotonic()
+    _, _, project_id = await asyncio.to_thread(_request, url, 'GET', '/api/v1/get_id')
+    project_id = json.loads(project_id)
+    user_id = uuid.uuid4().hex
+    result['project_id'] = project_id
+
+    ws_url = url.replace('http', 'ws', 1) + f'/ws/notifications/{project_id}'
+    async with websockets.connect(ws_url, max_size=None) as websocket:
+        await websocket.recv()  # 'Listening for notifications...'
+        body, content_type = _multipart('zip_file', filename, archive)
+        query = urllib.parse.urlencode({'project_id': project_id, 'user_id': user_id})
+        while True:
+            upload_start = time.monotonic()
+            status, headers, response = await asyncio.to_thread(
+                _request, url, 'POST', f'/api/v1/upload?{query}', body, {'Content-Type': content_type})
+            if status != 429:
+                break
+            result['rejections'] += 1
+            await asyncio.sleep(float(headers.get('retry-after', 1)))
+        result['upload'] = time.monotonic() - upload_start
+        if status != 200:
+            result['status'] = f'upload failed: {status} {response[:200]!r}'
+            return result
+
+        while True:
+            message = await websocket.recv()
+            received_at = time.time()
+            result['messages'] += 1
+            if message.startswith('Error'):
+                result['status'] = message
+                return result
+            if message == 'Project is ready to download':
+                break
+        result['time_to_ready'] = time.monotonic() - upload_start
+        if jobs_database is not None:
+            finished_at = await asyncio.to_thread(_finished_at, jobs_database, project_id)
+            if finished_at is not None:
+                result['ready_lag'] = received_at - finished_at
+
+    download_start = time.monotonic()
+    query = urllib.parse.urlencode({'project_id': project_id, 'user_id': user_id})
+    status, _, data = await asyncio.to_thread(_request, url, 'GET', f'/api/v1/download?{query}')
+    result['download'] = time.monotonic() - download_start
+    result['downloaded_bytes'] = len(data)
+    result['total'] = time.monotonic() - start
+    result['status'] = 'ok' if status == 200 else f'download failed: {status}'
+    return result
+
+
+async def run_clients(url: str, archive: bytes, filename: str, n_clients: int, n_jobs: int,
+                      jobs_database: str = None) -> list:
+    """
+    Runs n_jobs jobs on n_clients concurrent clients, every client runs its jobs one after another.
+
+    :return: list of job results, see run_job
+    """
+    queue = asyncio.Queue()
+    for _ in range(n_jobs):
+        queue.put_nowait(None)
+    results = []
+
+    async def client():
+        while not queue.empty():
+            queue.get_nowait()
+            try:
+                results.append(await run_job(url, archive, filename, jobs_database))
+            except Exception as e:
+                results.append({'status': f'{type(e).__name__}: {e}'})
+
+    await asyncio.gather(*(client() for _ in range(n_clients)))
+    return results
+
+
+def summarize(results: list, wall_time: float, archive_size: int, memory: list) -> dict:
+    """
+    Aggregates the job results into the report.
+    """
+    done = [result for result in results if result.get('status') == 'ok']
+
+    def distribution(key):
+        values = [result[key] for result in done if key in result]
+        return {f'p{p}': percentile(values, p) for p in (50, 95, 99)} | {'max': max(values, default=None)}
+
+    rss = [sample for _, sample in memory]
+    return {
+        'jobs': len(results),
+        'completed': len(done),
+        'failed': len(results) - len(done),
+        'errors': sorted({result['status'] for result in results if result.get('status') != 'ok'}),
+        'rejections': sum(result.get('rejections', 0) for result in results),
+        'wall_time': wall_time,
+        'jobs_per_minute': len(done) / wall_time * 60 if wall_time else None,
+        'uploaded_mb_per_second': len(done) * archive_size / wall_time / 1e6 if wall_time else None,
+        'time_to_ready': distribution('time_to_ready'),
+        'total_time': distribution('total'),
+        'ready_lag': distribution('ready_lag'),
+        'rss_peak': max(rss, default=None),
+        'rss_mean': sum(rss) / len(rss) if rss else None,
+        'rss_samples': memory,
+    }
+
+
+def _print_report(report: dict):
+    def seconds(value):
+        return f'{value:.3f}s' if value is not None else '-'
+
+    print(f'jobs: {report["completed"]} completed, {report["failed"]} failed, '
+          f'{report["rejections"]} rejected uploads retried')
+    for error in report['errors']:
+        print(f'  error: {error}')
+    print(f'wall time: {report["wall_time"]:.1f}s, {report["jobs_per_minute"]:.1f} jobs/min, '
+          f'{report["uploaded_mb_per_second"]:.2f} MB/s uploaded')
+    for key in ('time_to_ready', 'total_time', 'ready_lag'):
+        values = report[key]
+        print(f'{key:<14}' + ''.join(f' {name} {seconds(value):>9}' for name, value in values.items()))
+    if report['rss_peak'] is not None:
+        print(f'server RSS: peak {report["rss_peak"] / 2 ** 20:.0f} MiB, mean {report["rss_mean"] / 2 ** 20:.0f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=4, help='number of concurrent clients')
+    parser.add_argument('--jobs', type=int, default=16, help='total number of jobs')
+    parser.add_argument('--files', type=int, default=50, help='source files of the generated project')
+    parser.add_argument('--functions', type=int, default=10, help='functions per source file')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes of the started server')
+    parser.add_argument('--url', help='URL of a running server to test instead of starting one')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between memory samples')
+    parser.add_argument('--output', help='path to write the JSON report to')
+    args = parser.parse_args()
+
+    archive_path = os.path.join(tempfile.mkdtemp(prefix='paraphraser-project-'), 'Project.zip')
+    write_zip(generate_project(n_files=args.files, n_functions=args.functions), archive_path)
+    with open(archive_path, 'rb') as file:
+        archive = file.read()
+    os.remove(archive_path)
+    os.rmdir(os.path.dirname(archive_path))
+
+    server = Server(args.workers) if args.url is None else None
+    url = args.url or server.url
+    sampler = MemorySampler(server.process.pid, args.interval) if server is not None else None
+    try:
+        if sampler is not None:
+            sampler.start()
+        start = time.monotonic()
+        results = asyncio.run(run_clients(url, archive, 'Project.zip', args.clients, args.jobs,
+                                          server.jobs_database if server is not None else None))
+        wall_time = time.monotonic() - start
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if server is not None:
+            server.stop()
+
+    report = summarize(results, wall_time, len(archive), sampler.samples if sampler is not None else [])
+    report['parameters'] = vars(args)
+    _print_report(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Report written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
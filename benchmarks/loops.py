@@ -0,0 +1,49 @@
+"""
+Benchmarks transform_loops on generated files with a growing number of for loops, a third of them nested.
+
+Usage: python -m benchmarks.loops [--max-loops 20000]
+"""
+import argparse
+import random
+
+from api.scripts.text import transform_loops
+from benchmarks import run_scaling
+
+
+def generate_loops_file(n_loops: int, seed: int = 0) -> str:
+    """
+    Generates a Swift file with n_loops for loops, some of them nested and some sharing the same text.
+
+    :param n_loops: int, number of for loops
+    :param seed: int, seed for the random generator
+    :return: str, generated Swift code
+    """
+    rng = random.Random(seed)
+    functions = []
+    for i in range(0, n_loops, 3):
+        functions.append(f'''
+func sum{i}(rows: [[Int]]) -> Int {{
+    var total = 0
+    for row in rows {{
+        for value in row where value > {rng.randint(0, 100)} {{
+            total += value
+        }}
+    }}
+    for index in 0..<10 {{ total += index }}
+    return total
+}}''')
+    return 'import Foundation\n' + '\n'.join(functions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-loops', type=int, default=20000)
+    parser.add_argument('--steps', type=int, default=5)
+    args = parser.parse_args()
+
+    sizes = [args.max_loops // 2 ** i for i in reversed(range(args.steps))]
+    run_scaling(generate_loops_file, transform_loops, sizes, unit='loops', comment_adding=True)
+
+
+if __name__ == '__main__':
+    main()
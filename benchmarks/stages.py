@@ -0,0 +1,172 @@
+"""
+Times the pipeline stages on generated projects of growing size and writes the results as JSON, so that runs on
+different commits can be compared. The per-file stages run serially over the .swift sources of the project,
+rename_types runs on the whole project with a map of every declared type.
+
+Usage: python -m benchmarks.stages [--files 10,40,160] [--functions 10] [--stages remove_comments,...]
+                                   [--output results.json] [--baseline old.json] [--tolerance 1.25]
+"""
+import argparse
+import datetime
+import json
+import platform
+import random
+import subprocess
+import sys
+
+from api.scripts.comment_utils import add_comments
+from api.scripts.project_index import ProjectIndex
+from api.scripts.rename_utils import rename_variables, rename_types, parse_types_in_project, generate_rename_map
+from api.scripts.text import remove_comments, transform_conditions, transform_loops, parse_functions, \
+    restructure_functions
+from benchmarks import time_call, growth_exponent
+from benchmarks.generator import generate_project, swift_sources
+
+
+def _per_file(func: callable) -> callable:
+    def run(project: dict):
+        for content in swift_sources(project).values():
+            func(content)
+    return run
+
+
+def _parse_all_functions(code: str) -> list:
+    # parse_functions is lazy
+    return list(parse_functions(code))
+
+
+def _rename_types(project: dict):
+    sources = {path: content for path, content in project.items() if isinstance(content, str)}
+    index = ProjectIndex(sources)
+    rename_map = generate_rename_map(sorted(parse_types_in_project(sources, index=index)))
+    rename_types(sources, rename_map, index=index)
+
+
+STAGES = {
+    'remove_comments': _per_file(remove_comments),
+    'transform_conditions': _per_file(transform_conditions),
+    'transform_loops': _per_file(transform_loops),
+    'parse_functions': _per_file(_parse_all_functions),
+    'restructure_functions': _per_file(restructure_functions),
+    'rename_variables': _per_file(rename_variables),
+    'add_comments': _per_file(add_comments),
+    'rename_types': _rename_types,
+}
+
+
+def _seeded(func: callable) -> callable:
+    # some stages pick random names and comments, the same seed makes every run do the same work
+    def run(project: dict):
+        random.seed(0)
+        func(project)
+    return run
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(file_counts: list, stages: list, repeat: int = 3, **project_options) -> dict:
+    """
+    Times the stages on generated projects.
+
+    :param file_counts: list of numbers of source files of the generated projects
+    :param stages: list of names of STAGES to time
+    :param repeat: int, number of runs per stage and size, the fastest one is reported
+    :param project_options: kwargs to pass to generate_project
+    :return: dict with the environment and a list of results {stage, files, bytes, seconds, mb_per_second}
+    """
+    results = []
+    print(f'{"stage":<22} {"files":>6} {"bytes":>10} {"seconds":>9} {"MB/s":>8}')
+    for n_files in file_counts:
+        project = generate_project(n_files=n_files, **project_options)
+        n_bytes = sum(len(content.encode('utf-8')) for content in swift_sources(project).values())
+        for stage in stages:
+            seconds = time_call(_seeded(STAGES[stage]), project, repeat=repeat)
+            throughput = n_bytes / seconds / 1e6 if seconds else None
+            results.append({'stage': stage, 'files': n_files, 'bytes': n_bytes, 'seconds': seconds,
+                            'mb_per_second': throughput})
+            print(f'{stage:<22} {n_files:>6} {n_bytes:>10} {seconds:>9.4f} {throughput or 0:>8.2f}')
+
+    exponents = {}
+    for stage in stages:
+        sizes = [result['bytes'] for result in results if result['stage'] == stage]
+        times = [result['seconds'] for result in results if result['stage'] == stage]
+        if len(sizes) > 1:
+            exponents[stage] = growth_exponent(sizes, times)
+
+    return {
+        'commit': _git_commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'project': project_options,
+        'results': results,
+        'growth_exponents': exponents,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares a report to a baseline report and prints the slowdown of every stage and size both contain.
+
+    :param report: dict from run_suite
+    :param baseline: dict from run_suite on an earlier commit
+    :param tolerance: float, slowdowns above this ratio are reported as regressions
+    :return: list of (stage, files, ratio) of the regressions
+    """
+    previous = {(result['stage'], result['files']): result['seconds'] for result in baseline['results']}
+    regressions = []
+    print(f'\ncompared to {baseline.get("commit")} ({baseline.get("date")}):')
+    for result in report['results']:
+        key = (result['stage'], result['files'])
+        if key not in previous or not previous[key]:
+            continue
+        ratio = result['seconds'] / previous[key]
+        flag = ' REGRESSION' if ratio > tolerance else ''
+        print(f'{result["stage"]:<22} {result["files"]:>6} {ratio:>7.2f}x{flag}')
+        if flag:
+            regressions.append((*key, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', default='10,40,160', help='comma-separated numbers of source files')
+    parser.add_argument('--functions', type=int, default=10, help='functions per source file')
+    parser.add_argument('--guards', type=float, default=0.5)
+    parser.add_argument('--loops', type=float, default=0.5)
+    parser.add_argument('--types', type=int, default=20)
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma-separated names of the stages to time')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='path to write the JSON report to')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f'unknown stages: {", ".join(unknown)}')
+
+    report = run_suite([int(n) for n in args.files.split(',')], stages, args.repeat, n_functions=args.functions,
+                       guard_density=args.guards, loop_density=args.loops, n_types=args.types)
+    for stage, exponent in report['growth_exponents'].items():
+        print(f'{stage} growth exponent: {exponent:.2f} (1.0 is linear)')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(report, json.load(file), args.tolerance)
+
+
+if __name__ == '__main__':
+    main()
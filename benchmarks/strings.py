@@ -0,0 +1,94 @@
+"""
+Benchmarks renaming an identifier outside of string literals on generated files of growing size: the legacy
+quote-parity lookahead against the lexer's region mask and the token-based rename_identifiers.
+
+Usage: python -m benchmarks.strings [--max-kb 1024] [--skip-legacy]
+"""
+import argparse
+import random
+
+import regex as re
+
+from api.scripts.lexer import lex
+from api.scripts.rename_utils import rename_identifiers
+from benchmarks import time_call, growth_exponent
+
+OLD_NAME = 'ProfileModel'
+NEW_NAME = 'TypeProfileModel'
+
+# the pattern rename_type used before the lexer, the lookahead scans to the end of the file for every candidate
+LEGACY_PATTERN = re.compile(r'(?<!\w)' + OLD_NAME + r'(?!\w)(?=(?:(?:[^"]*"){2})*[^"]*$)', re.MULTILINE)
+
+NAME_PATTERN = re.compile(r'(?<!\w)' + OLD_NAME + r'(?!\w)')
+
+
+def generate_strings_file(n_bytes: int, seed: int = 0) -> str:
+    """
+    Generates a Swift file of about n_bytes with string literals, escaped quotes, multi-line strings and comments
+    that mention the renamed type next to code that uses it.
+
+    :param n_bytes: int, approximate size of the file
+    :param seed: int, seed for the random generator
+    :return: str, generated Swift code
+    """
+    rng = random.Random(seed)
+    functions = ['import Foundation\n']
+    size = 0
+    i = 0
+    while size < n_bytes:
+        function = f'''
+// builds a {OLD_NAME} for "row {i}"
+func makeProfile{i}(name: String) -> {OLD_NAME} {{
+    let model = {OLD_NAME}(name: name, age: {rng.randint(0, 100)})
+    print("created \\"{OLD_NAME}\\" for \\(name)")
+    let description = """
+        {OLD_NAME} "{i}"
+        """
+    return model
+}}
+'''
+        functions.append(function)
+        size += len(function)
+        i += 1
+    return ''.join(functions)
+
+
+def rename_legacy(code: str) -> str:
+    return LEGACY_PATTERN.sub(NEW_NAME, code)
+
+
+def rename_with_mask(code: str) -> str:
+    source = lex(code)
+    return NAME_PATTERN.sub(lambda match: NEW_NAME if source.is_code(match.start()) else match.group(), code)
+
+
+def rename_with_tokens(code: str) -> str:
+    return rename_identifiers(code, {OLD_NAME: NEW_NAME})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-kb', type=int, default=1024)
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--skip-legacy', action='store_true', help='do not time the quadratic legacy pattern')
+    args = parser.parse_args()
+
+    sizes = [args.max_kb * 1024 // 2 ** i for i in reversed(range(args.steps))]
+    variants = {'mask': rename_with_mask, 'tokens': rename_with_tokens}
+    if not args.skip_legacy:
+        variants = {'legacy': rename_legacy, **variants}
+
+    times = {name: [] for name in variants}
+    print(f'{"bytes":>10}' + ''.join(f' {name:>9}' for name in variants))
+    for size in sizes:
+        code = generate_strings_file(size)
+        for name, func in variants.items():
+            times[name].append(time_call(func, code, repeat=1 if name == 'legacy' else 3))
+        print(f'{len(code):>10}' + ''.join(f' {times[name][-1]:>9.4f}' for name in variants))
+
+    for name in variants:
+        print(f'{name} growth exponent: {growth_exponent(sizes, times[name]):.2f} (1.0 is linear)')
+
+
+if __name__ == '__main__':
+    main()